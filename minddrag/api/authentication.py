@@ -0,0 +1,30 @@
+"""
+Authentication of the API requests.
+"""
+
+from django.contrib.auth.models import AnonymousUser
+from piston.authentication import HttpBasicAuthentication
+
+from core.tokens import get_token_user
+
+
+class TokenAuthentication(HttpBasicAuthentication):
+    """
+    Accepts API tokens (see ``core.tokens``) in an ``Authorization: Token
+    <token>`` header, and username and password with HTTP basic
+    authentication like before. ``request.auth_method`` tells which one was
+    used.
+    """
+
+    def is_authenticated(self, request):
+        auth_string = request.META.get('HTTP_AUTHORIZATION', '')
+        method, credentials = (auth_string.split(' ', 1) + [''])[:2]
+
+        if method.lower() != 'token':
+            request.auth_method = 'basic'
+            return super(TokenAuthentication, self).is_authenticated(request)
+
+        request.auth_method = 'token'
+        user = get_token_user(credentials.strip())
+        request.user = user or AnonymousUser()
+        return user is not None
@@ -0,0 +1,511 @@
+"""
+Benchmark of the API handlers and views on synthetic data.
+
+``generate`` fills the database with users, teams with large member lists,
+chains of connected dragables and annotations of every type. ``run`` sends
+requests to every handler method and view in process, through the Django
+test client, and reports the throughput, the latency percentiles, the
+number of queries (see ``core.metrics``) and the memory every scenario
+needs on top of the one the process already uses.
+
+Use the ``benchmark`` management command, which runs both on a fresh test
+database.
+"""
+
+# api.resource would shadow the resource module of the standard library
+from __future__ import absolute_import
+
+import random
+import resource
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import Client
+from django.utils import simplejson
+
+from core import metrics
+from core.bulk import insert_instances
+from core.models import Annotation
+from core.models import Dragable
+from core.models import Team
+
+PASSWORD = 'benchmark'
+
+# the words of titles, texts and notes, so that searches find something
+WORDS = ('mind', 'map', 'graph', 'idea', 'note', 'link', 'draft', 'paper',
+         'research', 'video', 'image', 'archive', 'reference', 'summary')
+
+ANNOTATION_TYPES = ('note', 'url', 'image', 'video', 'file', 'connection')
+
+
+def _text(rng, words):
+    return ' '.join([rng.choice(WORDS) for i in range(words)])
+
+
+def _status_kb(name):
+    # e.g. "VmHWM:     1234 kB"
+    try:
+        status = open('/proc/self/status')
+        try:
+            for line in status:
+                if line.startswith(name + ':'):
+                    return int(line.split()[1])
+        finally:
+            status.close()
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def _reset_peak_memory():
+    """
+    Resets the peak memory of the process to the current one and returns
+    the current one, in kilobytes.
+
+    Without ``/proc`` (or if the peak can't be reset) it returns the peak so
+    far, so that the difference to ``_peak_memory`` is the growth of the
+    peak, which is 0 for a scenario that needs less than an earlier one.
+    """
+    try:
+        clear_refs = open('/proc/self/clear_refs', 'w')
+        try:
+            # resets VmHWM, Linux 4.0 and newer
+            clear_refs.write('5')
+        finally:
+            clear_refs.close()
+    except IOError:
+        return _peak_memory()
+    current = _status_kb('VmRSS')
+    if current is None:
+        return _peak_memory()
+    return current
+
+
+def _peak_memory():
+    peak = _status_kb('VmHWM')
+    if peak is None:
+        # the same unit on Linux, the high-water mark of the whole process
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak
+
+
+def generate(users=1000, teams=100, members=200, dragables=100000,
+             chain_length=10, annotations=1, batch_size=1000, seed=0,
+             log=None):
+    """
+    Creates the benchmark data and returns the numbers of the created
+    objects.
+
+    The user ``benchmark`` is a member of all ``teams``, the other members
+    are drawn from ``users``. The ``dragables`` are spread evenly over the
+    teams and connected to each other in chains of ``chain_length``. Every
+    dragable has ``annotations`` annotations, their types take turns.
+    """
+    rng = random.Random(seed)
+    log = log or (lambda message: None)
+    start = time.time()
+
+    user = User.objects.create_user('benchmark',
+                                    'benchmark@example.com',
+                                    PASSWORD)
+    user_list = [user]
+    for i in range(users):
+        member = User(username='bench%d' % i,
+                      email='bench%d@example.com' % i,
+                      password=user.password)
+        member.save()
+        user_list.append(member)
+    log('%d users' % len(user_list))
+
+    team_list = []
+    for i in range(teams):
+        team = Team(name='bench team %d' % i,
+                    description=_text(rng, 8),
+                    created_by=rng.choice(user_list))
+        team.save()
+        team.members.add(user,
+                         *rng.sample(user_list, min(members, len(user_list))))
+        team_list.append(team)
+    log('%d teams' % len(team_list))
+
+    counts = {'users': len(user_list), 'teams': len(team_list),
+              'dragables': 0, 'annotations': 0}
+    chains = max(1, batch_size // chain_length)
+
+    for i, team in enumerate(team_list):
+        creators = [u.pk for u in rng.sample(user_list,
+                                             min(members, len(user_list)))]
+        count = dragables // teams + (i < dragables % teams and 1 or 0)
+        made = 0
+
+        while made < count:
+            # a batch of chains, one level at a time, so that the dragables
+            # of the previous level have primary keys
+            previous = [None] * min(chains, count - made)
+            for level in range(chain_length):
+                batch = []
+                for parent in previous:
+                    if made >= count:
+                        break
+                    batch.append(Dragable(
+                                hash='bench-d%d' % counts['dragables'],
+                                team_id=team.pk,
+                                created_by_id=rng.choice(creators),
+                                url='http://www.example.com/%d'
+                                    % counts['dragables'],
+                                title=_text(rng, 4),
+                                text=_text(rng, 30),
+                                xpath='/html/body/div[%d]' % level,
+                                connected_to_id=parent and parent.pk))
+                    counts['dragables'] += 1
+                    made += 1
+                if not batch:
+                    break
+
+                insert_instances(Dragable, batch)
+                counts['annotations'] += _annotate(rng, batch, creators,
+                                                   annotations,
+                                                   counts['annotations'])
+                previous = batch
+
+        log('%d dragables, %d annotations' % (counts['dragables'],
+                                              counts['annotations']))
+
+    counts['seconds'] = time.time() - start
+    return counts
+
+
+def _annotate(rng, dragables, creators, per_dragable, offset):
+    batch = []
+    for dragable in dragables:
+        for i in range(per_dragable):
+            type = ANNOTATION_TYPES[(offset + len(batch)) %
+                                    len(ANNOTATION_TYPES)]
+            annotation = Annotation(hash='bench-a%d' % (offset + len(batch)),
+                                    dragable_id=dragable.pk,
+                                    created_by_id=rng.choice(creators),
+                                    type=type)
+            if type == 'note':
+                annotation.note = _text(rng, 20)
+            elif type == 'connection':
+                target = rng.choice(dragables)
+                if target is dragable:
+                    continue
+                annotation.connected_dragable_id = target.pk
+            else:
+                annotation.url = 'http://www.example.com/%s' % type
+                annotation.description = _text(rng, 10)
+            batch.append(annotation)
+
+    insert_instances(Annotation, batch)
+    return len(batch)
+
+
+class Scenario(object):
+    """
+    Requests to one handler method or view. ``request`` is called with the
+    client and the number of the request, and returns the response.
+    """
+
+    def __init__(self, name, request, client='api'):
+        self.name = name
+        self.request = request
+        self.client = client
+
+
+def _bulk_hashes(prefix, i, size):
+    return ','.join(['%s%d-%d' % (prefix, i, j) for j in range(size)])
+
+
+def _bulk_items(prefix, i, size, **fields):
+    items = []
+    for hash in _bulk_hashes(prefix, i, size).split(','):
+        item = {'hash': hash}
+        item.update(fields)
+        items.append(item)
+    return simplejson.dumps(items)
+
+
+def scenarios(counts, bulk_size=50, seed=0):
+    """
+    Returns the ``Scenario``s for the data created by ``generate``. The
+    writes of one scenario create the objects that the following ones
+    update and delete, so keep their order.
+    """
+    rng = random.Random(seed)
+    teams = counts['teams']
+    dragables = counts['dragables']
+    annotations = counts['annotations']
+    bulk_size = min(bulk_size, getattr(settings, 'API_BULK_MAX_ITEMS', 100))
+
+    def team():
+        return 'bench team %d' % rng.randrange(teams)
+
+    def dragable():
+        return 'bench-d%d' % rng.randrange(dragables)
+
+    def annotation():
+        return 'bench-a%d' % rng.randrange(annotations)
+
+    def hashes(pick, count=10):
+        return ','.join([pick() for i in range(count)])
+
+    def get(url, params=None):
+        return lambda c, i: c.get(url() if callable(url) else url,
+                                  params and params() or {})
+
+    def json_body(method, url, items):
+        return lambda c, i: getattr(c, method)(url, items(i),
+                                               content_type='application/json')
+
+    return [
+        Scenario('TeamHandler.read (list)',
+                 get('/api/1.0/teams/')),
+        Scenario('TeamHandler.read (name)',
+                 get(lambda: '/api/1.0/teams/%s/' % team())),
+        Scenario('TeamHandler.read (multi-get)',
+                 get('/api/1.0/teams/', lambda: {'name': hashes(team)})),
+        Scenario('TeamHandler.read (search)',
+                 get('/api/1.0/teams/', lambda: {'search': 'research'})),
+        Scenario('AnonymousTeamHandler.read',
+                 get('/api/1.0/teams/'),
+                 client='anonymous'),
+        Scenario('TeamGraphHandler.read',
+                 get(lambda: '/api/1.0/teams/%s/graph/' % team())),
+        Scenario('DragableHandler.read (list)',
+                 get('/api/1.0/dragables/')),
+        Scenario('DragableHandler.read (team)',
+                 get('/api/1.0/dragables/', lambda: {'team': team()})),
+        Scenario('DragableHandler.read (stream)',
+                 get('/api/1.0/dragables/',
+                     lambda: {'team': team(), 'stream': 1})),
+        Scenario('DragableHandler.read (hash)',
+                 get(lambda: '/api/1.0/dragables/%s/' % dragable())),
+        Scenario('DragableHandler.read (multi-get)',
+                 get('/api/1.0/dragables/',
+                     lambda: {'hash': hashes(dragable)})),
+        Scenario('DragableHandler.read (search)',
+                 get('/api/1.0/dragables/', lambda: {'search': 'research'})),
+        Scenario('DragableHandler.read (since)',
+                 get('/api/1.0/dragables/',
+                     lambda: {'since': _sync_token()})),
+        Scenario('NeighbourhoodHandler.read',
+                 get(lambda: '/api/1.0/dragables/%s/neighbourhood/'
+                             % dragable())),
+        Scenario('AnnotationHandler.read (list)',
+                 get('/api/1.0/annotations/')),
+        Scenario('AnnotationHandler.read (hash)',
+                 get(lambda: '/api/1.0/annotations/%s/' % annotation())),
+        Scenario('AnnotationHandler.read (dragable)',
+                 get('/api/1.0/annotations/',
+                     lambda: {'dragable': dragable()})),
+        Scenario('AnnotationHandler.read (multi-get)',
+                 get('/api/1.0/annotations/',
+                     lambda: {'hash': hashes(annotation)})),
+        Scenario('AnnotationHandler.read (search)',
+                 get('/api/1.0/annotations/',
+                     lambda: {'search': 'research'})),
+        Scenario('AnnotationHandler.read (since)',
+                 get('/api/1.0/annotations/',
+                     lambda: {'since': _sync_token()})),
+        Scenario('MetricsHandler.read',
+                 get('/api/1.0/_metrics')),
+        Scenario('views.my_dragables',
+                 get('/members/'),
+                 client='session'),
+
+        Scenario('TeamHandler.create',
+                 lambda c, i: c.post('/api/1.0/teams/',
+                                     {'name': 'bench new team %d' % i,
+                                      'description': _text(rng, 8)})),
+        Scenario('TeamHandler.update',
+                 lambda c, i: c.put('/api/1.0/teams/bench new team %d/' % i,
+                                    {'description': _text(rng, 8)})),
+        Scenario('DragableHandler.create',
+                 lambda c, i: c.post('/api/1.0/dragables/',
+                                     {'hash': 'bench-new-d%d' % i,
+                                      'team': team(),
+                                      'url': 'http://www.example.com/',
+                                      'xpath': '/html/body',
+                                      'title': _text(rng, 4)})),
+        Scenario('DragableHandler.update',
+                 lambda c, i: c.put('/api/1.0/dragables/bench-new-d%d/' % i,
+                                    {'title': _text(rng, 4)})),
+        Scenario('AnnotationHandler.create',
+                 lambda c, i: c.post('/api/1.0/annotations/',
+                                     _new_annotation(rng, i, dragable))),
+        Scenario('AnnotationHandler.update',
+                 lambda c, i: c.put('/api/1.0/annotations/bench-new-a%d/'
+                                    % i,
+                                    _updated_annotation(rng, i))),
+        Scenario('BulkDragableHandler.create',
+                 json_body('post', '/api/1.0/bulk/dragables/',
+                           lambda i: _bulk_items('bench-bulk-d', i,
+                                                 bulk_size,
+                                                 team=team(),
+                                                 url='http://www.example.com/',
+                                                 xpath='/html/body'))),
+        Scenario('BulkDragableHandler.update',
+                 json_body('put', '/api/1.0/bulk/dragables/',
+                           lambda i: _bulk_items('bench-bulk-d', i,
+                                                 bulk_size,
+                                                 title=_text(rng, 4)))),
+        Scenario('BulkAnnotationHandler.create',
+                 json_body('post', '/api/1.0/bulk/annotations/',
+                           lambda i: _bulk_items('bench-bulk-a', i,
+                                                 bulk_size,
+                                                 dragable=dragable(),
+                                                 type='note',
+                                                 note=_text(rng, 20)))),
+        Scenario('BulkAnnotationHandler.update',
+                 json_body('put', '/api/1.0/bulk/annotations/',
+                           lambda i: _bulk_items('bench-bulk-a', i,
+                                                 bulk_size,
+                                                 note=_text(rng, 20)))),
+
+        Scenario('BulkAnnotationHandler.delete',
+                 lambda c, i: c.delete('/api/1.0/bulk/annotations/',
+                                       {'hash': _bulk_hashes('bench-bulk-a', i,
+                                                             bulk_size)})),
+        Scenario('BulkDragableHandler.delete',
+                 lambda c, i: c.delete('/api/1.0/bulk/dragables/',
+                                       {'hash': _bulk_hashes('bench-bulk-d', i,
+                                                             bulk_size)})),
+        Scenario('AnnotationHandler.delete',
+                 lambda c, i: c.delete('/api/1.0/annotations/bench-new-a%d/'
+                                       % i)),
+        Scenario('DragableHandler.delete',
+                 lambda c, i: c.delete('/api/1.0/dragables/bench-new-d%d/'
+                                       % i)),
+        Scenario('TeamHandler.delete',
+                 lambda c, i: c.delete('/api/1.0/teams/bench new team %d/'
+                                       % i)),
+    ]
+
+
+def _sync_token():
+    from datetime import datetime
+    from datetime import timedelta
+    from api.pagination import encode_sync_token
+    return encode_sync_token(datetime.now() - timedelta(hours=1))
+
+
+def _new_annotation(rng, i, dragable):
+    type = ANNOTATION_TYPES[i % len(ANNOTATION_TYPES)]
+    data = {'hash': 'bench-new-a%d' % i, 'dragable': dragable(), 'type': type}
+    if type == 'note':
+        data['note'] = _text(rng, 20)
+    elif type == 'connection':
+        data['connected_to'] = dragable()
+    else:
+        data['url'] = 'http://www.example.com/%s' % type
+        data['description'] = _text(rng, 10)
+    return data
+
+
+def _updated_annotation(rng, i):
+    type = ANNOTATION_TYPES[i % len(ANNOTATION_TYPES)]
+    if type == 'note':
+        return {'note': _text(rng, 20)}
+    if type == 'file':
+        return {'filename': 'bench%d.txt' % i}
+    if type == 'connection':
+        return {'connected_to': 'bench-d0'}
+    return {'url': 'http://www.example.com/%s' % type,
+            'description': _text(rng, 10)}
+
+
+def clients():
+    """
+    Returns the clients of the scenarios: the ``benchmark`` user with basic
+    authentication, with a session and anonymous.
+    """
+    import base64
+    credentials = base64.encodestring('benchmark:%s' % PASSWORD).rstrip()
+    api = Client(HTTP_AUTHORIZATION='Basic %s' % credentials)
+
+    session = Client()
+    session.login(username='benchmark', password=PASSWORD)
+
+    # makes the user staff for the metrics
+    User.objects.filter(username='benchmark').update(is_staff=True)
+
+    return {'api': api, 'session': session, 'anonymous': Client()}
+
+
+def run(scenarios, requests=100, only=None, log=None):
+    """
+    Sends ``requests`` requests per scenario (the ones whose names start
+    with one of ``only``, if given) and returns the report of each one.
+    """
+    log = log or (lambda message: None)
+    client_map = clients()
+    old_debug = settings.DEBUG
+    old_enabled = getattr(settings, 'METRICS_ENABLED', True)
+    # DEBUG keeps every query in memory
+    settings.DEBUG = False
+    settings.METRICS_ENABLED = True
+    reports = []
+
+    try:
+        for scenario in scenarios:
+            if only and not [n for n in only if scenario.name.startswith(n)]:
+                continue
+            reports.append(_run_scenario(scenario,
+                                         client_map[scenario.client],
+                                         requests))
+            log('%(name)s: %(throughput).1f requests/s' % reports[-1])
+    finally:
+        settings.DEBUG = old_debug
+        settings.METRICS_ENABLED = old_enabled
+
+    return reports
+
+
+def _run_scenario(scenario, client, requests):
+    metrics.registry.reset()
+    latencies = []
+    statuses = {}
+    response_bytes = 0
+    start_memory = _reset_peak_memory()
+    start = time.time()
+
+    for i in range(requests):
+        request_start = time.time()
+        response = scenario.request(client, i)
+        # streamed responses are rendered while they are read
+        response_bytes += len(response.content)
+        latencies.append(time.time() - request_start)
+        statuses[response.status_code] = statuses.get(response.status_code,
+                                                      0) + 1
+
+    elapsed = time.time() - start
+    memory = max(_peak_memory() - start_memory, 0)
+    latencies.sort()
+    measured = metrics.registry.as_dict()['handlers'].values()
+    queries = sum([stats['queries'] for stats in measured])
+    query_time = sum([stats['query_time'] for stats in measured])
+
+    def ms(seconds):
+        if seconds is None:
+            return None
+        return round(seconds * 1000, 3)
+
+    return {
+        'name': scenario.name,
+        'requests': requests,
+        'statuses': dict([(str(k), v) for k, v in statuses.items()]),
+        'throughput': elapsed and requests / elapsed or 0.0,
+        'latency_ms': {
+            'mean': ms(sum(latencies) / max(len(latencies), 1)),
+            'p50': ms(metrics.percentile(latencies, 50)),
+            'p95': ms(metrics.percentile(latencies, 95)),
+            'p99': ms(metrics.percentile(latencies, 99)),
+            'max': ms(metrics.percentile(latencies, 100)),
+        },
+        'queries': float(queries) / max(requests, 1),
+        'query_time_ms': ms(query_time / max(requests, 1)),
+        'response_bytes': response_bytes / max(requests, 1),
+        'memory_kb': memory,
+    }
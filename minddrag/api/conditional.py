@@ -0,0 +1,103 @@
+"""
+Conditional GETs based on the team versions (see ``core.versions``).
+
+The ETag of a response is derived from the versions of the teams its content
+depends on, so it is known before the handler runs. If the client already
+has the current representation, the handler isn't called at all and the
+response is an empty ``304 Not Modified``.
+
+Versioned reads go to the primary database while one of their teams has
+changed within the lag of the replicas (see ``core.routers.is_replicated``),
+a lagging replica would give an old representation the ETag of the current
+one. Otherwise they are served by the replicas.
+
+The ETag also names the gzip compressed representation (with a suffix, see
+``core.compression.gzip_etag``), which is cached by
+``core.middleware.CompressionMiddleware``. Clients that accept gzip get the
+cached representation without running the handler, rendering or compressing.
+"""
+
+from hashlib import md5
+
+from django.http import HttpResponseNotModified
+from django.utils.http import http_date
+from piston.decorator import decorator
+from piston.utils import HttpStatusCode
+
+from api.visibility import visible_team_ids
+from core import compression
+from core import routers
+from core.versions import ALL_TEAMS
+from core.versions import get_team_state
+
+
+def all_teams(request):
+    """
+    For reads that depend on the list of all teams.
+    """
+    return [ALL_TEAMS]
+
+
+def member_teams(request):
+    """
+    For reads that only depend on the teams the user is a member of.
+    Multi-gets also report objects of other teams, they aren't versioned.
+    """
+    if 'hash' in request.GET:
+        return None
+    return sorted(visible_team_ids(request))
+
+
+def _matching(etag, if_none_match):
+    # the tag in If-None-Match that names the current representation, plain
+    # or compressed, if any
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    for tag in (etag, compression.gzip_etag(etag)):
+        if tag in tags:
+            return tag
+    if '*' in tags:
+        return etag
+    return None
+
+
+def conditional(teams):
+    """
+    Decorator for ``read`` methods. ``teams`` is called with the request and
+    returns the ids of the teams whose versions determine the response, or
+    ``None`` if the response can't be versioned.
+
+    Stores the ETag and the time of the last modification in the request, the
+    ``Resource`` adds them to the response.
+    """
+    @decorator
+    def wrap(f, self, request, *args, **kwargs):
+        team_ids = teams(request)
+
+        if team_ids is not None:
+            versions, last_modified = get_team_state(team_ids)
+            if not routers.is_replicated(last_modified):
+                routers.read_from_primary()
+            key = '%s|%s|%s' % (request.get_full_path(),
+                                request.user.id,
+                                ','.join(['%s:%s' % (t, versions[t])
+                                          for t in team_ids]))
+            etag = '"%s"' % md5(key.encode('utf-8')).hexdigest()
+
+            tag = _matching(etag, request.META.get('HTTP_IF_NONE_MATCH', ''))
+            if tag:
+                response = HttpResponseNotModified()
+                response['ETag'] = tag
+                raise HttpStatusCode(response)
+
+            request.etag = etag
+            request.last_modified = http_date(last_modified)
+
+            if compression.accepts_gzip(request):
+                request.compressed_cache_key = 'api.gzip.%s' % etag.strip('"')
+                response = compression.get_compressed(
+                                                request.compressed_cache_key)
+                if response is not None:
+                    raise HttpStatusCode(response)
+
+        return f(self, request, *args, **kwargs)
+    return wrap
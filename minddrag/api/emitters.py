@@ -0,0 +1,301 @@
+"""
+Emitters for the Minddrag API.
+
+These replace the json, xml and yaml emitters of piston. Lists of objects
+are rendered one object at a time: every object is serialized on its own
+into a fragment, and the document is assembled from the fragments. The
+fragments of dragables and annotations are cached (see
+``api.representations``), so unchanged objects aren't serialized again.
+
+For streamed requests (see ``api.pagination.is_streamed``) the emitters
+return a generator that reads the queryset in chunks and yields the
+fragments as it goes, instead of building the whole document in memory.
+Everything else is rendered by the piston emitters as before.
+
+The MessagePack emitter (see ``api.messagepack``) is only registered if
+``msgpack`` is installed, it also registers the parser for request bodies
+of type ``application/x-msgpack``.
+"""
+
+try:
+    import cStringIO as StringIO
+except ImportError:
+    import StringIO
+
+from django.core.serializers.json import DateTimeAwareJSONEncoder
+from django.db.models import Model
+from django.db.models.query import QuerySet
+from django.utils.functional import curry
+from django.utils import simplejson
+from django.utils.xmlutils import SimplerXMLGenerator
+from piston import emitters
+from piston.emitters import Emitter
+from piston.utils import Mimer
+
+from api import messagepack
+from api.pagination import chunks
+from api.pagination import is_streamed
+from api.representations import get_fragments
+from core import metrics
+
+
+def _is_model_list(data):
+    if isinstance(data, QuerySet):
+        return True
+    if not isinstance(data, (list, tuple)):
+        return False
+    for item in data:
+        if not isinstance(item, Model):
+            return False
+    return True
+
+
+class _Fieldset(object):
+    """
+    Stands in for a handler in the typemapper, with the ``fields`` of a
+    sparse fieldset (see ``api.fieldsets``).
+    """
+
+    def __init__(self, handler, fields):
+        self.handler = handler
+        self.fields = fields
+
+
+    def __getattr__(self, name):
+        return getattr(self.handler, name)
+
+
+class FragmentMixin(object):
+    """
+    Renders lists of objects from the fragments of the single objects.
+
+    Only the fields of the sparse fieldset in ``request.fieldset`` are
+    serialized, if the handler selected one.
+    """
+    # name of the format, the fragments are cached under it
+    format = None
+    fieldset = None
+
+    def render(self, request):
+        self.fieldset = getattr(request, 'fieldset', None)
+        if self.fieldset is not None:
+            self.fields = self.fieldset
+
+        timer = metrics.current_timer()
+        if timer is None:
+            return self.render_data(request)
+        return timer.serializing(self.render_data, request)
+
+
+    def render_data(self, request):
+        if isinstance(self.data, QuerySet) and is_streamed(request):
+            return self.document(request, self.stream_fragments())
+        if _is_model_list(self.data):
+            return ''.join(self.document(request,
+                                         self.fragments(list(self.data))))
+        return super(FragmentMixin, self).render(request)
+
+
+    def fragment(self, item):
+        """
+        Returns the serialized ``dict`` of one object as a utf-8 encoded
+        string.
+        """
+        raise NotImplementedError("Please implement fragment.")
+
+
+    def document(self, request, fragments):
+        """
+        Yields the parts of the document that holds ``fragments``.
+        """
+        raise NotImplementedError("Please implement document.")
+
+
+    def fragments(self, objects):
+        prepare = getattr(self.handler, 'prepare', None)
+        if prepare and self.fieldset is not None:
+            prepare = curry(prepare, fields=self.fieldset)
+
+        return get_fragments(self.format,
+                             objects,
+                             self.render_fragment,
+                             prepare,
+                             cached=self.fieldset is None)
+
+
+    def render_fragment(self, obj):
+        data = self.data
+        self.data = obj
+        try:
+            return self.fragment(self.construct())
+        finally:
+            self.data = data
+
+
+    def in_typemapper(self, model, anonymous):
+        # ``only`` reads instances of a deferred subclass
+        if getattr(model, '_deferred', False):
+            model = model._meta.proxy_for_model
+
+        handler = super(FragmentMixin, self).in_typemapper(model, anonymous)
+        if (handler is not None and self.fieldset is not None and
+            model is getattr(self.handler, 'model', None)):
+            return _Fieldset(handler, self.fieldset)
+        return handler
+
+
+    def stream_fragments(self):
+        for chunk in chunks(self.data):
+            for fragment in self.fragments(chunk):
+                yield fragment
+
+
+def _dumps(item, **kwargs):
+    data = simplejson.dumps(item,
+                            cls=DateTimeAwareJSONEncoder,
+                            ensure_ascii=False,
+                            **kwargs)
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    return data
+
+
+class JSONEmitter(FragmentMixin, emitters.JSONEmitter):
+    """
+    JSON array of the objects.
+    """
+    format = 'json'
+
+    def fragment(self, item):
+        return _dumps(item, indent=4)
+
+
+    def document(self, request, fragments):
+        cb = request.GET.get('callback')
+        if cb:
+            yield '%s(' % cb
+
+        yield '['
+        separator = '\n'
+        for fragment in fragments:
+            yield separator
+            yield fragment
+            separator = ',\n'
+        yield '\n]'
+
+        if cb:
+            yield ')'
+
+
+class NDJSONEmitter(FragmentMixin, Emitter):
+    """
+    Newline delimited JSON, one object per line. Always streamed.
+    """
+    format = 'ndjson'
+
+    def render_data(self, request):
+        if isinstance(self.data, QuerySet):
+            return self.document(request, self.stream_fragments())
+        if _is_model_list(self.data):
+            return ''.join(self.fragments(list(self.data)))
+
+        data = self.construct()
+        if not isinstance(data, list):
+            data = [data]
+        return ''.join([self.fragment(item) for item in data])
+
+
+    def fragment(self, item):
+        return _dumps(item) + '\n'
+
+
+    def document(self, request, fragments):
+        return fragments
+
+
+class XMLEmitter(FragmentMixin, emitters.XMLEmitter):
+    """
+    XML document with one ``resource`` element per object.
+    """
+    format = 'xml'
+
+    def fragment(self, item):
+        stream = StringIO.StringIO()
+        xml = SimplerXMLGenerator(stream, 'utf-8')
+        xml.startElement('resource', {})
+        self._to_xml(xml, item)
+        xml.endElement('resource')
+        return stream.getvalue()
+
+
+    def document(self, request, fragments):
+        stream = StringIO.StringIO()
+        xml = SimplerXMLGenerator(stream, 'utf-8')
+        xml.startDocument()
+        xml.startElement('response', {})
+        yield stream.getvalue()
+
+        for fragment in fragments:
+            yield fragment
+
+        yield '</response>'
+
+
+class YAMLEmitter(FragmentMixin, emitters.YAMLEmitter):
+    """
+    YAML sequence of the objects.
+    """
+    format = 'yaml'
+
+    def fragment(self, item):
+        return emitters.yaml.safe_dump([item])
+
+
+    def document(self, request, fragments):
+        empty = True
+        for fragment in fragments:
+            empty = False
+            yield fragment
+
+        if empty:
+            yield emitters.yaml.safe_dump([])
+
+
+class MessagePackEmitter(FragmentMixin, Emitter):
+    """
+    MessagePack array of the objects, with the strings interned across all
+    of them. Streamed as a sequence of the objects.
+    """
+    format = 'msgpack'
+
+    def render_data(self, request):
+        interner = messagepack.Interner()
+        if isinstance(self.data, QuerySet) and is_streamed(request):
+            return self.document(request, self.stream_fragments(), interner)
+        if _is_model_list(self.data):
+            fragments = self.fragments(list(self.data))
+            return (interner.packer.pack_array_header(len(fragments)) +
+                    ''.join(self.document(request, fragments, interner)))
+        return interner.pack(self.construct())
+
+
+    def fragment(self, item):
+        # cached without interning, the numbers depend on the document
+        return messagepack.pack_fragment(item)
+
+
+    def document(self, request, fragments, interner):
+        for fragment in fragments:
+            yield interner.splice(fragment)
+
+
+Emitter.register('json', JSONEmitter, 'application/json; charset=utf-8')
+Emitter.register('ndjson', NDJSONEmitter, 'application/x-ndjson; charset=utf-8')
+Emitter.register('xml', XMLEmitter, 'text/xml; charset=utf-8')
+
+if emitters.yaml:
+    Emitter.register('yaml', YAMLEmitter, 'application/x-yaml; charset=utf-8')
+
+if messagepack.msgpack:
+    Emitter.register('msgpack', MessagePackEmitter, 'application/x-msgpack')
+    Mimer.register(messagepack.unpackb, ('application/x-msgpack',))
@@ -0,0 +1,101 @@
+"""
+Sparse fieldsets for the reads of teams, dragables and annotations.
+
+The ``fields`` URL parameter is a comma separated list of the fields a
+client wants, e.g. ``fields=hash,title,updated``. The handlers store the
+selected entries of their ``fields`` in ``request.fieldset`` and read only
+the columns those need (plus the ones the handler itself uses, like
+``created`` for the cursors), and the related objects of unselected fields
+aren't loaded at all. The emitters serialize the selected fields only.
+
+Instances read with ``only`` are of a deferred subclass of the model, which
+the emitters map to the handler of the model. Fragments of a fieldset aren't
+cached, they are cheap to render.
+"""
+
+from django.db.models import ForeignKey
+from django.db.models.fields import FieldDoesNotExist
+
+
+class InvalidFieldset(ValueError):
+    """
+    Raised when the ``fields`` URL parameter names unknown fields.
+    """
+    pass
+
+
+def field_name(field):
+    """
+    Returns the name of an entry of a handler's ``fields``, which is either
+    a name or a tuple of a name and the fields of the related object.
+    """
+    if isinstance(field, (list, tuple)):
+        return field[0]
+    return field
+
+
+def select_fields(request, handler):
+    """
+    Returns the entries of ``handler.fields`` that are named in the
+    ``fields`` URL parameter, in their order, and stores them in
+    ``request.fieldset``. Returns ``None`` without the parameter.
+
+    Raises ``InvalidFieldset`` if the parameter names an unknown field.
+    """
+    request.fieldset = None
+    if not 'fields' in request.GET:
+        return None
+
+    names = set([name.strip() for name in request.GET['fields'].split(',')
+                 if name.strip()])
+    known = set([field_name(field) for field in handler.fields])
+    if not names or names - known:
+        raise InvalidFieldset('unknown fields: %s'
+                              % ', '.join(sorted(names - known)))
+
+    request.fieldset = tuple([field for field in handler.fields
+                              if field_name(field) in names])
+    return request.fieldset
+
+
+def is_selected(fieldset, name):
+    """
+    Returns true, if the field ``name`` is in ``fieldset`` (all fields are,
+    if it's ``None``).
+    """
+    if fieldset is None:
+        return True
+    return name in [field_name(field) for field in fieldset]
+
+
+def selected(fieldset, *names):
+    """
+    Returns the ``names`` that are in ``fieldset``, e.g. for the related
+    objects to load.
+    """
+    return [name for name in names if is_selected(fieldset, name)]
+
+
+def narrow(queryset, fieldset, *required):
+    """
+    Restricts ``queryset`` to the columns of the fields in ``fieldset`` and
+    the ``required`` ones. ``required`` may name columns of objects that are
+    read with ``select_related``, e.g. ``dragable__team``.
+    """
+    if fieldset is None:
+        return queryset
+
+    opts = queryset.model._meta
+    columns = list(required)
+    for field in fieldset:
+        name = field_name(field)
+        try:
+            model_field = opts.get_field(name)
+        except FieldDoesNotExist:
+            # not a column, e.g. ``members``
+            continue
+        if model_field.rel is None or isinstance(model_field, ForeignKey):
+            columns.append(name)
+
+    return queryset.only(*columns)
+
@@ -2,15 +2,243 @@
 These classes implement the Minddrag API.
 """
 
+from datetime import datetime
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.http import HttpResponse
+from django.utils.functional import curry
 from piston.handler import AnonymousBaseHandler
 from piston.handler import BaseHandler
 from piston.utils import rc
 
+from api.conditional import all_teams
+from api.conditional import conditional
+from api.conditional import member_teams
+from api.fieldsets import InvalidFieldset
+from api.fieldsets import is_selected
+from api.fieldsets import narrow
+from api.fieldsets import select_fields
+from api.fieldsets import selected
+from api.pagination import InvalidPageParameter
+from api.pagination import decode_sync_cursor
+from api.pagination import decode_sync_token
+from api.pagination import encode_sync_cursor
+from api.pagination import encode_sync_token
+from api.pagination import get_limit
+from api.pagination import paginate
+from api.pagination import paginate_search
+from api.pagination import updated_after
+from api.prefetch import load_members
+from api.prefetch import load_related
+from api.prefetch import team_members
+from api.visibility import team_filter
+from api.visibility import visible_annotations
+from api.visibility import visible_dragables
+from api.visibility import visible_team_ids
+from core import metrics
+from core import writebehind
+from core.bulk import insert_instances
+from core.bulk import update_instances
+from core.graph import get_team_graph
+from core.graph import neighbourhood
 from core.models import Team
 from core.models import Dragable
 from core.models import Annotation
+from core.models import ApiToken
+from core.sync import changes_since
+from core.sync import is_expired
+from core.tokens import issue_token
+
+# required and optional fields of the annotation types for creates
+ANNOTATION_CREATE_FIELDS = {
+    'note': (('note',), ()),
+    'url': (('url',), ('description',)),
+    'image': (('url',), ('description',)),
+    'video': (('url',), ('description',)),
+    'file': (('url',), ('description',)),
+    'connection': (('connected_to',), ()),
+}
+
+# required and optional fields of the annotation types for updates
+ANNOTATION_UPDATE_FIELDS = {
+    'note': (('note',), []),
+    'url': (('url',), ('description',)),
+    'image': (('url',), ('description',)),
+    'video': (('url',), ('description',)),
+    'file': (('filename',), []),
+    'connection':  (('connected_to',), []),
+}
+
+
+def multi_get(request, key, name, queryset, is_visible=None, prepare=None):
+    """
+    Looks up all objects whose ``key`` field is in the comma separated list
+    of the URL parameter ``key`` with one query. Returns the status of every
+    requested object (``found``, ``forbidden`` or ``missing``) and the object
+    itself under ``name``, if it was found and ``is_visible`` accepts it.
+
+    ``prepare`` is called with the list of returned objects, to load what
+    their serialization needs.
+    """
+    values = []
+    for value in request.GET[key].split(','):
+        if value and value not in values:
+            values.append(value)
+
+    if not values or len(values) > getattr(settings,
+                                           'API_BULK_MAX_ITEMS',
+                                           100):
+        return rc.BAD_REQUEST
+
+    objects = dict([(getattr(obj, key), obj) for obj in
+                    queryset.filter(**{'%s__in' % key: values})])
+    results = []
+
+    for value in values:
+        obj = objects.get(value)
+
+        if obj is None:
+            results.append({key: value, 'status': 'missing'})
+        elif is_visible and not is_visible(obj):
+            results.append({key: value, 'status': 'forbidden'})
+        else:
+            results.append({key: value, 'status': 'found', name: obj})
+
+    if prepare:
+        prepare([result[name] for result in results if name in result])
+
+    return results
 
-class AnonymousTeamHandler(AnonymousBaseHandler):
+
+def save_created(instance):
+    """
+    Saves the new ``instance``, through the write-behind buffer if it's
+    enabled (see ``core.writebehind``), and returns the response.
+    """
+    try:
+        if not writebehind.save(instance):
+            return rc.BAD_REQUEST
+    except writebehind.BufferFull:
+        return rc.THROTTLED
+    except writebehind.StillWriting:
+        return HttpResponse(status=202)
+    return rc.CREATED
+
+
+def get_dragable(hash):
+    """
+    Returns the dragable with ``hash``, also if it's still in the write-behind
+    buffer.
+    """
+    dragable = writebehind.pending(Dragable, hash)
+    if dragable is None:
+        dragable = Dragable.objects.get(hash=hash)
+    return dragable
+
+
+def new_sync_token():
+    """
+    Returns the sync token for the data read from now on. It points a little
+    into the past (``SYNC_TOKEN_OVERLAP`` seconds), so that writes which
+    were still being committed aren't missed by the next sync.
+    """
+    overlap = getattr(settings, 'SYNC_TOKEN_OVERLAP', 2)
+    return encode_sync_token(datetime.now() - timedelta(seconds=overlap))
+
+
+def sync(request, model, queryset, prepare, team_ids=None,
+         dragable_ids=None):
+    """
+    Returns the instances of ``model`` in ``queryset`` that were created or
+    updated after the time in the ``since`` token, the hashes of the deleted
+    ones and a new token. ``prepare`` is called with the list of changed
+    instances.
+
+    The changed instances come in pages of ``limit`` in ``(updated, id)``
+    order. If ``has_more`` is true, the client gets the next page with the
+    same ``since`` token and the returned ``cursor``, and uses the new token
+    after the last page. The deleted hashes are part of the first page.
+
+    ``team_ids`` (the visible teams by default) and ``dragable_ids`` restrict
+    the deleted objects like ``queryset`` restricts the changed ones.
+    """
+    try:
+        since = decode_sync_token(request.GET['since'])
+        if 'cursor' in request.GET:
+            until, position = decode_sync_cursor(request.GET['cursor'])
+        else:
+            until, position = None, None
+        limit = get_limit(request)
+    except InvalidPageParameter:
+        return rc.BAD_REQUEST
+
+    if is_expired(since):
+        # deletions might have been forgotten, the client has to start over
+        return rc.NOT_HERE
+
+    if until is None:
+        request.sync_token = new_sync_token()
+    else:
+        # the token of the first page, later pages mustn't skip the writes
+        # that happened while the client was paging
+        request.sync_token = encode_sync_token(until)
+
+    if team_ids is None:
+        team_ids = team_filter(request)
+    changed, deleted = changes_since(model,
+                                     since,
+                                     team_ids,
+                                     queryset,
+                                     dragable_ids)
+    if position is not None:
+        changed = updated_after(changed, *position)
+        deleted = []
+    else:
+        deleted = list(deleted)
+
+    # fetch one extra row to find out whether there is a next page
+    changed = list(changed[:limit + 1])
+    request.next_cursor = None
+    if len(changed) > limit:
+        changed = changed[:limit]
+        request.next_cursor = encode_sync_cursor(
+                                    decode_sync_token(request.sync_token),
+                                    changed[-1])
+    prepare(changed)
+
+    return {
+        'token': request.sync_token,
+        'changed': changed,
+        'deleted': deleted,
+        'has_more': request.next_cursor is not None,
+        'cursor': request.next_cursor,
+    }
+
+
+class TeamFieldsMixin(object):
+    """
+    Serializes the members of a team from the members loaded by ``prepare``.
+    """
+
+    @classmethod
+    def members(cls, team):
+        return [{'username': user.username} for user in team_members(team)]
+
+
+    def prepare(self, teams, fields=None):
+        """
+        Loads the creators and members of ``teams`` before they are
+        serialized, as far as they are in the sparse fieldset ``fields``.
+        """
+        load_related(teams, *selected(fields, 'created_by'))
+        if is_selected(fields, 'members'):
+            load_members(teams)
+
+
+class AnonymousTeamHandler(TeamFieldsMixin, AnonymousBaseHandler):
     allowed_methods = ('GET',)
     model = Team
     fields = (
@@ -19,22 +247,43 @@ class AnonymousTeamHandler(AnonymousBaseHandler):
         'public',
         'created',
         ('created_by', ('username',)),
-        ('members', ('username',)),
+        'members',
     )
     exclude = ('password',)
 
+    @conditional(all_teams)
     def read(self, request, name=None):
-        teams = Team.objects.all()
+        try:
+            fieldset = select_fields(request, self)
+        except InvalidFieldset:
+            return rc.BAD_REQUEST
+        teams = narrow(Team.objects.all(), fieldset, 'name', 'created')
 
         if name:
-            teams = teams.filter(name=name)
-            if not teams.count():
+            teams = list(teams.filter(name=name))
+            if not teams:
                 return rc.NOT_FOUND
+            return teams
+
+        if 'name' in request.GET:
+            return multi_get(request,
+                             'name',
+                             'team',
+                             teams,
+                             prepare=curry(self.prepare, fields=fieldset))
+
+        if 'search' in request.GET:
+            terms = request.GET['search']
+            teams = teams.filter(Q(name__icontains=terms) |
+                                 Q(description__icontains=terms))
 
-        return teams
+        try:
+            return paginate(request, teams)
+        except InvalidPageParameter:
+            return rc.BAD_REQUEST
 
 
-class TeamHandler(BaseHandler):
+class TeamHandler(TeamFieldsMixin, BaseHandler):
     allowed_methods = ('GET', 'POST', 'PUT', 'DELETE')
     model = Team
     anonymous = AnonymousTeamHandler
@@ -44,38 +293,60 @@ class TeamHandler(BaseHandler):
         'public',
         'created',
         ('created_by', ('username',)),
-        ('members', ('username',)),
+        'members',
     )
     exclude = ('password',)
 
+    @conditional(all_teams)
     def read(self, request, name=None):
-        teams = Team.objects.all()
+        try:
+            fieldset = select_fields(request, self)
+        except InvalidFieldset:
+            return rc.BAD_REQUEST
+        teams = narrow(Team.objects.all(), fieldset, 'name', 'created')
 
         if name:
-            teams = teams.filter(name=name)
-            if not teams.count():
+            teams = list(teams.filter(name=name))
+            if not teams:
                 return rc.NOT_FOUND
+            return teams
+
+        if 'name' in request.GET:
+            return multi_get(request,
+                             'name',
+                             'team',
+                             teams,
+                             prepare=curry(self.prepare, fields=fieldset))
 
-        return teams
+        if 'search' in request.GET:
+            terms = request.GET['search']
+            teams = teams.filter(Q(name__icontains=terms) |
+                                 Q(description__icontains=terms))
+
+        try:
+            return paginate(request, teams)
+        except InvalidPageParameter:
+            return rc.BAD_REQUEST
 
 
     def create(self, request):
-        if not 'name' in request.POST:
+        params = body_params(request)
+        if params is None or not 'name' in params:
             return rc.BAD_REQUEST
 
-        if Team.objects.filter(name=request.POST['name']):
+        if Team.objects.filter(name=params['name']):
             return rc.DUPLICATE_ENTRY
 
         data = {}
-        data['name'] = request.POST['name']
+        data['name'] = params['name']
         data['created_by'] = request.user
 
-        if 'description' in request.POST:
-            data['description'] = request.POST['description']
+        if 'description' in params:
+            data['description'] = params['description']
 
-        if 'password' in request.POST and request.POST['password'].strip():
+        if 'password' in params and params['password'].strip():
             data['public'] = False
-            data['password'] = request.POST['password']
+            data['password'] = params['password']
 
         team = Team(**data)
         team.save()
@@ -91,15 +362,19 @@ class TeamHandler(BaseHandler):
         if team.created_by != request.user:
             return rc.FORBIDDEN
 
-        if 'name' in request.PUT:
-            team.name = request.PUT['name']
+        params = body_params(request)
+        if params is None:
+            return rc.BAD_REQUEST
+
+        if 'name' in params:
+            team.name = params['name']
 
-        if 'description' in request.PUT:
-            team.description = request.PUT['description']
+        if 'description' in params:
+            team.description = params['description']
 
-        if 'password' in request.PUT and request.PUT['password'].strip():
+        if 'password' in params and params['password'].strip():
             team.public = False
-            team.password = request.PUT['password']
+            team.password = params['password']
 
         team.save()
         return rc.ALL_OK
@@ -118,6 +393,29 @@ class TeamHandler(BaseHandler):
         return rc.DELETED
 
 
+class TeamGraphHandler(BaseHandler):
+    """
+    The dragables of a team and the connections between them, for drawing
+    the whole mindmap with one request.
+    """
+    allowed_methods = ('GET',)
+
+    @conditional(member_teams)
+    def read(self, request, name):
+        try:
+            team_id = Team.objects.filter(name=name).values_list('pk',
+                                                                 flat=True)[0]
+        except IndexError:
+            return rc.NOT_FOUND
+
+        if not team_id in visible_team_ids(request):
+            return rc.FORBIDDEN
+
+        graph = dict(get_team_graph(team_id))
+        graph['team'] = name
+        return graph
+
+
 class DragableHandler(BaseHandler):
     allowed_methods = ('GET', 'POST', 'PUT', 'DELETE')
     model = Dragable
@@ -134,39 +432,106 @@ class DragableHandler(BaseHandler):
         ('connected_to', ('hash',)),
     )
 
+    @conditional(member_teams)
     def read(self, request, hash=None):
-        username = request.user.username
+        try:
+            fieldset = select_fields(request, self)
+        except InvalidFieldset:
+            return rc.BAD_REQUEST
+        prepare = curry(self.prepare, fields=fieldset)
 
         if hash:
-            dragables = Dragable.objects.filter(hash=hash)
-            if not dragables.count():
+            # one query, membership is checked with the cached team ids
+            dragables = list(narrow(Dragable.objects.filter(hash=hash),
+                                    fieldset,
+                                    'hash',
+                                    'created',
+                                    'team'))
+            if not dragables:
                 return rc.NOT_FOUND
-            else:
-                dragables = dragables.filter(team__members__username=username)
-                if not dragables.count():
-                    return rc.FORBIDDEN
+            if dragables[0].team_id not in visible_team_ids(request):
+                return rc.FORBIDDEN
         else:
-            dragables = Dragable.objects.filter(
-                                            team__members__username=username)
+            if 'hash' in request.GET:
+                team_ids = visible_team_ids(request)
+                return multi_get(request,
+                                 'hash',
+                                 'dragable',
+                                 narrow(Dragable.objects.all(),
+                                        fieldset,
+                                        'hash',
+                                        'created',
+                                        'team'),
+                                 lambda d: d.team_id in team_ids,
+                                 prepare)
+
+            if 'search' in request.GET:
+                return self._search(request)
+
             # handle optional URL parameters that must be used without 'hash'
             if 'team' in request.GET:
-                dragables = dragables.filter(team__name=request.GET['team'])
-                if not dragables.count():
+                team_ids = list(Team.objects.filter(
+                                    name=request.GET['team']
+                                ).values_list('pk', flat=True))
+                if not team_ids or team_ids[0] not in visible_team_ids(
+                                                                    request):
                     return rc.FORBIDDEN
-        
+                dragables = Dragable.objects.filter(team=team_ids[0])
+            else:
+                team_ids = None
+                dragables = visible_dragables(request)
+            dragables = narrow(dragables, fieldset, 'hash', 'created')
+
+            if 'since' in request.GET:
+                return sync(request, Dragable, dragables, prepare, team_ids)
+
+            request.sync_token = new_sync_token()
+            try:
+                return paginate(request, dragables)
+            except InvalidPageParameter:
+                return rc.BAD_REQUEST
+
         return dragables
 
 
+    def _search(self, request):
+        team_ids = visible_team_ids(request)
+
+        if 'team' in request.GET:
+            team_ids = Team.objects.filter(pk__in=team_ids,
+                                           name=request.GET['team'])
+            team_ids = list(team_ids.values_list('pk', flat=True))
+            if not team_ids:
+                return rc.FORBIDDEN
+
+        try:
+            return paginate_search(request, Dragable, team_ids)
+        except InvalidPageParameter:
+            return rc.BAD_REQUEST
+
+
+    def prepare(self, dragables, fields=None):
+        """
+        Loads the related objects of ``dragables`` in the sparse fieldset
+        ``fields`` before they are serialized.
+        """
+        load_related(dragables,
+                     *selected(fields, 'created_by', 'team', 'connected_to'))
+
+
     def create(self, request):
         required_fields = ('hash', 'url', 'xpath')
         optional_fields = ('title', 'text', 'connected_to')
+        params = body_params(request)
+        if params is None:
+            return rc.BAD_REQUEST
 
         for field in required_fields + ('team',):
-            if field not in request.POST.keys():
+            if field not in params:
                 return rc.BAD_REQUEST # FIXME proper error msg?
 
         try:
-            team = Team.objects.get(name=request.POST['team'])
+            team = Team.objects.get(name=params['team'])
         except:
             return rc.BAD_REQUEST     # FIXME proper error msg?
 
@@ -178,14 +543,13 @@ class DragableHandler(BaseHandler):
         dragable.team = team
 
         for field in required_fields:
-            setattr(dragable, field, request.POST[field])
+            setattr(dragable, field, params[field])
 
         for field in optional_fields:
-            if field in request.POST:
-                setattr(dragable, field, request.POST[field])
+            if field in params:
+                setattr(dragable, field, params[field])
 
-        dragable.save()
-        return rc.CREATED
+        return save_created(dragable)
 
 
     def update(self, request, hash):
@@ -197,17 +561,21 @@ class DragableHandler(BaseHandler):
         if not dragable.can_modify(request.user):
             return rc.FORBIDDEN
 
-        if 'team' in request.PUT:
+        params = body_params(request)
+        if params is None:
+            return rc.BAD_REQUEST
+
+        if 'team' in params:
             try:
-                team = Team.objects.get(name=request.PUT['team'])
+                team = Team.objects.get(name=params['team'])
                 if not team.is_member(request.user):
                     return rc.FORBIDDEN
             except:
                 return rc.BAD_REQUEST
             dragable.team = team
 
-        if 'connected_to' in request.PUT:
-            connected_to_hash = request.PUT['connected_to']
+        if 'connected_to' in params:
+            connected_to_hash = params['connected_to']
             try:
                 connected_to = Dragable.objects.get(hash=connected_to_hash)
                 assert dragable.team == connected_to.team # FIXME do we want to enforce this?
@@ -216,8 +584,8 @@ class DragableHandler(BaseHandler):
             dragable.connected_to = connected_to
 
         for field in ('url', 'xpath', 'title', 'text'):
-            if field in request.PUT:
-                setattr(dragable, field, request.PUT[field])
+            if field in params:
+                setattr(dragable, field, params[field])
         dragable.save()
         return rc.ALL_OK
 
@@ -235,6 +603,53 @@ class DragableHandler(BaseHandler):
         return rc.DELETED
 
 
+class NeighbourhoodHandler(BaseHandler):
+    """
+    The dragables around one dragable and the connections between them.
+    """
+    allowed_methods = ('GET',)
+
+    @conditional(member_teams)
+    def read(self, request, hash):
+        try:
+            depth = self._get_int(request, 'depth', 'API_GRAPH_DEPTH', 2,
+                                  'API_GRAPH_MAX_DEPTH', 5)
+            limit = self._get_int(request, 'limit', 'API_GRAPH_NODES', 100,
+                                  'API_GRAPH_MAX_NODES', 500)
+        except ValueError:
+            return rc.BAD_REQUEST
+
+        try:
+            dragable = Dragable.objects.get(hash=hash)
+        except Dragable.DoesNotExist:
+            return rc.NOT_FOUND
+
+        if not dragable.team_id in visible_team_ids(request):
+            return rc.FORBIDDEN
+
+        graph = neighbourhood(dragable, depth, limit)
+        graph['hash'] = hash
+        graph['depth'] = depth
+        return graph
+
+
+    def _get_int(self, request, name, default_setting, default,
+                 maximum_setting, maximum):
+        """
+        Returns the URL parameter ``name`` as an int, capped at the value of
+        the setting ``maximum_setting``. Raises ``ValueError`` if it is
+        malformed or negative.
+        """
+        value = int(request.GET.get(name,
+                                    getattr(settings,
+                                            default_setting,
+                                            default)))
+        if value < 0:
+            raise ValueError('%s must not be negative' % name)
+
+        return min(value, getattr(settings, maximum_setting, maximum))
+
+
 class AnnotationHandler(BaseHandler):
     allowed_methods = ('GET', 'POST', 'PUT', 'DELETE')
     model = Annotation
@@ -248,44 +663,109 @@ class AnnotationHandler(BaseHandler):
         'note',
         'url',
         'description',
-        ('connected_dragable', 'hash'),
+        ('connected_dragable', ('hash',)),
     )
     exclude = ('filename',)
 
 
+    @conditional(member_teams)
     def read(self, request, hash=None):
-        username = request.user.username
+        try:
+            fieldset = select_fields(request, self)
+        except InvalidFieldset:
+            return rc.BAD_REQUEST
+        prepare = curry(self.prepare, fields=fieldset)
+        # the dragables are joined for the membership check
+        with_dragables = narrow(Annotation.objects.select_related('dragable'),
+                                fieldset,
+                                'hash',
+                                'created',
+                                'dragable__team',
+                                'dragable__hash')
 
         if hash:
-            annotations = Annotation.objects.filter(hash=hash)
+            # one query, membership is checked with the cached team ids; one
+            # row, so it needs no order
+            annotations = list(with_dragables.filter(hash=hash).order_by())
 
-            if not annotations.count():
+            if not annotations:
                 return rc.NOT_FOUND
 
-            if not annotations[0].dragable.team.is_member(request.user):
+            if annotations[0].dragable.team_id not in visible_team_ids(
+                                                                    request):
                 return rc.FORBIDDEN
         else:
-            annotations = Annotation.objects.filter(
-                            dragable__team__members__username=username)
+            if 'hash' in request.GET:
+                team_ids = visible_team_ids(request)
+                return multi_get(request,
+                                 'hash',
+                                 'annotation',
+                                 with_dragables,
+                                 lambda a: a.dragable.team_id in team_ids,
+                                 prepare)
+
+            if 'search' in request.GET:
+                try:
+                    return paginate_search(request,
+                                           Annotation,
+                                           visible_team_ids(request))
+                except InvalidPageParameter:
+                    return rc.BAD_REQUEST
+
+            annotations = narrow(visible_annotations(request),
+                                 fieldset,
+                                 'hash',
+                                 'created')
 
             if 'dragable' in request.GET:
-                dragable_hash = request.GET['dragable']
+                dragable_ids = list(Dragable.objects.filter(
+                                        hash=request.GET['dragable']
+                                    ).values_list('pk', flat=True))
 
-                if not Dragable.objects.filter(hash=dragable_hash).count():
+                if not dragable_ids:
                     return rc.BAD_REQUEST
 
-                annotations = annotations.filter(dragable__hash=dragable_hash)
+                annotations = annotations.filter(dragable__in=dragable_ids)
+            else:
+                dragable_ids = None
+
+            if 'since' in request.GET:
+                return sync(request,
+                            Annotation,
+                            annotations,
+                            prepare,
+                            dragable_ids=dragable_ids)
+
+            request.sync_token = new_sync_token()
+            try:
+                return paginate(request, annotations)
+            except InvalidPageParameter:
+                return rc.BAD_REQUEST
 
         return annotations
 
 
+    def prepare(self, annotations, fields=None):
+        """
+        Loads the related objects of ``annotations`` in the sparse fieldset
+        ``fields`` before they are serialized.
+        """
+        load_related(annotations,
+                     *selected(fields, 'dragable', 'created_by',
+                               'connected_dragable'))
+
+
     def create(self, request):
         required_fields = ('hash', 'dragable', 'type')
+        params = body_params(request)
+        if params is None:
+            return rc.BAD_REQUEST
+
         for field in required_fields:
-            if field not in request.POST:
+            if field not in params:
                 return rc.BAD_REQUEST
 
-        type = request.POST['type']
+        type = params['type']
         if type == 'note':
             return self._create_note_annotation(request)
         elif type == 'url':
@@ -308,17 +788,10 @@ class AnnotationHandler(BaseHandler):
         except:
             return rc.NOT_FOUND
 
-        if not annotation.dragable.team.is_member(request.user):
+        if annotation.dragable.team_id not in visible_team_ids(request):
             return rc.FORBIDDEN
 
-        fields = {
-            'note': (('note',), []),
-            'url': (('url',), ('description',)),
-            'image': (('url',), ('description',)),
-            'video': (('url',), ('description',)),
-            'file': (('filename',), []),
-            'connection':  (('connected_to',), []),
-        }[annotation.type]
+        fields = ANNOTATION_UPDATE_FIELDS[annotation.type]
 
         return self._update_annotation(annotation, request, *fields)
 
@@ -329,7 +802,7 @@ class AnnotationHandler(BaseHandler):
         except:
             return rc.NOT_FOUND
 
-        if not annotation.dragable.team.is_member(request.user):
+        if annotation.dragable.team_id not in visible_team_ids(request):
             return rc.FORBIDDEN
 
         annotation.delete()
@@ -337,7 +810,7 @@ class AnnotationHandler(BaseHandler):
 
 
     def _create_note_annotation(self, request):
-        qdict = request.POST
+        qdict = body_params(request)
 
         if (Annotation.objects.filter(hash=qdict['hash']).count()):
             return rc.BAD_REQUEST
@@ -345,15 +818,13 @@ class AnnotationHandler(BaseHandler):
         try:
             annotation = self._create_with_common_fields(request)
             annotation.note = qdict['note']
-            annotation.save()
+            return save_created(annotation)
         except:
             return rc.BAD_REQUEST
 
-        return rc.CREATED
-
 
     def _create_url_annotation(self, request):
-        qdict = request.POST
+        qdict = body_params(request)
 
         if (Annotation.objects.filter(hash=qdict['hash']).count()):
             return rc.BAD_REQUEST
@@ -363,12 +834,10 @@ class AnnotationHandler(BaseHandler):
             annotation.url = qdict['url']
             if 'description' in qdict:
                 annotation.description = qdict['description']
-            annotation.save()
+            return save_created(annotation)
         except:
             return rc.BAD_REQUEST
 
-        return rc.CREATED
-
 
     def _create_image_annotation(self, request):
         # for now, the same as url annotation
@@ -386,7 +855,7 @@ class AnnotationHandler(BaseHandler):
 
 
     def _create_connection_annotation(self, request):
-        qdict = request.POST
+        qdict = body_params(request)
         if (qdict['dragable'] == qdict['connected_to']):
             return rc.BAD_REQUEST
 
@@ -395,18 +864,16 @@ class AnnotationHandler(BaseHandler):
 
         try:
             annotation = self._create_with_common_fields(request)
-            connected_to = Dragable.objects.get(hash=qdict['connected_to'])
+            connected_to = get_dragable(qdict['connected_to'])
             annotation.connected_dragable = connected_to
-            annotation.save()
+            return save_created(annotation)
         except:
             return rc.BAD_REQUEST
 
-        return rc.CREATED
-
 
     def _create_with_common_fields(self, request):
-        qdict = request.POST
-        dragable = Dragable.objects.get(hash=qdict['dragable'])
+        qdict = body_params(request)
+        dragable = get_dragable(qdict['dragable'])
         annotation = Annotation()
         annotation.dragable = dragable
         annotation.created_by = request.user
@@ -422,7 +889,9 @@ class AnnotationHandler(BaseHandler):
                            request,
                            required_fields,
                            optional_fields):
-        qdict = request.PUT
+        qdict = body_params(request)
+        if qdict is None:
+            return rc.BAD_REQUEST
 
         for field in required_fields:
             if field not in qdict:
@@ -439,7 +908,7 @@ class AnnotationHandler(BaseHandler):
             except:
                 return rc.BAD_REQUEST
 
-            if not dragable.team.is_member(request.user):
+            if dragable.team_id not in visible_team_ids(request):
                 return rc.FORBIDDEN
 
             annotation.dragable = dragable
@@ -450,3 +919,515 @@ class AnnotationHandler(BaseHandler):
             return rc.BAD_REQUEST
         return rc.ALL_OK
 
+
+
+def body_params(request):
+    """
+    Returns the fields of the body of a single object request: the decoded
+    object of a JSON, YAML or MessagePack body (see ``api.emitters``), else
+    the form data.
+
+    The values are strings, like form data: numbers are converted, any other
+    value makes it return ``None``, as does a body that isn't an object.
+    """
+    if not hasattr(request, 'data'):
+        if request.method == 'PUT':
+            return request.PUT
+        return request.POST
+
+    if not isinstance(request.data, dict):
+        return None
+
+    params = {}
+    for name, value in request.data.items():
+        if isinstance(value, bool):
+            return None
+        if isinstance(value, (int, long, float)):
+            value = unicode(value)
+        if not isinstance(value, basestring):
+            return None
+        params[name] = value
+    return params
+
+
+def bulk_items(request):
+    """
+    Returns the list of objects in the JSON body of a bulk request, or
+    ``None`` if there is none or it is longer than ``API_BULK_MAX_ITEMS``.
+    """
+    items = getattr(request, 'data', None)
+
+    if not isinstance(items, list):
+        return None
+
+    if len(items) > getattr(settings, 'API_BULK_MAX_ITEMS', 100):
+        return None
+
+    for item in items:
+        if not isinstance(item, dict) or not item.get('hash'):
+            return None
+        for value in item.values():
+            if not isinstance(value, (basestring, int, long, float)):
+                return None
+
+    return items
+
+
+def split_param(request, name):
+    """
+    Returns the comma separated values of the URL parameter ``name``.
+    """
+    return [v for v in request.GET.get(name, '').split(',') if v]
+
+
+def item_status(hash, response):
+    """
+    Returns the status of one item of a bulk request, with the status code
+    of the ``rc`` response the single object request would have returned.
+    """
+    return {'hash': hash, 'status': response.status_code}
+
+
+class BulkDragableHandler(BaseHandler):
+    """
+    Creates, updates or deletes many dragables with one request. The request
+    is processed in one transaction, the response contains the status of
+    every item. Creates and updates take a constant number of queries,
+    deletes cascade to the annotations one object at a time.
+    """
+    allowed_methods = ('POST', 'PUT', 'DELETE')
+
+    @transaction.commit_on_success
+    def create(self, request):
+        items = bulk_items(request)
+        if items is None:
+            return rc.BAD_REQUEST
+
+        hashes = [item['hash'] for item in items]
+        existing = set(Dragable.objects.filter(
+                            hash__in=hashes).values_list('hash', flat=True))
+        teams = dict(Team.objects.filter(
+                            name__in=[item.get('team') for item in items]
+                        ).values_list('name', 'pk'))
+        connected = dict([(h, (pk, team_id)) for h, pk, team_id in
+                          Dragable.objects.filter(
+                            hash__in=[item.get('connected_to') for item in items]
+                          ).values_list('hash', 'pk', 'team')])
+        team_ids = visible_team_ids(request)
+
+        created = rc.CREATED
+        statuses = []
+        dragables = {}
+        linked = {}
+
+        for item in items:
+            hash = item['hash']
+            statuses.append((hash, created))
+
+            if [f for f in ('team', 'url', 'xpath') if not item.get(f)]:
+                statuses[-1] = (hash, rc.BAD_REQUEST)
+                continue
+
+            if hash in existing or hash in dragables:
+                statuses[-1] = (hash, rc.DUPLICATE_ENTRY)
+                continue
+
+            team_id = teams.get(item['team'])
+            if team_id is None:
+                statuses[-1] = (hash, rc.BAD_REQUEST)
+                continue
+
+            if team_id not in team_ids:
+                statuses[-1] = (hash, rc.FORBIDDEN)
+                continue
+
+            connected_to = item.get('connected_to')
+            target = connected.get(connected_to)
+            if connected_to and target is None:
+                if connected_to not in hashes:
+                    statuses[-1] = (hash, rc.BAD_REQUEST)
+                    continue
+                # connected to a dragable from this request, checked below
+                linked[hash] = connected_to
+            elif target is not None and target[1] != team_id:
+                statuses[-1] = (hash, rc.BAD_REQUEST)
+                continue
+
+            dragable = Dragable(hash=hash,
+                                team_id=team_id,
+                                created_by=request.user,
+                                connected_to_id=target and target[0])
+            for field in ('url', 'xpath', 'title', 'text'):
+                if field in item:
+                    setattr(dragable, field, item[field])
+            dragables[hash] = dragable
+
+        # dragables connected to a dragable of this request that isn't
+        # created (or is in another team) fail as well, which can make
+        # further ones fail
+        failed = True
+        while failed:
+            failed = False
+            for hash, connected_to in linked.items():
+                target = dragables.get(connected_to)
+                if (target is None or
+                    target.team_id != dragables[hash].team_id):
+                    del dragables[hash]
+                    del linked[hash]
+                    failed = True
+
+        results = []
+        for hash, status in statuses:
+            if status is created and hash not in dragables:
+                status = rc.BAD_REQUEST
+            results.append(item_status(hash, status))
+
+        insert_instances(Dragable, dragables.values())
+
+        links = []
+        for hash, connected_to in linked.items():
+            dragable = dragables[hash]
+            dragable.connected_to_id = dragables[connected_to].pk
+            links.append(dragable)
+        update_instances(Dragable, links, ['connected_to'])
+
+        return results
+
+
+    @transaction.commit_on_success
+    def update(self, request):
+        items = bulk_items(request)
+        if items is None:
+            return rc.BAD_REQUEST
+
+        dragables = dict([
+                (d.hash, d) for d in Dragable.objects.filter(
+                                hash__in=[item['hash'] for item in items])])
+        teams = dict(Team.objects.filter(
+                            name__in=[item.get('team') for item in items]
+                        ).values_list('name', 'pk'))
+        connected = dict([(h, (pk, team_id)) for h, pk, team_id in
+                          Dragable.objects.filter(
+                            hash__in=[item.get('connected_to') for item in items]
+                          ).values_list('hash', 'pk', 'team')])
+        team_ids = visible_team_ids(request)
+
+        results = []
+        changed = []
+        field_names = set()
+
+        for item in items:
+            hash = item['hash']
+            dragable = dragables.get(hash)
+
+            if dragable is None:
+                results.append(item_status(hash, rc.NOT_FOUND))
+                continue
+
+            if not dragable.can_modify(request.user):
+                results.append(item_status(hash, rc.FORBIDDEN))
+                continue
+
+            team_id = dragable.team_id
+            if 'team' in item:
+                team_id = teams.get(item['team'])
+                if team_id is None:
+                    results.append(item_status(hash, rc.BAD_REQUEST))
+                    continue
+                if team_id not in team_ids:
+                    results.append(item_status(hash, rc.FORBIDDEN))
+                    continue
+
+            if 'connected_to' in item:
+                target = connected.get(item['connected_to'])
+                if target is None or target[1] != team_id:
+                    results.append(item_status(hash, rc.BAD_REQUEST))
+                    continue
+                dragable.connected_to_id = target[0]
+                field_names.add('connected_to')
+
+            dragable.team_id = team_id
+            field_names.add('team')
+
+            for field in ('url', 'xpath', 'title', 'text'):
+                if field in item:
+                    setattr(dragable, field, item[field])
+                    field_names.add(field)
+
+            changed.append(dragable)
+            results.append(item_status(hash, rc.ALL_OK))
+
+        update_instances(Dragable, changed, field_names)
+        return results
+
+
+    @transaction.commit_on_success
+    def delete(self, request):
+        hashes = split_param(request, 'hash')
+        if not hashes:
+            return rc.BAD_REQUEST
+
+        dragables = dict([(d.hash, d) for d in
+                          Dragable.objects.filter(hash__in=hashes)])
+        results = []
+        deletable = []
+
+        for hash in hashes:
+            dragable = dragables.get(hash)
+
+            if dragable is None:
+                results.append(item_status(hash, rc.NOT_FOUND))
+            elif not dragable.can_modify(request.user):
+                results.append(item_status(hash, rc.FORBIDDEN))
+            else:
+                deletable.append(dragable.pk)
+                results.append(item_status(hash, rc.DELETED))
+
+        if deletable:
+            Dragable.objects.filter(pk__in=deletable).delete()
+
+        return results
+
+
+class BulkAnnotationHandler(BaseHandler):
+    """
+    Creates, updates or deletes many annotations with one request. The
+    request is processed in one transaction, the response contains the
+    status of every item. Creates and updates take a constant number of
+    queries, deletes one per annotation.
+    """
+    allowed_methods = ('POST', 'PUT', 'DELETE')
+
+    @transaction.commit_on_success
+    def create(self, request):
+        items = bulk_items(request)
+        if items is None:
+            return rc.BAD_REQUEST
+
+        existing = set(Annotation.objects.filter(
+                            hash__in=[item['hash'] for item in items]
+                        ).values_list('hash', flat=True))
+        dragable_hashes = set()
+        for item in items:
+            dragable_hashes.add(item.get('dragable'))
+            dragable_hashes.add(item.get('connected_to'))
+        dragables = dict([(h, (pk, team_id)) for h, pk, team_id in
+                          Dragable.objects.filter(
+                                hash__in=dragable_hashes
+                          ).values_list('hash', 'pk', 'team')])
+        team_ids = visible_team_ids(request)
+
+        results = []
+        annotations = {}
+
+        for item in items:
+            hash = item['hash']
+            type = item.get('type')
+
+            if type not in ANNOTATION_CREATE_FIELDS:
+                results.append(item_status(hash, rc.BAD_REQUEST))
+                continue
+
+            required, optional = ANNOTATION_CREATE_FIELDS[type]
+            if [f for f in required if not item.get(f)]:
+                results.append(item_status(hash, rc.BAD_REQUEST))
+                continue
+
+            if hash in existing or hash in annotations:
+                results.append(item_status(hash, rc.DUPLICATE_ENTRY))
+                continue
+
+            dragable = dragables.get(item.get('dragable'))
+            if dragable is None:
+                results.append(item_status(hash, rc.BAD_REQUEST))
+                continue
+
+            if dragable[1] not in team_ids:
+                results.append(item_status(hash, rc.FORBIDDEN))
+                continue
+
+            annotation = Annotation(hash=hash,
+                                    type=type,
+                                    dragable_id=dragable[0],
+                                    created_by=request.user)
+
+            if type == 'connection':
+                connected_to = dragables.get(item['connected_to'])
+                if (connected_to is None or
+                    item['connected_to'] == item['dragable']):
+                    results.append(item_status(hash, rc.BAD_REQUEST))
+                    continue
+                annotation.connected_dragable_id = connected_to[0]
+            else:
+                for field in required + optional:
+                    if field in item:
+                        setattr(annotation, field, item[field])
+
+            annotations[hash] = annotation
+            results.append(item_status(hash, rc.CREATED))
+
+        insert_instances(Annotation, annotations.values())
+        return results
+
+
+    @transaction.commit_on_success
+    def update(self, request):
+        items = bulk_items(request)
+        if items is None:
+            return rc.BAD_REQUEST
+
+        annotations = dict([(a.hash, a) for a in
+                            Annotation.objects.select_related('dragable').filter(
+                                hash__in=[item['hash'] for item in items])])
+        dragable_hashes = set()
+        for item in items:
+            dragable_hashes.add(item.get('dragable'))
+            dragable_hashes.add(item.get('connected_to'))
+        dragables = dict([(h, (pk, team_id)) for h, pk, team_id in
+                          Dragable.objects.filter(
+                                hash__in=dragable_hashes
+                          ).values_list('hash', 'pk', 'team')])
+        team_ids = visible_team_ids(request)
+
+        results = []
+        changed = []
+        field_names = set()
+
+        for item in items:
+            hash = item['hash']
+            annotation = annotations.get(hash)
+
+            if annotation is None:
+                results.append(item_status(hash, rc.NOT_FOUND))
+                continue
+
+            if annotation.dragable.team_id not in team_ids:
+                results.append(item_status(hash, rc.FORBIDDEN))
+                continue
+
+            required, optional = ANNOTATION_UPDATE_FIELDS[annotation.type]
+            if [f for f in required if f not in item]:
+                results.append(item_status(hash, rc.BAD_REQUEST))
+                continue
+
+            if 'dragable' in item:
+                dragable = dragables.get(item['dragable'])
+                if dragable is None:
+                    results.append(item_status(hash, rc.BAD_REQUEST))
+                    continue
+                if dragable[1] not in team_ids:
+                    results.append(item_status(hash, rc.FORBIDDEN))
+                    continue
+                annotation.dragable_id = dragable[0]
+                field_names.add('dragable')
+
+            if annotation.type == 'connection':
+                connected_to = dragables.get(item['connected_to'])
+                if connected_to is None:
+                    results.append(item_status(hash, rc.BAD_REQUEST))
+                    continue
+                annotation.connected_dragable_id = connected_to[0]
+                field_names.add('connected_dragable')
+            else:
+                for field in tuple(required) + tuple(optional):
+                    if field in item:
+                        setattr(annotation, field, item[field])
+                        field_names.add(field)
+
+            changed.append(annotation)
+            results.append(item_status(hash, rc.ALL_OK))
+
+        update_instances(Annotation, changed, field_names)
+        return results
+
+
+    @transaction.commit_on_success
+    def delete(self, request):
+        hashes = split_param(request, 'hash')
+        if not hashes:
+            return rc.BAD_REQUEST
+
+        annotations = dict([(h, (pk, team_id)) for h, pk, team_id in
+                            Annotation.objects.filter(
+                                hash__in=hashes
+                            ).values_list('hash', 'pk', 'dragable__team')])
+        team_ids = visible_team_ids(request)
+        results = []
+        deletable = []
+
+        for hash in hashes:
+            annotation = annotations.get(hash)
+
+            if annotation is None:
+                results.append(item_status(hash, rc.NOT_FOUND))
+            elif annotation[1] not in team_ids:
+                results.append(item_status(hash, rc.FORBIDDEN))
+            else:
+                deletable.append(annotation[0])
+                results.append(item_status(hash, rc.DELETED))
+
+        if deletable:
+            Annotation.objects.filter(pk__in=deletable).delete()
+
+        return results
+
+
+class TokenHandler(BaseHandler):
+    """
+    Issues, lists and revokes the API tokens of the authenticated user.
+    """
+    allowed_methods = ('GET', 'POST', 'DELETE')
+    model = ApiToken
+    fields = ('id', 'name', 'created')
+
+    def read(self, request):
+        # in the order of creation, along the index of the user
+        return ApiToken.objects.filter(user=request.user).order_by('pk')
+
+
+    def create(self, request):
+        # tokens are issued for username and password only, so a stolen
+        # token can't be used to get more of them
+        if getattr(request, 'auth_method', None) != 'basic':
+            return rc.FORBIDDEN
+
+        params = body_params(request)
+        if params is None:
+            return rc.BAD_REQUEST
+
+        token, api_token = issue_token(request.user, params.get('name', ''))
+        return {
+            'id': api_token.pk,
+            'name': api_token.name,
+            'created': api_token.created,
+            'token': token,
+        }
+
+
+    def delete(self, request, id):
+        try:
+            api_token = ApiToken.objects.get(pk=id, user=request.user)
+        except (ApiToken.DoesNotExist, ValueError):
+            return rc.NOT_FOUND
+
+        api_token.delete()
+        return rc.DELETED
+
+
+class MetricsHandler(BaseHandler):
+    """
+    The request metrics of this process (see ``core.metrics``), for staff
+    only. ``exposition='prometheus'`` returns them in the text format of
+    Prometheus.
+    """
+    allowed_methods = ('GET',)
+
+    def read(self, request, exposition=None):
+        if not request.user.is_staff:
+            return rc.FORBIDDEN
+
+        if exposition == 'prometheus':
+            return HttpResponse(metrics.registry.as_prometheus(),
+                                mimetype='text/plain; version=0.0.4')
+
+        return metrics.registry.as_dict()
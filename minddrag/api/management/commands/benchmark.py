@@ -0,0 +1,105 @@
+"""
+Benchmarks the API handlers and views on synthetic data (see
+``api.benchmark``) and prints the results as JSON.
+
+The data is created in a test database, like ``manage.py test`` does, which
+is destroyed afterwards. Run it with a local cache backend (e.g.
+``locmem://``), the benchmark writes to the cache like the API does.
+"""
+
+from optparse import make_option
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import simplejson
+
+from api import benchmark
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the API handlers and views on synthetic data in a '
+            'test database and prints the results as JSON.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--users', type='int', default=1000,
+                    help='Number of users (default 1000).'),
+        make_option('--teams', type='int', default=100,
+                    help='Number of teams (default 100).'),
+        make_option('--members', type='int', default=200,
+                    help='Members per team (default 200).'),
+        make_option('--dragables', type='int', default=100000,
+                    help='Number of dragables (default 100000).'),
+        make_option('--chain-length', type='int', default=10,
+                    help='Dragables per chain of connected dragables '
+                         '(default 10).'),
+        make_option('--annotations', type='int', default=1,
+                    help='Annotations per dragable (default 1).'),
+        make_option('--requests', type='int', default=100,
+                    help='Requests per scenario (default 100).'),
+        make_option('--bulk-size', type='int', default=50,
+                    help='Objects per bulk request (default 50).'),
+        make_option('--only', default='',
+                    help='Comma separated prefixes of the scenarios to run, '
+                         'e.g. "DragableHandler.read,views".'),
+        make_option('--seed', type='int', default=0,
+                    help='Seed of the random data (default 0).'),
+        make_option('--output', default=None,
+                    help='Write the results to this file instead of stdout.'),
+        make_option('--noinput', action='store_false', dest='interactive',
+                    default=True,
+                    help='Do not ask before replacing an existing test '
+                         'database.'),
+    )
+
+    def handle(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        def log(message):
+            if verbosity:
+                sys.stderr.write('%s\n' % message)
+
+        old_names = []
+        for alias in connections:
+            connection = connections[alias]
+            old_names.append((connection, connection.settings_dict['NAME']))
+            connection.creation.create_test_db(
+                                    verbosity,
+                                    autoclobber=not options['interactive'])
+
+        try:
+            counts = benchmark.generate(users=options['users'],
+                                        teams=options['teams'],
+                                        members=options['members'],
+                                        dragables=options['dragables'],
+                                        chain_length=options['chain_length'],
+                                        annotations=options['annotations'],
+                                        seed=options['seed'],
+                                        log=log)
+            scenarios = benchmark.scenarios(counts,
+                                            bulk_size=options['bulk_size'],
+                                            seed=options['seed'])
+            only = [name for name in options['only'].split(',') if name]
+            results = {
+                'data': counts,
+                'scenarios': benchmark.run(scenarios,
+                                           options['requests'],
+                                           only,
+                                           log),
+                'database': settings.DATABASES['default']['ENGINE'],
+                'cache': settings.CACHE_BACKEND,
+            }
+        finally:
+            for connection, old_name in old_names:
+                connection.creation.destroy_test_db(old_name, verbosity)
+
+        output = simplejson.dumps(results, indent=4, sort_keys=True)
+        if options['output']:
+            out = open(options['output'], 'w')
+            try:
+                out.write(output)
+            finally:
+                out.close()
+        else:
+            sys.stdout.write(output + '\n')
@@ -0,0 +1,203 @@
+"""
+MessagePack encoding for the API.
+
+Compared to the JSON documents, two things make the encoding smaller:
+
+- Dates and datetimes are integers, the seconds since the epoch (UTC).
+  Naive datetimes are in the local time of ``TIME_ZONE``, dates are taken
+  as midnight UTC.
+- Strings are interned. The first occurrence of a string of
+  ``INTERN_MIN_LENGTH`` to ``INTERN_MAX_LENGTH`` bytes in a document is sent
+  as an extension of type ``STRING`` and gets the next number, starting at
+  0. Every further occurrence is sent as an extension of type ``REF`` that
+  holds the number as a big-endian unsigned integer of 1, 2 or 4 bytes. This
+  applies to map keys as well.
+
+A decoder only has to number the ``STRING`` extensions in the order it reads
+them, like ``unpackb`` and ``unpacker`` do. Streamed documents are a sequence
+of objects instead of one array, the numbering runs over the whole sequence.
+
+The cached fragments of objects (see ``api.representations``) can't hold the
+interned strings, their numbers depend on the document. ``pack_fragment``
+encodes an object into the encoded parts between the strings that may be
+interned and those strings, and ``Interner.splice`` joins the parts with
+the strings interned for the current document. Nothing but the strings is
+encoded again.
+
+``msgpack`` is optional, without it the format isn't offered.
+"""
+
+from __future__ import absolute_import
+
+import calendar
+import struct
+import time
+from datetime import date
+from datetime import datetime
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# extension types
+STRING = 1
+REF = 2
+
+# shorter strings are cheaper to send than to reference
+INTERN_MIN_LENGTH = 4
+# longer ones rarely repeat
+INTERN_MAX_LENGTH = 255
+
+
+def _utc_offset(seconds):
+    # of the local time at the moment ``seconds``, daylight saving included
+    return calendar.timegm(time.localtime(seconds)) - seconds
+
+
+def _timestamp(value):
+    """
+    Returns the seconds since the epoch of the datetime ``value``.
+    """
+    if value.tzinfo is not None:
+        return calendar.timegm(value.utctimetuple())
+
+    local = calendar.timegm(value.timetuple())
+    seconds = local - _utc_offset(local)
+    # again, in case daylight saving starts or ends between the two
+    return local - _utc_offset(seconds)
+
+
+def _default(obj):
+    if isinstance(obj, datetime):
+        return _timestamp(obj)
+    if isinstance(obj, date):
+        return calendar.timegm(obj.timetuple())
+    raise TypeError('%r can not be encoded with MessagePack.' % obj)
+
+
+def packb(data):
+    """
+    Encodes ``data`` without interning.
+    """
+    return msgpack.packb(data, default=_default, use_bin_type=False)
+
+
+def _is_internable(string):
+    return INTERN_MIN_LENGTH <= len(string) <= INTERN_MAX_LENGTH
+
+
+def pack_fragment(data):
+    """
+    Encodes ``data`` for ``Interner.splice``. Returns a list of the encoded
+    parts and the utf-8 encoded strings that may be interned, alternating:
+    ``[part, string, part, ..., string, part]``.
+    """
+    packer = msgpack.Packer(default=_default, use_bin_type=False)
+    fragment = []
+    part = []
+
+    def pack(data):
+        if isinstance(data, dict):
+            part.append(packer.pack_map_header(len(data)))
+            for key, value in data.iteritems():
+                pack(key)
+                pack(value)
+        elif isinstance(data, (list, tuple)):
+            part.append(packer.pack_array_header(len(data)))
+            for value in data:
+                pack(value)
+        elif isinstance(data, basestring):
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+            if _is_internable(data):
+                fragment.append(''.join(part))
+                fragment.append(data)
+                del part[:]
+            else:
+                part.append(packer.pack(data))
+        else:
+            part.append(packer.pack(data))
+
+    pack(data)
+    fragment.append(''.join(part))
+    return fragment
+
+
+class Interner(object):
+    """
+    Encodes the objects of one document, with the strings interned across
+    all of them.
+    """
+
+    def __init__(self):
+        self.packer = msgpack.Packer(default=_default, use_bin_type=False)
+        # string -> number
+        self.strings = {}
+
+
+    def pack(self, data):
+        return self.splice(pack_fragment(data))
+
+
+    def splice(self, fragment):
+        """
+        Returns the encoded object of a ``pack_fragment`` result, with its
+        strings interned.
+        """
+        parts = [fragment[0]]
+        for i in range(1, len(fragment), 2):
+            parts.append(self._intern(fragment[i]))
+            parts.append(fragment[i + 1])
+        return ''.join(parts)
+
+
+    def _intern(self, string):
+        # the encoded extension of the utf-8 encoded ``string``
+        number = self.strings.get(string)
+        if number is None:
+            self.strings[string] = len(self.strings)
+            return self.packer.pack(msgpack.ExtType(STRING, string))
+        if number < 0x100:
+            reference = struct.pack('>B', number)
+        elif number < 0x10000:
+            reference = struct.pack('>H', number)
+        else:
+            reference = struct.pack('>I', number)
+        return self.packer.pack(msgpack.ExtType(REF, reference))
+
+
+def _ext_hook():
+    # the interned strings of one document
+    strings = []
+
+    def ext_hook(code, data):
+        if code == STRING:
+            string = data.decode('utf-8')
+            strings.append(string)
+            return string
+        if code == REF:
+            if len(data) not in (1, 2, 4):
+                raise ValueError('Invalid string reference.')
+            number, = struct.unpack('>' + {1: 'B', 2: 'H', 4: 'I'}[len(data)],
+                                    data)
+            if number >= len(strings):
+                raise ValueError('Unknown string reference %d.' % number)
+            return strings[number]
+        return msgpack.ExtType(code, data)
+    return ext_hook
+
+
+def unpacker(**kwargs):
+    """
+    Returns an ``msgpack.Unpacker`` for a streamed document, which resolves
+    the interned strings.
+    """
+    return msgpack.Unpacker(raw=False, ext_hook=_ext_hook(), **kwargs)
+
+
+def unpackb(data):
+    """
+    Decodes a document with one object, e.g. the body of a request.
+    """
+    return msgpack.unpackb(data, raw=False, ext_hook=_ext_hook())
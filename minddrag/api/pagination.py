@@ -0,0 +1,243 @@
+"""
+Keyset (cursor) pagination for the collection reads of the Minddrag API.
+
+Collections are ordered by ``(created, id)``. Instead of an offset, clients
+get an opaque cursor that encodes the sort key of the last row on the page,
+so the database can seek straight to the next page no matter how deep it is.
+"""
+
+import base64
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+
+from core.search import get_backend
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class InvalidPageParameter(ValueError):
+    """
+    Raised when the ``limit`` or ``cursor`` URL parameter can't be used.
+    """
+    pass
+
+
+def encode_cursor(obj):
+    """
+    Returns the opaque cursor pointing behind ``obj``.
+    """
+    key = '%s|%d' % (obj.created.strftime(DATETIME_FORMAT), obj.pk)
+    return base64.urlsafe_b64encode(key)
+
+
+def decode_cursor(cursor):
+    """
+    Returns the ``(created, id)`` tuple encoded in ``cursor``.
+    """
+    try:
+        created, pk = base64.urlsafe_b64decode(str(cursor)).split('|')
+        return datetime.strptime(created, DATETIME_FORMAT), int(pk)
+    except (TypeError, ValueError, UnicodeError):
+        raise InvalidPageParameter('invalid cursor')
+
+
+def encode_search_cursor(score, pk):
+    """
+    Returns the opaque cursor pointing behind the search result with the
+    given ``score`` and ``pk``.
+    """
+    return base64.urlsafe_b64encode('%r|%d' % (score, pk))
+
+
+def decode_search_cursor(cursor):
+    """
+    Returns the ``(score, id)`` tuple encoded in ``cursor``.
+    """
+    try:
+        score, pk = base64.urlsafe_b64decode(str(cursor)).split('|')
+        return float(score), int(pk)
+    except (TypeError, ValueError, UnicodeError):
+        raise InvalidPageParameter('invalid cursor')
+
+
+def encode_sync_token(time):
+    """
+    Returns the opaque token for syncing the changes made after ``time``.
+    """
+    return base64.urlsafe_b64encode(time.strftime(DATETIME_FORMAT))
+
+
+def decode_sync_token(token):
+    """
+    Returns the time encoded in the sync ``token``.
+    """
+    try:
+        return datetime.strptime(base64.urlsafe_b64decode(str(token)),
+                                 DATETIME_FORMAT)
+    except (TypeError, ValueError, UnicodeError):
+        raise InvalidPageParameter('invalid sync token')
+
+
+def encode_sync_cursor(time, obj):
+    """
+    Returns the opaque cursor pointing behind ``obj`` in the changes of a
+    sync, which ends with the sync token for ``time``.
+    """
+    key = '%s|%s|%d' % (time.strftime(DATETIME_FORMAT),
+                        obj.updated.strftime(DATETIME_FORMAT),
+                        obj.pk)
+    return base64.urlsafe_b64encode(key)
+
+
+def decode_sync_cursor(cursor):
+    """
+    Returns the time of the final sync token and the ``(updated, id)``
+    tuple encoded in ``cursor``.
+    """
+    try:
+        time, updated, pk = base64.urlsafe_b64decode(str(cursor)).split('|')
+        return (datetime.strptime(time, DATETIME_FORMAT),
+                (datetime.strptime(updated, DATETIME_FORMAT), int(pk)))
+    except (TypeError, ValueError, UnicodeError):
+        raise InvalidPageParameter('invalid cursor')
+
+
+def get_limit(request):
+    """
+    Returns the page size requested with the ``limit`` URL parameter,
+    capped at ``API_MAX_PAGE_SIZE``.
+    """
+    default = getattr(settings, 'API_PAGE_SIZE', 25)
+    maximum = getattr(settings, 'API_MAX_PAGE_SIZE', 100)
+
+    if not 'limit' in request.GET:
+        return default
+
+    try:
+        limit = int(request.GET['limit'])
+    except ValueError:
+        raise InvalidPageParameter('invalid limit')
+
+    if limit < 1:
+        raise InvalidPageParameter('invalid limit')
+
+    return min(limit, maximum)
+
+
+def after(queryset, created, pk):
+    """
+    Restricts ``queryset`` to the rows that sort after ``(created, pk)``.
+    """
+    return queryset.filter(Q(created__gt=created) | Q(created=created,
+                                                         pk__gt=pk))
+
+
+def updated_after(queryset, updated, pk):
+    """
+    Restricts ``queryset`` to the rows that sort after ``(updated, pk)``.
+    """
+    return queryset.filter(Q(updated__gt=updated) | Q(updated=updated,
+                                                         pk__gt=pk))
+
+
+def is_streamed(request):
+    """
+    Returns true, if the client asked for the whole collection to be
+    streamed instead of paginated.
+    """
+    return (request.GET.get('stream') in ('1', 'true') or
+            request.GET.get('format') == 'ndjson')
+
+
+def chunks(queryset, chunk_size=None):
+    """
+    Yields the rows of ``queryset`` in ``(created, id)`` order as lists of
+    ``chunk_size`` rows, reading one chunk per query. Each chunk seeks past
+    the last row of the previous one, so memory use stays flat and no chunk
+    is more expensive than the first, on every database backend.
+    """
+    if chunk_size is None:
+        chunk_size = getattr(settings, 'API_STREAM_CHUNK_SIZE', 500)
+
+    queryset = queryset.order_by('created', 'pk')
+    chunk = list(queryset[:chunk_size])
+
+    while chunk:
+        yield chunk
+
+        if len(chunk) < chunk_size:
+            break
+
+        last = chunk[-1]
+        chunk = list(after(queryset, last.created, last.pk)[:chunk_size])
+
+
+def iterate_in_chunks(queryset, chunk_size=None):
+    """
+    Yields every row of ``queryset`` in ``(created, id)`` order, reading
+    ``chunk_size`` rows per query (see ``chunks``).
+    """
+    for chunk in chunks(queryset, chunk_size):
+        for obj in chunk:
+            yield obj
+
+
+def paginate(request, queryset):
+    """
+    Returns one page of ``queryset`` as a list and stores the cursor for the
+    following page in ``request.next_cursor`` (``None`` on the last page).
+
+    Streamed requests get the queryset back (starting after ``cursor``, if
+    given), the emitter reads it in chunks while writing the response.
+
+    Raises ``InvalidPageParameter`` if ``limit`` or ``cursor`` are malformed.
+    """
+    queryset = queryset.order_by('created', 'pk')
+
+    if 'cursor' in request.GET:
+        queryset = after(queryset, *decode_cursor(request.GET['cursor']))
+
+    if is_streamed(request):
+        return queryset
+
+    limit = get_limit(request)
+
+    # fetch one extra row to find out whether there is a next page
+    page = list(queryset[:limit + 1])
+    request.next_cursor = None
+
+    if len(page) > limit:
+        page = page[:limit]
+        request.next_cursor = encode_cursor(page[-1])
+
+    return page
+
+
+def paginate_search(request, model, team_ids):
+    """
+    Returns one page of the ``model`` instances in the given teams that match
+    the ``search`` URL parameter, best match first. Like ``paginate``, the
+    cursor for the following page is stored in ``request.next_cursor``.
+    """
+    limit = get_limit(request)
+    after = None
+
+    if 'cursor' in request.GET:
+        after = decode_search_cursor(request.GET['cursor'])
+
+    results = get_backend().search(model,
+                                   request.GET['search'],
+                                   team_ids,
+                                   after,
+                                   limit + 1)
+    request.next_cursor = None
+
+    if len(results) > limit:
+        results = results[:limit]
+        pk, score = results[-1]
+        request.next_cursor = encode_search_cursor(score, pk)
+
+    objects = model.objects.in_bulk([pk for pk, score in results])
+    return [objects[pk] for pk, score in results if pk in objects]
@@ -0,0 +1,73 @@
+"""
+Loads the related objects that the handlers serialize (``created_by``,
+``team``, ``members``, ...) for many objects at once.
+
+Piston resolves nested fields one object at a time, which would cost a query
+per object and relation. The handlers' ``prepare`` methods use these
+functions to fill Django's related object caches in advance, with one query
+per relation.
+"""
+
+from core.models import Team
+
+
+def load_related(objects, *names):
+    """
+    Loads the objects referred to by the foreign keys ``names`` of
+    ``objects`` with one query per foreign key.
+    """
+    if not objects:
+        return
+
+    opts = objects[0]._meta
+
+    for name in names:
+        field = opts.get_field(name)
+        cache_name = field.get_cache_name()
+        ids = set()
+
+        for obj in objects:
+            value = getattr(obj, field.attname)
+            if value is not None and not hasattr(obj, cache_name):
+                ids.add(value)
+
+        if not ids:
+            continue
+
+        related = field.rel.to._default_manager.in_bulk(list(ids))
+
+        for obj in objects:
+            value = getattr(obj, field.attname)
+            if value is not None and not hasattr(obj, cache_name):
+                setattr(obj, cache_name, related.get(value))
+
+
+def load_members(teams):
+    """
+    Loads the members of ``teams`` with one query. They are available as
+    ``team_members(team)`` afterwards.
+    """
+    if not teams:
+        return
+
+    members = dict([(team.pk, []) for team in teams])
+    memberships = Team.members.through.objects.filter(
+                                        team__in=members.keys()
+                                    ).select_related('user').order_by('pk')
+
+    for membership in memberships:
+        members[membership.team_id].append(membership.user)
+
+    for team in teams:
+        team._members_cache = members[team.pk]
+
+
+def team_members(team):
+    """
+    Returns the members of ``team``, loaded by ``load_members`` if it was
+    called for the team.
+    """
+    members = getattr(team, '_members_cache', None)
+    if members is None:
+        members = list(team.members.all())
+    return members
@@ -0,0 +1,221 @@
+"""
+Cache of the serialized representations of dragables and annotations.
+
+The emitters serialize every object of a collection on its own (a
+"fragment") and assemble the response from the fragments. Fragments are
+cached per format, under a key made of the object's hash and ``updated``
+time, so a write to an object invalidates its fragments by itself.
+
+The fragments also contain the names of related teams and users. Every team
+and user has a name version in the cache, which is part of the keys of the
+fragments showing the name and changes when the name does. A rename doesn't
+touch the objects, so syncing clients don't get them again. (Hashes never
+change, and objects referring to a deleted dragable are deleted along with
+it.)
+"""
+
+import time
+from hashlib import md5
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.db.models.signals import post_init
+from django.db.models.signals import post_save
+
+from core.models import Annotation
+from core.models import Dragable
+from core.models import Team
+from core.signals import post_bulk_save
+from core.versions import ALL_TEAMS
+from core.versions import VERSION_TIMEOUT
+from core.versions import bump_team_versions
+
+# the formats of the emitters in api.emitters
+FORMATS = ('json', 'ndjson', 'xml', 'yaml', 'msgpack')
+
+CACHED_MODELS = (Dragable, Annotation)
+
+
+def fragment_key(format, model, hash, updated, names):
+    """
+    Returns the cache key of the ``format`` fragment of an object, with the
+    versions of the ``names`` it shows.
+    """
+    # ``updated`` as stored in the database, e.g. without microseconds in
+    # MySQL, so that objects read from the database and objects that were
+    # just saved have the same key
+    key = '%s|%s|%s|%s' % (model._meta.object_name,
+                           hash,
+                           connection.ops.value_to_db_datetime(updated),
+                           ','.join([str(version) for version in names]))
+    return 'api.repr.%s.%s' % (format, md5(key.encode('utf-8')).hexdigest())
+
+
+def _name_key(model, pk):
+    return 'api.name_version.%s.%s' % (model._meta.object_name, pk)
+
+
+def _named(obj):
+    # the cache keys of the name versions of the teams and users that the
+    # fragments of ``obj`` show
+    if isinstance(obj, Dragable):
+        return [_name_key(Team, obj.team_id),
+                _name_key(User, obj.created_by_id)]
+    return [_name_key(User, obj.created_by_id)]
+
+
+def get_name_versions(objects):
+    """
+    Returns a dict mapping the cache keys of the name versions of the teams
+    and users shown by ``objects`` to the versions. Needs one cache lookup.
+    """
+    keys = set()
+    for obj in objects:
+        keys.update(_named(obj))
+    versions = cache.get_many(list(keys))
+
+    for key in keys:
+        if key not in versions:
+            # a fresh version is larger than one that was evicted
+            cache.add(key, int(time.time() * 1000000), VERSION_TIMEOUT)
+            versions[key] = cache.get(key)
+
+    return versions
+
+
+def _fragment_keys(format, model, objects):
+    versions = get_name_versions(objects)
+    return [fragment_key(format,
+                         model,
+                         obj.hash,
+                         obj.updated,
+                         [versions[key] for key in _named(obj)])
+            for obj in objects]
+
+
+def get_fragments(format, objects, render, prepare=None, cached=True):
+    """
+    Returns the ``format`` fragments of ``objects``, in the same order.
+    ``render`` is called with each object whose fragment isn't cached, after
+    ``prepare`` was called with the list of all of them. Dragables and
+    annotations are looked up in the cache with one request, everything else
+    (and everything, unless ``cached``) is rendered every time.
+    """
+    keys = [None] * len(objects)
+
+    if cached:
+        for model in CACHED_MODELS:
+            indexes = [i for i, obj in enumerate(objects)
+                       if type(obj) is model]
+            model_keys = _fragment_keys(format,
+                                        model,
+                                        [objects[i] for i in indexes])
+            for i, key in zip(indexes, model_keys):
+                keys[i] = key
+
+    cached = cache.get_many([key for key in keys if key])
+
+    if prepare:
+        prepare([obj for key, obj in zip(keys, objects)
+                 if not key in cached])
+
+    fragments = []
+    missing = {}
+
+    for key, obj in zip(keys, objects):
+        fragment = cached.get(key) if key else None
+        if fragment is None:
+            fragment = render(obj)
+            if key:
+                missing[key] = fragment
+        fragments.append(fragment)
+
+    if missing:
+        cache.set_many(missing,
+                       getattr(settings, 'API_REPRESENTATION_CACHE_TIMEOUT',
+                               60 * 60 * 24))
+
+    return fragments
+
+
+def invalidate(model, objects):
+    """
+    Drops the cached fragments of the ``model`` instances ``objects``.
+    """
+    keys = []
+    for format in FORMATS:
+        keys.extend(_fragment_keys(format, model, objects))
+    cache.delete_many(keys)
+
+
+def _saved(sender, instance, created, **kwargs):
+    # ``updated`` might not have changed, if the database stores seconds only
+    if not created:
+        invalidate(sender, [instance])
+
+
+def _bulk_saved(sender, instances, created, **kwargs):
+    if sender in CACHED_MODELS and not created:
+        invalidate(sender, instances)
+
+
+# the names that show up in the fragments of dragables and annotations
+NAME_FIELDS = {
+    Team: 'name',
+    User: 'username',
+}
+
+
+def _renamed(sender, instance):
+    """
+    Starts a new version of the name of the team or user ``instance``, and
+    bumps the versions of the teams whose content shows it. A team's own
+    version is bumped by ``core.versions`` on every save.
+    """
+    key = _name_key(sender, instance.pk)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, int(time.time() * 1000000), VERSION_TIMEOUT)
+
+    if sender is User:
+        dragables = Dragable.objects.filter(created_by=instance.pk)
+        annotations = Annotation.objects.filter(created_by=instance.pk)
+        team_ids = set([ALL_TEAMS])
+        team_ids.update(dragables.order_by().values_list(
+                                            'team', flat=True).distinct())
+        team_ids.update(annotations.order_by().values_list(
+                                    'dragable__team', flat=True).distinct())
+        bump_team_versions(team_ids)
+
+
+def _name_loaded(sender, instance, **kwargs):
+    instance._loaded_name = getattr(instance, NAME_FIELDS[sender])
+
+
+def _name_saved(sender, instance, created, **kwargs):
+    name = getattr(instance, NAME_FIELDS[sender])
+    if not created and name != getattr(instance, '_loaded_name', name):
+        _renamed(sender, instance)
+    instance._loaded_name = name
+
+
+post_save.connect(_saved,
+                  sender=Dragable,
+                  dispatch_uid='api.representations.dragable_saved')
+post_save.connect(_saved,
+                  sender=Annotation,
+                  dispatch_uid='api.representations.annotation_saved')
+post_bulk_save.connect(_bulk_saved,
+                       dispatch_uid='api.representations.bulk_saved')
+for model in NAME_FIELDS:
+    post_init.connect(_name_loaded,
+                      sender=model,
+                      dispatch_uid='api.representations.%s_loaded'
+                                   % model._meta.object_name)
+    post_save.connect(_name_saved,
+                      sender=model,
+                      dispatch_uid='api.representations.%s_saved'
+                                   % model._meta.object_name)
@@ -0,0 +1,86 @@
+"""
+Minddrag flavour of the piston ``Resource``.
+"""
+
+from piston import resource
+
+# replaces the piston emitters with the streaming ones
+from api import emitters
+from api.pagination import is_streamed
+from core import metrics
+from core import routers
+
+
+class Resource(resource.Resource):
+    """
+    Adds the headers that the Minddrag handlers ask for (ETag, Last-Modified,
+    X-Next-Cursor, X-Sync-Token) to the response and marks streamed responses, so that
+    middleware leaves their content alone.
+
+    Every request is measured (see ``core.metrics``) under the name of the
+    handler method, e.g. ``TeamHandler.read``.
+
+    Reads may be served by a read replica, successful writes keep the reads
+    of the user on the primary database for a while (see ``core.routers``).
+    """
+
+    def __call__(self, request, *args, **kwargs):
+        method = self.callmap.get(request.method.upper(), request.method)
+        timer = metrics.start(self.metrics_name(request))
+        reading = None
+        if method == 'read':
+            reading = routers.start_reading(request)
+        try:
+            response = super(Resource, self).__call__(request, *args, **kwargs)
+        except:
+            if timer:
+                metrics.finish(timer, 500, 0)
+            raise
+        finally:
+            if reading:
+                routers.stop_reading()
+
+        if method != 'read' and response.status_code < 400:
+            routers.pin(request.user)
+
+        etag = getattr(request, 'etag', None)
+        if etag and response.status_code == 200:
+            # compressed responses from the cache have their own
+            if not response.has_header('ETag'):
+                response['ETag'] = etag
+            response['Last-Modified'] = request.last_modified
+
+        next_cursor = getattr(request, 'next_cursor', None)
+        if next_cursor:
+            response['X-Next-Cursor'] = next_cursor
+
+        sync_token = getattr(request, 'sync_token', None)
+        if sync_token:
+            response['X-Sync-Token'] = sync_token
+
+        if is_streamed(request):
+            response.streaming = True
+            if reading:
+                response._container = routers.iterate_reading(
+                                                    reading,
+                                                    response._container)
+
+        if timer:
+            if getattr(response, 'streaming', False):
+                # the content is produced while it's sent
+                metrics.stop(timer)
+                response._container = metrics.iterate_measured(
+                                                    timer,
+                                                    response.status_code,
+                                                    response._container)
+            else:
+                metrics.finish(timer,
+                               response.status_code,
+                               len(response.content))
+
+        return response
+
+
+    def metrics_name(self, request):
+        method = self.callmap.get(request.method.upper(), request.method)
+        return '%s.%s' % (self.handler.__class__.__name__, method)
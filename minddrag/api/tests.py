@@ -2,10 +2,12 @@
 Tests for the API
 """
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
 from django.test import Client
 from django.test import TestCase
+from django.test import TransactionTestCase
 
 import simplejson as json
 
@@ -1170,3 +1172,3013 @@ class DragableAndAnnotationTest(TestCase):
         self.assertEqual(Annotation.objects.filter(hash=hash).count(), 0)
         response = self.client.delete('/api/1.0/annotations/%s/' % hash)
         self.assertEqual(response.status_code, 404)
+
+
+def create_paginated_team(count):
+    """
+    Creates a team with ``count`` dragables that have one note annotation each
+    and returns a client for its creator.
+    """
+    user = User.objects.create_user('testuser',
+                                    'testuser@example.com',
+                                    'donthackmebro')
+    user.save()
+
+    team = Team(name='paginated team', created_by=user)
+    team.save()
+
+    for i in range(count):
+        dragable = Dragable()
+        dragable.hash = 'page%d' % i
+        dragable.team = team
+        dragable.created_by = user
+        dragable.url = 'http://www.example.com/%d' % i
+        dragable.title = 'dragable %d' % i
+        dragable.xpath = 'foo/bar'
+        dragable.save()
+
+        annotation = Annotation()
+        annotation.type = 'note'
+        annotation.hash = 'page_note%d' % i
+        annotation.dragable = dragable
+        annotation.created_by = user
+        annotation.note = 'note %d' % i
+        annotation.save()
+
+    return BasicAuthClient('testuser', 'donthackmebro')
+
+
+class PaginationTest(TestCase):
+    """
+    Tests for the cursor based pagination of the collection reads
+    """
+
+    def setUp(self):
+        self.client = create_paginated_team(7)
+
+
+    def _walk(self, url, limit):
+        hashes = []
+        params = {'limit': limit}
+
+        while True:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            page = json.loads(response.content)
+            self.assert_(len(page) <= limit)
+            hashes.extend([item['hash'] for item in page])
+
+            if not response.has_header('X-Next-Cursor'):
+                break
+            params['cursor'] = response['X-Next-Cursor']
+
+        return hashes
+
+
+    def test_walk_dragables(self):
+        hashes = self._walk('/api/1.0/dragables/', 3)
+        self.assertEqual(hashes, ['page%d' % i for i in range(7)])
+
+
+    def test_walk_annotations(self):
+        hashes = self._walk('/api/1.0/annotations/', 2)
+        self.assertEqual(hashes, ['page_note%d' % i for i in range(7)])
+
+
+    def test_last_page_has_no_cursor(self):
+        response = self.client.get('/api/1.0/dragables/', {'limit': 7})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)), 7)
+        self.failIf(response.has_header('X-Next-Cursor'))
+
+
+    def test_limit_is_capped(self):
+        from django.conf import settings
+        old_max = settings.API_MAX_PAGE_SIZE
+        settings.API_MAX_PAGE_SIZE = 4
+        try:
+            response = self.client.get('/api/1.0/dragables/', {'limit': 100})
+        finally:
+            settings.API_MAX_PAGE_SIZE = old_max
+        self.assertEqual(len(json.loads(response.content)), 4)
+
+
+    def test_invalid_limit(self):
+        response = self.client.get('/api/1.0/dragables/', {'limit': 'all'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/1.0/dragables/', {'limit': 0})
+        self.assertEqual(response.status_code, 400)
+
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/1.0/dragables/',
+                                   {'cursor': 'notacursor'})
+        self.assertEqual(response.status_code, 400)
+
+
+class StreamingTest(TestCase):
+    """
+    Tests for streamed collection reads
+    """
+
+    def setUp(self):
+        from django.conf import settings
+        self.client = create_paginated_team(7)
+        # make sure the emitters have to read more than one chunk
+        self.old_chunk_size = settings.API_STREAM_CHUNK_SIZE
+        settings.API_STREAM_CHUNK_SIZE = 3
+        self.hashes = ['page%d' % i for i in range(7)]
+
+
+    def tearDown(self):
+        from django.conf import settings
+        settings.API_STREAM_CHUNK_SIZE = self.old_chunk_size
+
+
+    def test_stream_json(self):
+        response = self.client.get('/api/1.0/dragables/',
+                                   {'stream': 1, 'limit': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assert_(response.streaming)
+        dragables = json.loads(response.content)
+        self.assertEqual([d['hash'] for d in dragables], self.hashes)
+        self.assertEqual(dragables[0]['team']['name'], 'paginated team')
+
+
+    def test_stream_json_from_cursor(self):
+        response = self.client.get('/api/1.0/dragables/', {'limit': 2})
+        cursor = response['X-Next-Cursor']
+        response = self.client.get('/api/1.0/dragables/',
+                                   {'stream': 1, 'cursor': cursor})
+        dragables = json.loads(response.content)
+        self.assertEqual([d['hash'] for d in dragables], self.hashes[2:])
+
+
+    def test_stream_json_empty(self):
+        Annotation.objects.all().delete()
+        response = self.client.get('/api/1.0/annotations/', {'stream': 1})
+        self.assertEqual(json.loads(response.content), [])
+
+
+    def test_stream_ndjson(self):
+        response = self.client.get('/api/1.0/annotations/',
+                                   {'format': 'ndjson'})
+        self.assertEqual(response.status_code, 200)
+        self.assert_(response['Content-Type'].startswith(
+                                                    'application/x-ndjson'))
+        lines = response.content.splitlines()
+        self.assertEqual([json.loads(l)['hash'] for l in lines],
+                         ['page_note%d' % i for i in range(7)])
+
+
+    def test_stream_xml(self):
+        from xml.dom import minidom
+        response = self.client.get('/api/1.0/dragables/',
+                                   {'stream': 1, 'format': 'xml'})
+        self.assertEqual(response.status_code, 200)
+        document = minidom.parseString(response.content)
+        hashes = [node.firstChild.data
+                  for node in document.getElementsByTagName('hash')]
+        self.assertEqual(hashes, self.hashes)
+
+
+    def test_stream_yaml(self):
+        import yaml
+        response = self.client.get('/api/1.0/dragables/',
+                                   {'stream': 1, 'format': 'yaml'})
+        self.assertEqual(response.status_code, 200)
+        dragables = yaml.safe_load(response.content)
+        self.assertEqual([d['hash'] for d in dragables], self.hashes)
+
+
+class SearchTest(TestCase):
+    """
+    Tests for the full-text search over teams, dragables and annotations
+    """
+
+    def setUp(self):
+        user = User.objects.create_user('testuser',
+                                        'testuser@example.com',
+                                        'donthackmebro')
+        other = User.objects.create_user('other',
+                                         'other@example.com',
+                                         'donthackmebro')
+
+        self.team = Team(name='search team',
+                         description='all about spam',
+                         created_by=user)
+        self.team.save()
+        self.team2 = Team(name='second search team', created_by=user)
+        self.team2.save()
+        other_team = Team(name='other team', created_by=other)
+        other_team.save()
+
+        data = (
+            ('spam_title', self.team, 'spam spam', 'eggs'),
+            ('spam_text', self.team, 'eggs', 'eggs spam bacon'),
+            ('eggs_only', self.team, 'eggs', 'eggs'),
+            ('spam_team2', self.team2, 'more eggs', 'spam'),
+            ('spam_hidden', other_team, 'spam', 'spam spam'),
+        )
+        for hash, team, title, text in data:
+            dragable = Dragable(hash=hash,
+                                team=team,
+                                created_by=team.created_by,
+                                url='http://www.example.com/',
+                                title=title,
+                                text=text,
+                                xpath='foo/bar')
+            dragable.save()
+
+            annotation = Annotation(hash='note_%s' % hash,
+                                    type='note',
+                                    dragable=dragable,
+                                    created_by=team.created_by,
+                                    note=text)
+            annotation.save()
+
+        self.client = BasicAuthClient('testuser', 'donthackmebro')
+
+
+    def _search(self, url, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return [item['hash'] for item in json.loads(response.content)]
+
+
+    def test_search_dragables(self):
+        hashes = self._search('/api/1.0/dragables/', search='spam')
+        # matches in the title rank higher, other users' teams are excluded
+        self.assertEqual(hashes[0], 'spam_title')
+        self.assertEqual(set(hashes),
+                         set(['spam_title', 'spam_text', 'spam_team2']))
+
+
+    def test_search_dragables_all_terms(self):
+        hashes = self._search('/api/1.0/dragables/', search='spam bacon')
+        self.assertEqual(hashes, ['spam_text'])
+
+
+    def test_search_dragables_in_team(self):
+        hashes = self._search('/api/1.0/dragables/',
+                              search='spam',
+                              team='second search team')
+        self.assertEqual(hashes, ['spam_team2'])
+
+
+    def test_search_dragables_in_inaccessible_team(self):
+        response = self.client.get('/api/1.0/dragables/',
+                                   {'search': 'spam', 'team': 'other team'})
+        self.assertEqual(response.status_code, 401)
+
+
+    def test_search_ignores_query_syntax(self):
+        hashes = self._search('/api/1.0/dragables/', search='"spam* OR (')
+        self.assertEqual(hashes, [])
+
+
+    def test_search_pagination(self):
+        expected = self._search('/api/1.0/dragables/', search='spam eggs')
+        hashes = []
+        params = {'search': 'spam eggs', 'limit': 1}
+
+        while True:
+            response = self.client.get('/api/1.0/dragables/', params)
+            hashes.extend([d['hash'] for d in json.loads(response.content)])
+            if not response.has_header('X-Next-Cursor'):
+                break
+            params['cursor'] = response['X-Next-Cursor']
+
+        self.assertEqual(len(expected), 3)
+        self.assertEqual(hashes, expected)
+
+
+    def test_search_follows_updates(self):
+        dragable = Dragable.objects.get(hash='eggs_only')
+        dragable.title = 'now with spam'
+        dragable.save()
+        hashes = self._search('/api/1.0/dragables/', search='spam')
+        self.assert_('eggs_only' in hashes)
+
+        Dragable.objects.get(hash='spam_title').delete()
+        hashes = self._search('/api/1.0/dragables/', search='spam')
+        self.failIf('spam_title' in hashes)
+
+
+    def test_search_follows_team_changes(self):
+        dragable = Dragable.objects.get(hash='spam_hidden')
+        dragable.team = self.team
+        dragable.save()
+        hashes = self._search('/api/1.0/annotations/', search='spam')
+        self.assert_('note_spam_hidden' in hashes)
+
+
+    def test_search_annotations(self):
+        hashes = self._search('/api/1.0/annotations/', search='bacon')
+        self.assertEqual(hashes, ['note_spam_text'])
+
+
+    def test_search_teams(self):
+        response = self.client.get('/api/1.0/teams/', {'search': 'spam'})
+        teams = json.loads(response.content)
+        self.assertEqual([t['name'] for t in teams], ['search team'])
+
+
+def count_queries(func, *args, **kwargs):
+    """
+    Returns the result of ``func`` and the number of queries it ran.
+    """
+    from django.conf import settings
+    from django.db import connection
+    old_debug = settings.DEBUG
+    settings.DEBUG = True
+    connection.queries = []
+    try:
+        result = func(*args, **kwargs)
+        return result, len(connection.queries)
+    finally:
+        settings.DEBUG = old_debug
+
+
+class BulkTest(TestCase):
+    """
+    Tests for the bulk create/update/delete API methods
+    """
+
+    def setUp(self):
+        user = User.objects.create_user('testuser',
+                                        'testuser@example.com',
+                                        'donthackmebro')
+        other = User.objects.create_user('other',
+                                         'other@example.com',
+                                         'donthackmebro')
+        self.team = Team(name='bulk team', created_by=user)
+        self.team.save()
+        self.other_team = Team(name='other team', created_by=other)
+        self.other_team.save()
+
+        self.foreign = Dragable(hash='foreign',
+                                team=self.other_team,
+                                created_by=other,
+                                url='http://www.example.com/',
+                                xpath='foo')
+        self.foreign.save()
+        Annotation(hash='foreign_note',
+                   type='note',
+                   dragable=self.foreign,
+                   created_by=other,
+                   note='hands off').save()
+
+        self.client = BasicAuthClient('testuser', 'donthackmebro')
+
+
+    def _send(self, method, url, data):
+        response = getattr(self.client, method)(url,
+                                                json.dumps(data),
+                                                content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return dict([(r['hash'], r['status'])
+                     for r in json.loads(response.content)])
+
+
+    def _dragables(self, count, prefix='bulk'):
+        return [{'hash': '%s%d' % (prefix, i),
+                 'team': 'bulk team',
+                 'url': 'http://www.example.com/%d' % i,
+                 'xpath': 'foo/bar',
+                 'title': 'bulk dragable %d' % i}
+                for i in range(count)]
+
+
+    def test_create_dragables(self):
+        items = self._dragables(3)
+        items[2]['connected_to'] = 'bulk0'
+        status = self._send('post', '/api/1.0/bulk/dragables/', items)
+        self.assertEqual(status, {'bulk0': 201, 'bulk1': 201, 'bulk2': 201})
+
+        dragable = Dragable.objects.get(hash='bulk2')
+        self.assertEqual(dragable.title, 'bulk dragable 2')
+        self.assertEqual(dragable.team, self.team)
+        self.assertEqual(dragable.connected_to.hash, 'bulk0')
+        self.assert_(dragable.created is not None)
+
+
+    def test_create_dragables_connected_to_later_item(self):
+        items = self._dragables(2)
+        items[0]['connected_to'] = 'bulk1'
+        self._send('post', '/api/1.0/bulk/dragables/', items)
+        dragable = Dragable.objects.get(hash='bulk0')
+        self.assertEqual(dragable.connected_to.hash, 'bulk1')
+
+
+    def test_create_dragables_connected_to_failed_item(self):
+        items = self._dragables(4)
+        del items[0]['url']
+        items[1]['connected_to'] = 'bulk0'
+        items[2]['connected_to'] = 'bulk1'
+        items[3]['connected_to'] = 'foreign'
+        status = self._send('post', '/api/1.0/bulk/dragables/', items)
+        self.assertEqual(status, {'bulk0': 400,
+                                  'bulk1': 400,
+                                  'bulk2': 400,
+                                  'bulk3': 400})
+        self.assertEqual(Dragable.objects.filter(team=self.team).count(), 0)
+
+
+    def test_create_dragables_item_errors(self):
+        items = self._dragables(5)
+        items[1]['hash'] = 'foreign'
+        items[2]['team'] = 'other team'
+        items[3]['team'] = 'no such team'
+        del items[4]['url']
+        status = self._send('post', '/api/1.0/bulk/dragables/', items)
+        self.assertEqual(status, {'bulk0': 201,
+                                  'foreign': 409,
+                                  'bulk2': 401,
+                                  'bulk3': 400,
+                                  'bulk4': 400})
+        self.assertEqual(Dragable.objects.filter(team=self.team).count(), 1)
+
+
+    def test_create_dragables_constant_queries(self):
+        # warm up the membership cache
+        self._send('post', '/api/1.0/bulk/dragables/', self._dragables(1))
+        response, small = count_queries(self._send, 'post',
+                                        '/api/1.0/bulk/dragables/',
+                                        self._dragables(2, 'small'))
+        response, large = count_queries(self._send, 'post',
+                                        '/api/1.0/bulk/dragables/',
+                                        self._dragables(40, 'large'))
+        self.assertEqual(small, large)
+
+
+    def test_create_too_many(self):
+        from django.conf import settings
+        items = self._dragables(settings.API_BULK_MAX_ITEMS + 1)
+        response = self.client.post('/api/1.0/bulk/dragables/',
+                                    json.dumps(items),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Dragable.objects.filter(team=self.team).count(), 0)
+
+
+    def test_update_dragables(self):
+        self._send('post', '/api/1.0/bulk/dragables/', self._dragables(3))
+        status = self._send('put', '/api/1.0/bulk/dragables/', [
+            {'hash': 'bulk0', 'title': 'new title'},
+            {'hash': 'bulk1', 'connected_to': 'bulk2', 'text': 'new text'},
+            {'hash': 'bulk2', 'connected_to': 'foreign'},
+            {'hash': 'foreign', 'title': 'mine now'},
+            {'hash': 'missing', 'title': 'nope'},
+        ])
+        self.assertEqual(status, {'bulk0': 200,
+                                  'bulk1': 200,
+                                  'bulk2': 400,
+                                  'foreign': 401,
+                                  'missing': 404})
+        self.assertEqual(Dragable.objects.get(hash='bulk0').title, 'new title')
+        dragable = Dragable.objects.get(hash='bulk1')
+        self.assertEqual(dragable.text, 'new text')
+        self.assertEqual(dragable.title, 'bulk dragable 1')
+        self.assertEqual(dragable.connected_to.hash, 'bulk2')
+        self.assertEqual(Dragable.objects.get(hash='foreign').title, '')
+
+
+    def test_delete_dragables(self):
+        self._send('post', '/api/1.0/bulk/dragables/', self._dragables(3))
+        response = self.client.delete('/api/1.0/bulk/dragables/',
+                                      {'hash': 'bulk0,bulk1,foreign,missing'})
+        status = dict([(r['hash'], r['status'])
+                       for r in json.loads(response.content)])
+        self.assertEqual(status, {'bulk0': 204,
+                                  'bulk1': 204,
+                                  'foreign': 401,
+                                  'missing': 404})
+        self.assertEqual(
+            list(Dragable.objects.filter(team=self.team).values_list(
+                                                        'hash', flat=True)),
+            ['bulk2'])
+
+
+    def test_create_annotations(self):
+        self._send('post', '/api/1.0/bulk/dragables/', self._dragables(2))
+        status = self._send('post', '/api/1.0/bulk/annotations/', [
+            {'hash': 'n1', 'dragable': 'bulk0', 'type': 'note', 'note': 'hi'},
+            {'hash': 'u1', 'dragable': 'bulk0', 'type': 'url',
+             'url': 'http://example.com/', 'description': 'a link'},
+            {'hash': 'c1', 'dragable': 'bulk0', 'type': 'connection',
+             'connected_to': 'bulk1'},
+            {'hash': 'c2', 'dragable': 'bulk0', 'type': 'connection',
+             'connected_to': 'bulk0'},
+            {'hash': 'x1', 'dragable': 'bulk0', 'type': 'bogus'},
+            {'hash': 'n2', 'dragable': 'bulk0', 'type': 'note'},
+            {'hash': 'n3', 'dragable': 'foreign', 'type': 'note',
+             'note': 'sneaky'},
+            {'hash': 'foreign_note', 'dragable': 'bulk0', 'type': 'note',
+             'note': 'dupe'},
+        ])
+        self.assertEqual(status, {'n1': 201,
+                                  'u1': 201,
+                                  'c1': 201,
+                                  'c2': 400,
+                                  'x1': 400,
+                                  'n2': 400,
+                                  'n3': 401,
+                                  'foreign_note': 409})
+        self.assertEqual(Annotation.objects.get(hash='n1').note, 'hi')
+        self.assertEqual(Annotation.objects.get(hash='u1').description,
+                         'a link')
+        self.assertEqual(
+                Annotation.objects.get(hash='c1').connected_dragable.hash,
+                'bulk1')
+
+
+    def test_update_and_delete_annotations(self):
+        self._send('post', '/api/1.0/bulk/dragables/', self._dragables(2))
+        self._send('post', '/api/1.0/bulk/annotations/', [
+            {'hash': 'n1', 'dragable': 'bulk0', 'type': 'note', 'note': 'hi'},
+            {'hash': 'n2', 'dragable': 'bulk0', 'type': 'note', 'note': 'ho'},
+        ])
+        status = self._send('put', '/api/1.0/bulk/annotations/', [
+            {'hash': 'n1', 'note': 'changed', 'dragable': 'bulk1'},
+            {'hash': 'n2'},
+            {'hash': 'foreign_note', 'note': 'mine'},
+        ])
+        self.assertEqual(status, {'n1': 200, 'n2': 400, 'foreign_note': 401})
+        annotation = Annotation.objects.get(hash='n1')
+        self.assertEqual(annotation.note, 'changed')
+        self.assertEqual(annotation.dragable.hash, 'bulk1')
+
+        response = self.client.delete('/api/1.0/bulk/annotations/',
+                                      {'hash': 'n1,n2,foreign_note'})
+        status = dict([(r['hash'], r['status'])
+                       for r in json.loads(response.content)])
+        self.assertEqual(status, {'n1': 204, 'n2': 204, 'foreign_note': 401})
+        self.assertEqual(Annotation.objects.filter(
+                                    dragable__team=self.team).count(), 0)
+
+
+    def test_bulk_created_dragables_are_searchable(self):
+        self._send('post', '/api/1.0/bulk/dragables/', self._dragables(2))
+        response = self.client.get('/api/1.0/dragables/', {'search': 'bulk'})
+        self.assertEqual(len(json.loads(response.content)), 2)
+
+
+class MultiGetTest(TestCase):
+    """
+    Tests for retrieving many objects by hash or name with one request
+    """
+
+    def setUp(self):
+        user = User.objects.create_user('testuser',
+                                        'testuser@example.com',
+                                        'donthackmebro')
+        other = User.objects.create_user('other',
+                                         'other@example.com',
+                                         'donthackmebro')
+        team = Team(name='my team', created_by=user)
+        team.save()
+        other_team = Team(name='other team', created_by=other)
+        other_team.save()
+
+        for hash, team, creator in (('mine1', team, user),
+                                    ('mine2', team, user),
+                                    ('theirs', other_team, other)):
+            dragable = Dragable(hash=hash,
+                                team=team,
+                                created_by=creator,
+                                url='http://www.example.com/',
+                                xpath='foo')
+            dragable.save()
+            Annotation(hash='note_%s' % hash,
+                       type='note',
+                       dragable=dragable,
+                       created_by=creator,
+                       note='a note').save()
+
+        self.client = BasicAuthClient('testuser', 'donthackmebro')
+
+
+    def _get(self, url, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+
+    def test_multi_get_dragables(self):
+        results = self._get('/api/1.0/dragables/',
+                            hash='mine2,theirs,missing,mine1,mine2')
+        self.assertEqual([(r['hash'], r['status']) for r in results],
+                         [('mine2', 'found'),
+                          ('theirs', 'forbidden'),
+                          ('missing', 'missing'),
+                          ('mine1', 'found')])
+        self.assertEqual(results[0]['dragable']['hash'], 'mine2')
+        self.assertEqual(results[0]['dragable']['team']['name'], 'my team')
+        self.failIf('dragable' in results[1])
+        self.failIf('dragable' in results[2])
+
+
+    def test_multi_get_annotations(self):
+        results = self._get('/api/1.0/annotations/',
+                            hash='note_mine1,note_theirs,nope')
+        self.assertEqual([(r['hash'], r['status']) for r in results],
+                         [('note_mine1', 'found'),
+                          ('note_theirs', 'forbidden'),
+                          ('nope', 'missing')])
+        self.assertEqual(results[0]['annotation']['dragable']['hash'],
+                         'mine1')
+
+
+    def test_multi_get_teams(self):
+        client = Client()
+        response = client.get('/api/1.0/teams/',
+                              {'name': 'other team,my team,no team'})
+        results = json.loads(response.content)
+        self.assertEqual([(r['name'], r['status']) for r in results],
+                         [('other team', 'found'),
+                          ('my team', 'found'),
+                          ('no team', 'missing')])
+        self.assertEqual(results[1]['team']['created_by']['username'],
+                         'testuser')
+        self.failIf('password' in results[1]['team'])
+
+
+    def test_multi_get_single_query(self):
+        # warm up the membership cache
+        self._get('/api/1.0/dragables/', hash='mine1')
+        response, one = count_queries(self.client.get,
+                                      '/api/1.0/dragables/',
+                                      {'hash': 'theirs'})
+        response, many = count_queries(self.client.get,
+                                       '/api/1.0/dragables/',
+                                       {'hash': 'theirs,a,b,c,d,e'})
+        self.assertEqual(one, many)
+
+
+    def test_multi_get_too_many(self):
+        hashes = ','.join(['h%d' % i
+                           for i in range(settings.API_BULK_MAX_ITEMS + 1)])
+        response = self.client.get('/api/1.0/dragables/', {'hash': hashes})
+        self.assertEqual(response.status_code, 400)
+
+
+class TeamGraphTest(TestCase):
+    """
+    Tests for the graph of a team
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user('testuser',
+                                             'testuser@example.com',
+                                             'donthackmebro')
+        other = User.objects.create_user('other',
+                                         'other@example.com',
+                                         'donthackmebro')
+        self.team = Team(name='graph team', created_by=self.user)
+        self.team.save()
+        Team(name='other team', created_by=other).save()
+        self.client = BasicAuthClient('testuser', 'donthackmebro')
+
+
+    def _add_dragable(self, hash, connected_to=None):
+        dragable = Dragable(hash=hash,
+                            team=self.team,
+                            created_by=self.user,
+                            url='http://www.example.com/%s' % hash,
+                            title='title %s' % hash,
+                            xpath='foo',
+                            connected_to=connected_to)
+        dragable.save()
+        return dragable
+
+
+    def _add_connection(self, hash, dragable, connected_dragable):
+        Annotation(hash=hash,
+                   type='connection',
+                   dragable=dragable,
+                   connected_dragable=connected_dragable,
+                   created_by=self.user).save()
+
+
+    def _graph(self, name='graph team'):
+        response = self.client.get('/api/1.0/teams/%s/graph/' % name)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+
+    def test_graph(self):
+        a = self._add_dragable('a')
+        b = self._add_dragable('b', connected_to=a)
+        c = self._add_dragable('c', connected_to=a)
+        self._add_connection('conn', c, b)
+        Annotation(hash='note', type='note', dragable=a, note='x',
+                   created_by=self.user).save()
+
+        graph = self._graph()
+        self.assertEqual(graph['team'], 'graph team')
+        self.assertEqual([n['hash'] for n in graph['nodes']], ['a', 'b', 'c'])
+        self.assertEqual(graph['nodes'][0]['title'], 'title a')
+        self.assertEqual(graph['connected_to'], {'b': ['a'], 'c': ['a']})
+        self.assertEqual(graph['connections'], {'c': [['b', 'conn']]})
+
+
+    def test_constant_queries(self):
+        from core.graph import build_team_graph
+        a = self._add_dragable('a')
+        graph, few = count_queries(build_team_graph, self.team.pk)
+
+        for i in range(20):
+            d = self._add_dragable('d%d' % i, connected_to=a)
+            self._add_connection('c%d' % i, d, a)
+        graph, many = count_queries(build_team_graph, self.team.pk)
+
+        self.assertEqual(len(graph['nodes']), 21)
+        self.assertEqual(few, many)
+
+
+    def test_cached_per_version(self):
+        a = self._add_dragable('a')
+        first = self._graph()
+        self.assertEqual(first, self._graph())
+
+        # cached graph, no queries besides authentication and the team lookup
+        response, cached = count_queries(self.client.get,
+                                         '/api/1.0/teams/graph team/graph/')
+        self.assert_(cached <= 3)
+
+        self._add_dragable('b', connected_to=a)
+        second = self._graph()
+        self.assert_(second['version'] > first['version'])
+        self.assertEqual(len(second['nodes']), 2)
+
+
+    def test_not_found_and_forbidden(self):
+        response = self.client.get('/api/1.0/teams/nope/graph/')
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get('/api/1.0/teams/other team/graph/')
+        self.assertEqual(response.status_code, 401)
+
+
+class NeighbourhoodTest(TestCase):
+    """
+    Tests for the bounded traversal of the dragable connections
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user('testuser',
+                                             'testuser@example.com',
+                                             'donthackmebro')
+        self.team = Team(name='graph team', created_by=self.user)
+        self.team.save()
+        self.client = BasicAuthClient('testuser', 'donthackmebro')
+
+        # a <- b <- c <- d, d -conn-> a (cycle), b -conn-> e, f unconnected
+        a = self._add_dragable('a')
+        b = self._add_dragable('b', a)
+        c = self._add_dragable('c', b)
+        d = self._add_dragable('d', c)
+        e = self._add_dragable('e')
+        self._add_dragable('f')
+        self._add_connection('d-a', d, a)
+        self._add_connection('b-e', b, e)
+
+
+    def tearDown(self):
+        settings.GRAPH_RECURSIVE_QUERIES = None
+
+
+    def _add_dragable(self, hash, connected_to=None):
+        dragable = Dragable(hash=hash,
+                            team=self.team,
+                            created_by=self.user,
+                            url='http://www.example.com/%s' % hash,
+                            xpath='foo',
+                            connected_to=connected_to)
+        dragable.save()
+        return dragable
+
+
+    def _add_connection(self, hash, dragable, connected_dragable):
+        Annotation(hash=hash,
+                   type='connection',
+                   dragable=dragable,
+                   connected_dragable=connected_dragable,
+                   created_by=self.user).save()
+
+
+    def _get(self, hash, **params):
+        response = self.client.get('/api/1.0/dragables/%s/neighbourhood/'
+                                   % hash, params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+
+    def _hops(self, graph):
+        return dict([(n['hash'], n['hops']) for n in graph['nodes']])
+
+
+    def _both(self, hash, **params):
+        results = []
+        for recursive in (True, False):
+            settings.GRAPH_RECURSIVE_QUERIES = recursive
+            results.append(self._get(hash, **params))
+        self.assertEqual(results[0], results[1])
+        return results[0]
+
+
+    def test_depth(self):
+        graph = self._both('a', depth=1)
+        self.assertEqual(self._hops(graph), {'a': 0, 'b': 1, 'd': 1})
+        self.assertEqual(graph['connected_to'], {'b': ['a']})
+        self.assertEqual(graph['connections'], {'d': [['a', 'd-a']]})
+        self.failIf(graph['truncated'])
+
+        graph = self._both('a', depth=2)
+        self.assertEqual(self._hops(graph),
+                         {'a': 0, 'b': 1, 'd': 1, 'c': 2, 'e': 2})
+
+
+    def test_cycle(self):
+        graph = self._both('c', depth=5)
+        self.assertEqual(self._hops(graph),
+                         {'c': 0, 'b': 1, 'd': 1, 'a': 2, 'e': 2})
+
+
+    def test_limit(self):
+        graph = self._both('a', depth=3, limit=3)
+        self.assertEqual(len(graph['nodes']), 3)
+        self.assertEqual(graph['nodes'][0]['hash'], 'a')
+        self.assert_(graph['truncated'])
+
+
+    def test_depth_zero(self):
+        graph = self._both('f', depth=0)
+        self.assertEqual(self._hops(graph), {'f': 0})
+
+
+    def test_queries_per_level(self):
+        from core.graph import neighbourhood
+        settings.GRAPH_RECURSIVE_QUERIES = False
+        root = Dragable.objects.get(hash='f')
+        for i in range(10):
+            self._add_dragable('f%d' % i, root)
+        graph, queries = count_queries(neighbourhood, root, 1, 100)
+        self.assertEqual(len(graph['nodes']), 11)
+        # one level plus building the graph
+        self.assertEqual(queries, 5)
+
+        settings.GRAPH_RECURSIVE_QUERIES = True
+        graph, queries = count_queries(neighbourhood, root, 1, 100)
+        self.assertEqual(queries, 3)
+
+
+    def test_errors(self):
+        response = self.client.get('/api/1.0/dragables/nope/neighbourhood/')
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get('/api/1.0/dragables/a/neighbourhood/',
+                                   {'depth': 'x'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/1.0/dragables/a/neighbourhood/',
+                                   {'limit': '-1'})
+        self.assertEqual(response.status_code, 400)
+
+        User.objects.create_user('other', 'other@example.com', 'pass')
+        client = BasicAuthClient('other', 'pass')
+        response = client.get('/api/1.0/dragables/a/neighbourhood/')
+        self.assertEqual(response.status_code, 401)
+
+
+class ConditionalGetTest(TestCase):
+    """
+    Tests for the ETags derived from the team versions
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user('testuser',
+                                             'testuser@example.com',
+                                             'donthackmebro')
+        self.team = Team(name='etag team', created_by=self.user)
+        self.team.save()
+        self.dragable = Dragable(hash='d1',
+                                 team=self.team,
+                                 created_by=self.user,
+                                 url='http://www.example.com/',
+                                 xpath='foo')
+        self.dragable.save()
+        self.client = BasicAuthClient('testuser', 'donthackmebro')
+
+
+    def _etag(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assert_(response.has_header('Last-Modified'))
+        return response['ETag']
+
+
+    def test_not_modified(self):
+        for url in ('/api/1.0/teams/',
+                    '/api/1.0/dragables/',
+                    '/api/1.0/dragables/d1/',
+                    '/api/1.0/annotations/',
+                    '/api/1.0/teams/etag team/graph/'):
+            etag = self._etag(url)
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.content, '')
+
+
+    def test_no_queries_for_not_modified(self):
+        url = '/api/1.0/dragables/'
+        etag = self._etag(url)
+        # authenticating the user is all that's left
+        response, queries = count_queries(self.client.get,
+                                          url,
+                                          HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(queries, 1)
+
+
+    def test_anonymous(self):
+        client = Client()
+        response = client.get('/api/1.0/teams/')
+        etag = response['ETag']
+        response = client.get('/api/1.0/teams/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+
+    def test_dragable_write(self):
+        etag = self._etag('/api/1.0/dragables/')
+        self.dragable.title = 'new title'
+        self.dragable.save()
+        self.assertNotEqual(etag, self._etag('/api/1.0/dragables/'))
+
+
+    def test_annotation_write(self):
+        etag = self._etag('/api/1.0/dragables/d1/')
+        Annotation(hash='a1',
+                   type='note',
+                   dragable=self.dragable,
+                   created_by=self.user,
+                   note='note').save()
+        self.assertNotEqual(etag, self._etag('/api/1.0/dragables/d1/'))
+
+
+    def test_membership_write(self):
+        other = User.objects.create_user('other', 'other@example.com', 'pass')
+        etag = self._etag('/api/1.0/teams/')
+        dragables_etag = self._etag('/api/1.0/dragables/')
+
+        self.team.members.add(other)
+        self.assertNotEqual(etag, self._etag('/api/1.0/teams/'))
+        self.assertNotEqual(dragables_etag, self._etag('/api/1.0/dragables/'))
+
+
+    def test_other_team_write(self):
+        other = User.objects.create_user('other', 'other@example.com', 'pass')
+        other_team = Team(name='other team', created_by=other)
+        other_team.save()
+        etag = self._etag('/api/1.0/dragables/')
+
+        Dragable(hash='d2',
+                 team=other_team,
+                 created_by=other,
+                 url='http://www.example.com/',
+                 xpath='foo').save()
+        self.assertEqual(etag, self._etag('/api/1.0/dragables/'))
+
+
+    def test_urls_and_users_differ(self):
+        self.assertNotEqual(self._etag('/api/1.0/dragables/'),
+                            self._etag('/api/1.0/dragables/?limit=1'))
+
+        User.objects.create_user('other', 'other@example.com', 'pass')
+        client = BasicAuthClient('other', 'pass')
+        response = client.get('/api/1.0/teams/')
+        self.assertNotEqual(response['ETag'], self._etag('/api/1.0/teams/'))
+
+
+    def test_multi_get_not_versioned(self):
+        response = self.client.get('/api/1.0/dragables/', {'hash': 'd1'})
+        self.failIf(response.has_header('ETag'))
+
+
+class SyncTest(TestCase):
+    """
+    Tests for syncing the changes since a sync token
+    """
+
+    def setUp(self):
+        self.old_overlap = settings.SYNC_TOKEN_OVERLAP
+        settings.SYNC_TOKEN_OVERLAP = 0
+
+        self.user = User.objects.create_user('testuser',
+                                             'testuser@example.com',
+                                             'donthackmebro')
+        self.team = Team(name='sync team', created_by=self.user)
+        self.team.save()
+        self.dragables = []
+        for i in range(5):
+            dragable = Dragable(hash='d%d' % i,
+                                team=self.team,
+                                created_by=self.user,
+                                url='http://www.example.com/',
+                                xpath='foo')
+            dragable.save()
+            self.dragables.append(dragable)
+            Annotation(hash='a%d' % i,
+                       type='note',
+                       dragable=dragable,
+                       created_by=self.user,
+                       note='note').save()
+        self.client = BasicAuthClient('testuser', 'donthackmebro')
+
+
+    def tearDown(self):
+        settings.SYNC_TOKEN_OVERLAP = self.old_overlap
+
+
+    def _token(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response['X-Sync-Token']
+
+
+    def _sync(self, url, token, **params):
+        params['since'] = token
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+
+    def test_no_changes(self):
+        token = self._token('/api/1.0/dragables/')
+        result = self._sync('/api/1.0/dragables/', token)
+        self.assertEqual(result['changed'], [])
+        self.assertEqual(result['deleted'], [])
+        self.assert_(result['token'])
+
+
+    def test_changed_and_deleted_dragables(self):
+        token = self._token('/api/1.0/dragables/')
+
+        self.dragables[1].title = 'changed'
+        self.dragables[1].save()
+        Dragable(hash='new',
+                 team=self.team,
+                 created_by=self.user,
+                 url='http://www.example.com/',
+                 xpath='foo').save()
+        response = self.client.delete('/api/1.0/dragables/d3/')
+        self.assertEqual(response.status_code, 204)
+
+        result = self._sync('/api/1.0/dragables/', token)
+        self.assertEqual([d['hash'] for d in result['changed']],
+                         ['d1', 'new'])
+        self.assertEqual(result['changed'][0]['title'], 'changed')
+        self.assertEqual(result['deleted'], ['d3'])
+
+        # nothing changed since the new token
+        result = self._sync('/api/1.0/dragables/', result['token'])
+        self.assertEqual(result['changed'], [])
+        self.assertEqual(result['deleted'], [])
+
+
+    def test_cascading_deletes(self):
+        token = self._token('/api/1.0/annotations/')
+        self.client.delete('/api/1.0/dragables/d2/')
+        self.client.delete('/api/1.0/annotations/a4/')
+
+        result = self._sync('/api/1.0/annotations/', token)
+        self.assertEqual(result['changed'], [])
+        self.assertEqual(sorted(result['deleted']), ['a2', 'a4'])
+
+
+    def test_other_teams(self):
+        other = User.objects.create_user('other', 'other@example.com', 'pass')
+        other_team = Team(name='other team', created_by=other)
+        other_team.save()
+        token = self._token('/api/1.0/dragables/')
+
+        dragable = Dragable(hash='theirs',
+                            team=other_team,
+                            created_by=other,
+                            url='http://www.example.com/',
+                            xpath='foo')
+        dragable.save()
+        dragable.delete()
+        Dragable(hash='theirs2',
+                 team=other_team,
+                 created_by=other,
+                 url='http://www.example.com/',
+                 xpath='foo').save()
+
+        result = self._sync('/api/1.0/dragables/', token)
+        self.assertEqual(result['changed'], [])
+        self.assertEqual(result['deleted'], [])
+
+
+    def test_pages(self):
+        token = self._token('/api/1.0/annotations/')
+        for dragable in self.dragables:
+            dragable.title = 'changed'
+            dragable.save()
+        self.client.delete('/api/1.0/annotations/a4/')
+
+        hashes = []
+        deleted = []
+        result = self._sync('/api/1.0/dragables/', token, limit=2)
+        while True:
+            hashes.extend([d['hash'] for d in result['changed']])
+            deleted.extend(result['deleted'])
+            if not result['has_more']:
+                break
+            self.assertEqual(len(result['changed']), 2)
+            # written while paging, after the position of the cursor
+            self.dragables[0].save()
+            final = result['token']
+            result = self._sync('/api/1.0/dragables/',
+                                token,
+                                limit=2,
+                                cursor=result['cursor'])
+            # the token of the first page, so the next sync sees the writes
+            self.assertEqual(result['token'], final)
+
+        self.assertEqual(hashes[:5], ['d0', 'd1', 'd2', 'd3', 'd4'])
+        self.assertEqual(set(hashes[5:]), set(['d0']))
+        self.assertEqual(deleted, [])
+
+        response = self.client.get('/api/1.0/dragables/',
+                                   {'since': token, 'cursor': 'nope'})
+        self.assertEqual(response.status_code, 400)
+
+
+    def test_filtered_tombstones(self):
+        other_team = Team(name='other sync team', created_by=self.user)
+        other_team.save()
+        Dragable(hash='o1',
+                 team=other_team,
+                 created_by=self.user,
+                 url='http://www.example.com/',
+                 xpath='foo').save()
+        token = self._token('/api/1.0/dragables/')
+
+        self.client.delete('/api/1.0/dragables/o1/')
+        self.client.delete('/api/1.0/dragables/d1/')
+        self.client.delete('/api/1.0/annotations/a2/')
+
+        result = self._sync('/api/1.0/dragables/', token, team='sync team')
+        self.assertEqual(result['deleted'], ['d1'])
+        result = self._sync('/api/1.0/dragables/', token)
+        self.assertEqual(sorted(result['deleted']), ['d1', 'o1'])
+
+        result = self._sync('/api/1.0/annotations/', token, dragable='d2')
+        self.assertEqual(result['deleted'], ['a2'])
+        result = self._sync('/api/1.0/annotations/', token, dragable='d3')
+        self.assertEqual(result['deleted'], [])
+
+
+    def test_invalid_and_expired_tokens(self):
+        from api.pagination import encode_sync_token
+        from datetime import datetime, timedelta
+
+        response = self.client.get('/api/1.0/dragables/', {'since': 'nope'})
+        self.assertEqual(response.status_code, 400)
+
+        old = datetime.now() - timedelta(days=settings.SYNC_TOMBSTONE_DAYS + 1)
+        response = self.client.get('/api/1.0/dragables/',
+                                   {'since': encode_sync_token(old)})
+        self.assertEqual(response.status_code, 410)
+
+
+class RepresentationCacheTest(TestCase):
+    """
+    Tests for the cached fragments of dragables and annotations
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user('testuser',
+                                             'testuser@example.com',
+                                             'donthackmebro')
+        self.team = Team(name='cache team', created_by=self.user)
+        self.team.save()
+        self.root = self._add_dragable('root')
+        for i in range(10):
+            self._add_dragable('d%d' % i, self.root)
+        self.client = BasicAuthClient('testuser', 'donthackmebro')
+
+
+    def _add_dragable(self, hash, connected_to=None):
+        dragable = Dragable(hash=hash,
+                            team=self.team,
+                            created_by=self.user,
+                            url='http://www.example.com/',
+                            xpath='foo',
+                            connected_to=connected_to)
+        dragable.save()
+        return dragable
+
+
+    def _dragables(self, **params):
+        response = self.client.get('/api/1.0/dragables/', params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+
+    def test_cached_fragments_skip_serialization(self):
+        from django.core.cache import cache
+        cache.clear()
+        first, uncached = count_queries(self.client.get, '/api/1.0/dragables/')
+        second, cached = count_queries(self.client.get, '/api/1.0/dragables/')
+        self.assertEqual(first.content, second.content)
+        # the related users, teams and dragables aren't read anymore
+        self.assert_(cached < uncached)
+
+
+    def test_update(self):
+        self._dragables()
+        dragable = Dragable.objects.get(hash='d3')
+        dragable.title = 'new title'
+        dragable.save()
+        titles = dict([(d['hash'], d['title']) for d in self._dragables()])
+        self.assertEqual(titles['d3'], 'new title')
+
+
+    def test_team_rename(self):
+        self._dragables()
+        self.team.name = 'renamed team'
+        self.team.save()
+        self.assertEqual(set([d['team']['name'] for d in self._dragables()]),
+                         set(['renamed team']))
+
+
+    def test_user_rename(self):
+        self._dragables()
+        self.user.username = 'renamed'
+        self.user.save()
+        client = BasicAuthClient('renamed', 'donthackmebro')
+        response = client.get('/api/1.0/dragables/')
+        dragables = json.loads(response.content)
+        self.assertEqual(set([d['created_by']['username'] for d in dragables]),
+                         set(['renamed']))
+
+
+    def test_rename_leaves_objects(self):
+        from datetime import datetime, timedelta
+        from api.pagination import encode_sync_token
+
+        # the names have their own versions, the objects aren't touched
+        since = encode_sync_token(datetime.now() - timedelta(seconds=1))
+        Dragable.objects.update(updated=datetime.now() - timedelta(days=1))
+        updated = set(Dragable.objects.values_list('updated', flat=True))
+        first = self.client.get('/api/1.0/dragables/', {'limit': 100})
+        self.team.name = 'renamed team'
+        self.team.save()
+        self.user.username = 'renamed'
+        self.user.save()
+
+        self.assertEqual(
+                set(Dragable.objects.values_list('updated', flat=True)),
+                updated)
+        client = BasicAuthClient('renamed', 'donthackmebro')
+        response = client.get('/api/1.0/dragables/',
+                              {'limit': 100},
+                              HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 200)
+        dragables = json.loads(response.content)
+        self.assertEqual(set([(d['team']['name'], d['created_by']['username'])
+                              for d in dragables]),
+                         set([('renamed team', 'renamed')]))
+        result = json.loads(client.get('/api/1.0/dragables/',
+                                       {'since': since}).content)
+        self.assertEqual(result['changed'], [])
+
+
+    def test_user_rename_queries(self):
+        # doesn't depend on the number of objects the user created
+        self.user.username = 'renamed'
+        few = count_queries(self.user.save)[1]
+        for i in range(10):
+            self._add_dragable('more%d' % i)
+        self.user.username = 'renamed again'
+        self.assertEqual(count_queries(self.user.save)[1], few)
+
+
+    def test_formats(self):
+        for format in ('json', 'xml', 'yaml', 'ndjson'):
+            uncached = self.client.get('/api/1.0/dragables/',
+                                       {'format': format}).content
+            cached = self.client.get('/api/1.0/dragables/',
+                                     {'format': format}).content
+            self.assertEqual(uncached, cached)
+            streamed = self.client.get('/api/1.0/dragables/',
+                                       {'format': format,
+                                        'stream': 1}).content
+            self.assertEqual(''.join(streamed), cached)
+
+
+class QueryCountTest(TestCase):
+    """
+    Guards against N+1 queries: the number of queries of every read must not
+    depend on the number of objects returned.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user('testuser',
+                                             'testuser@example.com',
+                                             'donthackmebro')
+        self.team = Team(name='counted team', created_by=self.user)
+        self.team.save()
+        self.root = None
+        self.count = 0
+        self.client = BasicAuthClient('testuser', 'donthackmebro')
+        self._add(2)
+
+
+    def _add(self, count):
+        """
+        Adds ``count`` teams with a member each, and ``count`` dragables with
+        a note and a connection annotation each.
+        """
+        for i in range(self.count, self.count + count):
+            member = User.objects.create_user('member%d' % i,
+                                              'member%d@example.com' % i,
+                                              'donthackmebro')
+            team = Team(name='team %d' % i, created_by=member)
+            team.save()
+            team.members.add(self.user)
+            self.team.members.add(member)
+
+            dragable = Dragable(hash='d%d' % i,
+                                team=self.team,
+                                created_by=member,
+                                url='http://www.example.com/',
+                                title='counted',
+                                xpath='foo',
+                                connected_to=self.root)
+            dragable.save()
+            self.root = self.root or dragable
+            Annotation(hash='n%d' % i,
+                       type='note',
+                       dragable=dragable,
+                       created_by=member,
+                       note='counted').save()
+            Annotation(hash='c%d' % i,
+                       type='connection',
+                       dragable=dragable,
+                       connected_dragable=self.root,
+                       created_by=member).save()
+        self.count += count
+
+
+    def _queries(self, url, params):
+        from django.core.cache import cache
+        cache.clear()
+
+        def get():
+            response = self.client.get(url, params)
+            # streamed responses are rendered while the content is read
+            response.content = ''.join(response)
+            return response
+
+        response, queries = count_queries(get)
+        self.assertEqual(response.status_code, 200)
+        return queries
+
+
+    def assertConstantQueries(self, url, params=None, get_params=None):
+        """
+        Compares the queries of ``url`` for 2 and for 12 objects.
+        ``get_params`` builds the URL parameters from the number of objects.
+        """
+        params = params or {}
+        if get_params:
+            params.update(get_params(self.count))
+        few = self._queries(url, params)
+
+        self._add(10)
+        if get_params:
+            params.update(get_params(self.count))
+        many = self._queries(url, params)
+
+        self.assertEqual(few, many, '%s: %d queries for %d objects, %d for 2'
+                                    % (url, many, self.count, few))
+
+
+    def _hashes(self, prefix):
+        return lambda count: {'hash': ','.join(['%s%d' % (prefix, i)
+                                                for i in range(count)])}
+
+
+    def test_teams(self):
+        self.assertConstantQueries('/api/1.0/teams/', {'limit': 100})
+
+
+    def test_teams_streamed(self):
+        self.assertConstantQueries('/api/1.0/teams/', {'stream': 1})
+
+
+    def test_teams_multi_get(self):
+        self.assertConstantQueries(
+            '/api/1.0/teams/',
+            get_params=lambda count: {'name': ','.join(['team %d' % i
+                                                        for i in range(count)])})
+
+
+    def test_team(self):
+        self.assertConstantQueries('/api/1.0/teams/counted team/')
+
+
+    def test_dragables(self):
+        self.assertConstantQueries('/api/1.0/dragables/', {'limit': 100})
+
+
+    def test_dragables_streamed(self):
+        self.assertConstantQueries('/api/1.0/dragables/', {'stream': 1})
+
+
+    def test_dragables_multi_get(self):
+        self.assertConstantQueries('/api/1.0/dragables/',
+                                   get_params=self._hashes('d'))
+
+
+    def test_dragables_search(self):
+        self.assertConstantQueries('/api/1.0/dragables/',
+                                   {'search': 'counted', 'limit': 100})
+
+
+    def test_dragables_sync(self):
+        from api.pagination import encode_sync_token
+        from datetime import datetime, timedelta
+        self.assertConstantQueries(
+                '/api/1.0/dragables/',
+                {'since': encode_sync_token(datetime.now() - timedelta(1))})
+
+
+    def test_dragable(self):
+        self.assertConstantQueries('/api/1.0/dragables/d1/')
+
+
+    def test_annotations(self):
+        self.assertConstantQueries('/api/1.0/annotations/', {'limit': 100})
+
+
+    def test_annotations_streamed(self):
+        self.assertConstantQueries('/api/1.0/annotations/', {'stream': 1})
+
+
+    def test_annotations_multi_get(self):
+        self.assertConstantQueries('/api/1.0/annotations/',
+                                   get_params=self._hashes('c'))
+
+
+    def test_annotations_search(self):
+        self.assertConstantQueries('/api/1.0/annotations/',
+                                   {'search': 'counted', 'limit': 100})
+
+
+    def test_annotations_sync(self):
+        from api.pagination import encode_sync_token
+        from datetime import datetime, timedelta
+        self.assertConstantQueries(
+                '/api/1.0/annotations/',
+                {'since': encode_sync_token(datetime.now() - timedelta(1))})
+
+
+    def test_annotation(self):
+        self.assertConstantQueries('/api/1.0/annotations/c1/')
+
+
+    def test_graph(self):
+        self.assertConstantQueries('/api/1.0/teams/counted team/graph/')
+
+
+    def test_neighbourhood(self):
+        self.assertConstantQueries('/api/1.0/dragables/d0/neighbourhood/')
+
+
+class MetricsTest(TestCase):
+    """
+    Tests for the request metrics
+    """
+
+    def setUp(self):
+        from core import metrics
+        self.registry = metrics.registry
+        self.registry.reset()
+        self.user = User.objects.create_user('testuser',
+                                             'testuser@example.com',
+                                             'donthackmebro')
+        self.team = Team(name='measured team', created_by=self.user)
+        self.team.save()
+        for i in range(3):
+            Dragable(hash='m%d' % i,
+                     team=self.team,
+                     created_by=self.user,
+                     url='http://www.example.com/',
+                     title='measured',
+                     xpath='foo').save()
+        self.client = BasicAuthClient('testuser', 'donthackmebro')
+
+
+    def _stats(self, name):
+        return self.registry.as_dict()['handlers'][name]
+
+
+    def test_handler_method(self):
+        response = self.client.get('/api/1.0/dragables/')
+        self.assertEqual(response.status_code, 200)
+        self.client.get('/api/1.0/dragables/m0/')
+
+        stats = self._stats('DragableHandler.read')
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['errors'], 0)
+        self.assert_(stats['queries'] > 0)
+        self.assert_(stats['response_bytes'] > len(response.content))
+        self.assertEqual(stats['latency']['buckets'][-1], ['+Inf', 2])
+
+
+    def test_queries(self):
+        from django.core.cache import cache
+        cache.clear()
+
+        def get():
+            return self.client.get('/api/1.0/dragables/')
+        response, queries = count_queries(get)
+        self.assertEqual(self._stats('DragableHandler.read')['queries'],
+                         queries)
+
+
+    def test_streamed(self):
+        response = self.client.get('/api/1.0/dragables/', {'stream': 1})
+        self.assertEqual(self.registry.as_dict()['handlers'], {})
+
+        content = ''.join(response)
+        stats = self._stats('DragableHandler.read')
+        self.assertEqual(stats['requests'], 1)
+        self.assertEqual(stats['response_bytes'], len(content))
+        self.assert_(stats['queries'] > 0)
+
+
+    def test_methods(self):
+        self.client.post('/api/1.0/dragables/',
+                         {'hash': 'm3',
+                          'team': 'measured team',
+                          'url': 'http://www.example.com/',
+                          'title': 'measured',
+                          'xpath': 'foo'})
+        self.assertEqual(self._stats('DragableHandler.create')['requests'], 1)
+
+
+    def test_view(self):
+        client = Client()
+        client.login(username='testuser', password='donthackmebro')
+        response = client.get('/members/')
+        self.assertEqual(response.status_code, 200)
+        stats = self._stats('views.my_dragables')
+        self.assertEqual(stats['requests'], 1)
+        self.assertEqual(stats['response_bytes'], len(response.content))
+
+
+    def test_staff_only(self):
+        response = self.client.get('/api/1.0/_metrics')
+        self.assertEqual(response.status_code, 401)
+
+        self.user.is_staff = True
+        self.user.save()
+        self.client.get('/api/1.0/teams/')
+        response = self.client.get('/api/1.0/_metrics')
+        self.assertEqual(response.status_code, 200)
+        metrics = json.loads(response.content)
+        self.assertEqual(metrics['handlers']['TeamHandler.read']['requests'],
+                         1)
+
+
+    def test_prometheus(self):
+        self.user.is_staff = True
+        self.user.save()
+        self.client.get('/api/1.0/teams/')
+        response = self.client.get('/api/1.0/_metrics/prometheus')
+        self.assertEqual(response.status_code, 200)
+        self.assert_(response['Content-Type'].startswith('text/plain'))
+        self.assert_('minddrag_requests_total{handler="TeamHandler.read"} 1\n'
+                     in response.content)
+        self.assert_('minddrag_request_duration_seconds_bucket'
+                     '{handler="TeamHandler.read",le="+Inf"} 1\n'
+                     in response.content)
+
+
+    def test_disabled(self):
+        settings.METRICS_ENABLED = False
+        try:
+            self.client.get('/api/1.0/teams/')
+        finally:
+            settings.METRICS_ENABLED = True
+        self.assertEqual(self.registry.as_dict()['handlers'], {})
+
+
+class BenchmarkTest(TestCase):
+    """
+    Runs the benchmark scenarios on a little data, so that they keep working
+    when the handlers change.
+    """
+
+    def test_scenarios(self):
+        from api import benchmark
+        counts = benchmark.generate(users=5, teams=2, members=3, dragables=32,
+                                    chain_length=4, annotations=2,
+                                    batch_size=8)
+        self.assertEqual(counts['dragables'], 32)
+        # 8 chains of 4
+        self.assertEqual(Dragable.objects.filter(
+                                    connected_to__isnull=True).count(), 8)
+        self.assertEqual(set(Annotation.objects.values_list('type',
+                                                            flat=True)),
+                         set(benchmark.ANNOTATION_TYPES))
+
+        reports = benchmark.run(benchmark.scenarios(counts, bulk_size=3),
+                                requests=2)
+        for report in reports:
+            for status in report['statuses']:
+                self.assert_(int(status) < 400,
+                             '%s: %s' % (report['name'], report['statuses']))
+            self.assert_(report['queries'] > 0, report['name'])
+            self.assert_(report['latency_ms']['p99'] >=
+                         report['latency_ms']['p50'])
+            self.assert_(report['memory_kb'] >= 0, report['name'])
+
+
+class TokenTest(TestCase):
+    """
+    Tests for the API tokens
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user('testuser',
+                                             'testuser@example.com',
+                                             'donthackmebro')
+        self.client = BasicAuthClient('testuser', 'donthackmebro')
+
+
+    def _issue(self, name='laptop'):
+        response = self.client.post('/api/1.0/tokens/', {'name': name})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+
+    def _get(self, url, token):
+        return Client().get(url, HTTP_AUTHORIZATION='Token %s' % token)
+
+
+    def test_issue(self):
+        from hashlib import sha256
+        from core.models import ApiToken
+        token = self._issue()
+        self.assertEqual(token['name'], 'laptop')
+
+        api_token = ApiToken.objects.get(pk=token['id'])
+        self.assertEqual(api_token.user, self.user)
+        self.assertEqual(api_token.digest,
+                         sha256(token['token']).hexdigest())
+
+        response = self._get('/api/1.0/dragables/', token['token'])
+        self.assertEqual(response.status_code, 200)
+
+
+    def test_list(self):
+        self._issue('laptop')
+        self._issue('phone')
+        tokens = json.loads(self.client.get('/api/1.0/tokens/').content)
+        self.assertEqual([t['name'] for t in tokens], ['laptop', 'phone'])
+        self.assertEqual(set(tokens[0].keys()), set(['id', 'name', 'created']))
+
+
+    def test_token_cannot_issue_tokens(self):
+        token = self._issue()
+        response = Client().post('/api/1.0/tokens/',
+                                 HTTP_AUTHORIZATION='Token %s'
+                                                    % token['token'])
+        self.assertEqual(response.status_code, 401)
+
+
+    def test_unknown_token(self):
+        response = self._get('/api/1.0/dragables/', 'nonsense')
+        self.assertEqual(response.status_code, 401)
+
+
+    def test_cached(self):
+        from core.tokens import get_token_user
+        token = self._issue()['token']
+        user, queries = count_queries(get_token_user, token)
+        self.assertEqual(user, self.user)
+        self.assertEqual(queries, 1)
+
+        user, queries = count_queries(get_token_user, token)
+        self.assertEqual(user, self.user)
+        self.assertEqual(queries, 0)
+
+
+    def test_shared_cache(self):
+        from core import tokens
+        token = self._issue()['token']
+        tokens.get_token_user(token)
+        # another process
+        tokens._local_cache.clear()
+        user, queries = count_queries(tokens.get_token_user, token)
+        self.assertEqual(user, self.user)
+        self.assertEqual(queries, 0)
+
+
+    def test_revoke(self):
+        token = self._issue()
+        self.assertEqual(self._get('/api/1.0/dragables/',
+                                   token['token']).status_code, 200)
+
+        response = self.client.delete('/api/1.0/tokens/%d/' % token['id'])
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self._get('/api/1.0/dragables/',
+                                   token['token']).status_code, 401)
+
+
+    def test_revoke_foreign_token(self):
+        token = self._issue()
+        User.objects.create_user('other', 'other@example.com', 'donthackmebro')
+        response = BasicAuthClient('other', 'donthackmebro').delete(
+                                        '/api/1.0/tokens/%d/' % token['id'])
+        self.assertEqual(response.status_code, 404)
+
+
+    def test_deactivated_user(self):
+        token = self._issue()['token']
+        self.assertEqual(self._get('/api/1.0/dragables/', token).status_code, 200)
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self._get('/api/1.0/dragables/', token).status_code, 401)
+
+
+class SingleQueryReadTest(TestCase):
+    """
+    Reads of one object decide between found, forbidden and missing and
+    fetch the object with one query.
+    """
+
+    def setUp(self):
+        from core.tokens import issue_token
+        self.user = User.objects.create_user('testuser',
+                                             'testuser@example.com',
+                                             'donthackmebro')
+        other = User.objects.create_user('other',
+                                         'other@example.com',
+                                         'donthackmebro')
+        self.team = Team(name='my team', created_by=self.user)
+        self.team.save()
+        other_team = Team(name='other team', created_by=other)
+        other_team.save()
+
+        for hash, team, user in (('mine', self.team, self.user),
+                                 ('theirs', other_team, other)):
+            dragable = Dragable(hash=hash,
+                                team=team,
+                                created_by=user,
+                                url='http://www.example.com/',
+                                title='single',
+                                xpath='foo')
+            dragable.save()
+            Annotation(hash='%s_note' % hash,
+                       type='note',
+                       dragable=dragable,
+                       created_by=user,
+                       note='single').save()
+
+        # token authentication doesn't query once the token is cached
+        token = issue_token(self.user)[0]
+        self.client = Client(HTTP_AUTHORIZATION='Token %s' % token)
+
+
+    def _queries(self, url):
+        # warms up the caches
+        self.client.get(url)
+        response, queries = count_queries(self.client.get, url)
+        return response.status_code, queries
+
+
+    def test_dragable(self):
+        self.assertEqual(self._queries('/api/1.0/dragables/mine/'), (200, 1))
+        self.assertEqual(self._queries('/api/1.0/dragables/theirs/'),
+                         (401, 1))
+        self.assertEqual(self._queries('/api/1.0/dragables/missing/'),
+                         (404, 1))
+
+
+    def test_annotation(self):
+        self.assertEqual(self._queries('/api/1.0/annotations/mine_note/'),
+                         (200, 1))
+        self.assertEqual(self._queries('/api/1.0/annotations/theirs_note/'),
+                         (401, 1))
+        self.assertEqual(self._queries('/api/1.0/annotations/missing/'),
+                         (404, 1))
+
+
+    def test_team(self):
+        # the team, and its creator and members for serializing it
+        self.assertEqual(self._queries('/api/1.0/teams/my team/'), (200, 3))
+        self.assertEqual(self._queries('/api/1.0/teams/missing/'), (404, 1))
+
+
+    def test_lists_do_not_count(self):
+        from django.db import connection
+        for url in ('/api/1.0/dragables/?team=my+team',
+                    '/api/1.0/annotations/?dragable=mine',
+                    '/api/1.0/teams/'):
+            response, queries = count_queries(self.client.get, url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([q for q in connection.queries
+                              if 'COUNT(' in q['sql']], [], url)
+
+
+class VisibilityTest(TestCase):
+    """
+    Lists are restricted to the teams of the user by their team ids, or by a
+    membership subquery for users in many teams.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user('testuser',
+                                             'testuser@example.com',
+                                             'donthackmebro')
+        other = User.objects.create_user('other',
+                                         'other@example.com',
+                                         'donthackmebro')
+
+        for name, members in (('first', (self.user, other)),
+                              ('second', (self.user, other)),
+                              ('other', (other,))):
+            team = Team(name=name, created_by=members[0])
+            team.save()
+            for member in members:
+                team.members.add(member)
+
+            dragable = Dragable(hash='%s_dragable' % name,
+                                team=team,
+                                created_by=members[0],
+                                url='http://www.example.com/',
+                                title=name,
+                                xpath='foo')
+            dragable.save()
+            Annotation(hash='%s_note' % name,
+                       type='note',
+                       dragable=dragable,
+                       created_by=members[0],
+                       note=name).save()
+
+        self.client = BasicAuthClient('testuser', 'donthackmebro')
+        self.old_max = settings.API_VISIBILITY_MAX_TEAM_IDS
+
+
+    def tearDown(self):
+        settings.API_VISIBILITY_MAX_TEAM_IDS = self.old_max
+
+
+    def _hashes(self, url):
+        from django.db import connection
+        response, queries = count_queries(self.client.get, url)
+        self.assertEqual(response.status_code, 200)
+        self.failIf([q for q in connection.queries
+                     if 'auth_user' in q['sql'] and 'core_dragable' in q['sql']])
+        content = json.loads(response.content)
+        if isinstance(content, dict):
+            content = content['changed']
+        return sorted([item['hash'] for item in content]), connection.queries
+
+
+    def _test_lists(self):
+        for url, hashes in (
+                ('/api/1.0/dragables/',
+                 ['first_dragable', 'second_dragable']),
+                ('/api/1.0/annotations/',
+                 ['first_note', 'second_note']),
+                ('/api/1.0/dragables/?since=%s' % self._token(),
+                 ['first_dragable', 'second_dragable']),
+                ('/api/1.0/annotations/?since=%s' % self._token(),
+                 ['first_note', 'second_note'])):
+            found, queries = self._hashes(url)
+            # members of several teams don't duplicate the rows
+            self.assertEqual(found, hashes, url)
+            yield queries
+
+
+    def _token(self):
+        from datetime import datetime
+        from datetime import timedelta
+        from api.pagination import encode_sync_token
+        return encode_sync_token(datetime.now() - timedelta(minutes=1))
+
+
+    def test_team_ids(self):
+        for queries in self._test_lists():
+            self.failIf([q for q in queries
+                         if 'core_team_members' in q['sql']
+                            and 'core_dragable' in q['sql']])
+
+
+    def test_subquery(self):
+        settings.API_VISIBILITY_MAX_TEAM_IDS = 1
+        for queries in self._test_lists():
+            self.failUnless([q for q in queries
+                             if 'core_team_members' in q['sql']
+                                and 'core_dragable' in q['sql']])
+
+
+    def test_team_ids_resolved_once(self):
+        from api import visibility
+
+        calls = []
+        old_get_team_ids = visibility.get_team_ids
+        def get_team_ids(user):
+            calls.append(user)
+            return old_get_team_ids(user)
+        visibility.get_team_ids = get_team_ids
+        try:
+            self.client.get('/api/1.0/dragables/?since=%s' % self._token())
+        finally:
+            visibility.get_team_ids = old_get_team_ids
+        self.assertEqual(len(calls), 1)
+
+
+class WriteBehindTest(TestCase):
+    """
+    Creates through the write-behind buffer. The buffer runs without its
+    thread here, the test database only exists in this thread.
+    """
+
+    def setUp(self):
+        from core import writebehind
+        self.user = User.objects.create_user('testuser',
+                                             'testuser@example.com',
+                                             'donthackmebro')
+        Team(name='team', created_by=self.user).save()
+        self.client = BasicAuthClient('testuser', 'donthackmebro')
+
+        self.old_settings = (settings.WRITE_BEHIND_ENABLED,
+                             settings.WRITE_BEHIND_DURABILITY,
+                             settings.WRITE_BEHIND_ENQUEUE_TIMEOUT,
+                             settings.WRITE_BEHIND_COMMIT_TIMEOUT)
+        settings.WRITE_BEHIND_ENABLED = True
+        settings.WRITE_BEHIND_ENQUEUE_TIMEOUT = 0.01
+        self.old_buffer = writebehind._buffer
+        self.buffer = writebehind._buffer = writebehind.WriteBuffer(
+                                                3, 10, background=False)
+
+
+    def tearDown(self):
+        from core import writebehind
+        (settings.WRITE_BEHIND_ENABLED,
+         settings.WRITE_BEHIND_DURABILITY,
+         settings.WRITE_BEHIND_ENQUEUE_TIMEOUT,
+         settings.WRITE_BEHIND_COMMIT_TIMEOUT) = self.old_settings
+        writebehind._buffer = self.old_buffer
+
+
+    def _create_dragable(self, hash):
+        return self.client.post('/api/1.0/dragables/',
+                                {'hash': hash,
+                                 'team': 'team',
+                                 'url': 'http://www.example.com/',
+                                 'xpath': 'foo'}).status_code
+
+
+    def _create_annotation(self, hash, dragable):
+        return self.client.post('/api/1.0/annotations/',
+                                {'hash': hash,
+                                 'dragable': dragable,
+                                 'type': 'note',
+                                 'note': 'queued'}).status_code
+
+
+    def test_commit(self):
+        settings.WRITE_BEHIND_DURABILITY = 'commit'
+        self.assertEqual(self._create_dragable('d1'), 201)
+        # acknowledged after the commit
+        self.failUnless(Dragable.objects.filter(hash='d1').exists())
+        self.assertEqual(self._create_annotation('a1', 'd1'), 201)
+        self.assertEqual(Annotation.objects.get(hash='a1').dragable.hash, 'd1')
+
+        # failures are reported
+        self.assertEqual(self._create_dragable('d1'), 400)
+        self.assertEqual(Dragable.objects.filter(hash='d1').count(), 1)
+
+
+    def test_commit_timeout(self):
+        settings.WRITE_BEHIND_DURABILITY = 'commit'
+        settings.WRITE_BEHIND_COMMIT_TIMEOUT = 0.01
+
+        # nothing is written in time, the dragable is taken out of the queue
+        self.buffer.flush = lambda: None
+        self.assertEqual(self._create_dragable('d1'), 503)
+        self.failIf(self.buffer.pending(Dragable, 'd1'))
+        del self.buffer.flush
+        self.buffer.flush()
+        self.failIf(Dragable.objects.filter(hash='d1').exists())
+
+        # the batch is taken, but not written in time
+        self.buffer.flush = lambda: self.buffer._take(block=False)
+        self.assertEqual(self._create_dragable('d2'), 202)
+
+
+    def test_enqueue(self):
+        settings.WRITE_BEHIND_DURABILITY = 'enqueue'
+        self.assertEqual(self._create_dragable('d1'), 201)
+        self.failIf(Dragable.objects.filter(hash='d1').exists())
+
+        # the queued dragable can be annotated, queued hashes are taken
+        self.assertEqual(self._create_annotation('a1', 'd1'), 201)
+        self.assertEqual(self._create_annotation('a1', 'd1'), 400)
+        self.assertEqual(self._create_annotation('a2', 'missing'), 400)
+
+        self.buffer.flush()
+        self.assertEqual(Annotation.objects.get(hash='a1').dragable,
+                         Dragable.objects.get(hash='d1'))
+        self.failIf(self.buffer.pending(Dragable, 'd1'))
+
+
+    def test_failed_batch(self):
+        settings.WRITE_BEHIND_DURABILITY = 'enqueue'
+        self.assertEqual(self._create_dragable('d1'), 201)
+        self.buffer.flush()
+
+        # the duplicate fails the batch, the other one is saved anyway
+        self.assertEqual(self._create_dragable('d1'), 201)
+        self.assertEqual(self._create_dragable('d2'), 201)
+        self.buffer.flush()
+        self.assertEqual(sorted(Dragable.objects.values_list('hash',
+                                                             flat=True)),
+                         ['d1', 'd2'])
+
+
+    def test_backpressure(self):
+        settings.WRITE_BEHIND_DURABILITY = 'enqueue'
+        for hash in ('d1', 'd2', 'd3'):
+            self.assertEqual(self._create_dragable(hash), 201)
+        self.assertEqual(self._create_dragable('d4'), 503)
+        self.failIf(self.buffer.pending(Dragable, 'd4'))
+
+        self.buffer.flush()
+        self.assertEqual(self._create_dragable('d4'), 201)
+        self.buffer.flush()
+        self.assertEqual(Dragable.objects.count(), 4)
+
+
+    def test_batches(self):
+        from core.signals import post_bulk_save
+
+        settings.WRITE_BEHIND_DURABILITY = 'enqueue'
+        for hash in ('d1', 'd2', 'd3'):
+            self._create_dragable(hash)
+
+        batches = []
+        def bulk_saved(sender, instances, **kwargs):
+            batches.append([instance.hash for instance in instances])
+        post_bulk_save.connect(bulk_saved, sender=Dragable)
+        try:
+            self.buffer.flush()
+        finally:
+            post_bulk_save.disconnect(bulk_saved, sender=Dragable)
+        self.assertEqual(batches, [['d1', 'd2', 'd3']])
+
+
+class ReplicaTest(TestCase):
+    """
+    Reads from a second SQLite database as the replica, which is a copy of
+    the default database from the start of the test.
+    """
+
+    def setUp(self):
+        import os
+        import tempfile
+        from django.db import connections
+
+        self.user = User.objects.create_user('testuser',
+                                             'testuser@example.com',
+                                             'donthackmebro')
+        self.team = Team(name='team', created_by=self.user)
+        self.team.save()
+        Dragable(hash='d1',
+                 team=self.team,
+                 created_by=self.user,
+                 url='http://www.example.com/',
+                 title='replicated',
+                 xpath='foo').save()
+
+        handle, self.replica_name = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        connections.databases['replica'] = dict(
+                                        connections.databases['default'],
+                                        NAME=self.replica_name)
+        self._replicate()
+
+        self.old_replicas = settings.DATABASE_REPLICAS
+        settings.DATABASE_REPLICAS = ['replica']
+        self.client = BasicAuthClient('testuser', 'donthackmebro')
+
+
+    def tearDown(self):
+        import os
+        from django.core.cache import cache
+        from django.db import connections
+        from core import routers
+
+        settings.DATABASE_REPLICAS = self.old_replicas
+        cache.delete(routers._pin_key(self.user.id))
+        connections['replica'].close()
+        del connections._connections['replica']
+        del connections.databases['replica']
+        os.remove(self.replica_name)
+
+
+    def _replicate(self):
+        from django.core.management.color import no_style
+        from django.db import connections
+
+        primary = connections['default'].cursor()
+        replica = connections['replica']
+        cursor = replica.cursor()
+
+        for model in (User, Team, Team.members.through, Dragable,
+                      Annotation):
+            for statement in replica.creation.sql_create_model(
+                                                        model, no_style())[0]:
+                cursor.execute(statement)
+
+            table = model._meta.db_table
+            primary.execute('SELECT * FROM %s' % table)
+            for row in primary.fetchall():
+                cursor.execute('INSERT INTO %s VALUES (%s)'
+                               % (table, ', '.join(['%s'] * len(row))),
+                               row)
+
+
+    def _title(self, hash):
+        # multi-gets aren't versioned, they may be read from the replica
+        response = self.client.get('/api/1.0/dragables/', {'hash': hash})
+        if response.status_code != 200:
+            return response.status_code
+        item = json.loads(response.content)[0]
+        if item['status'] != 'found':
+            return item['status']
+        return item['dragable']['title']
+
+
+    def test_reads(self):
+        # the replica lags behind
+        Dragable.objects.filter(hash='d1').update(title='primary')
+        self.assertEqual(self._title('d1'), 'replicated')
+
+        client = Client()
+        client.login(username='testuser', password='donthackmebro')
+        response = client.get('/members/')
+        self.assertContains(response, 'replicated')
+        self.assertNotContains(response, 'primary')
+
+
+    def test_read_your_writes(self):
+        from django.core.cache import cache
+        from core import routers
+
+        response = self.client.post('/api/1.0/dragables/',
+                                    {'hash': 'd2',
+                                     'team': 'team',
+                                     'url': 'http://www.example.com/',
+                                     'title': 'written',
+                                     'xpath': 'foo'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self._title('d2'), 'written')
+        self.assertEqual(self._title('d1'), 'replicated')
+
+        # once the pin is gone, d2 isn't replicated yet
+        cache.delete(routers._pin_key(self.user.id))
+        self.assertEqual(self._title('d2'), 'missing')
+
+
+    def test_token_from_primary(self):
+        from core.tokens import issue_token
+
+        # not replicated yet, or revoked on the primary only
+        token, api_token = issue_token(self.user)
+        client = Client(HTTP_AUTHORIZATION='Token %s' % token)
+        response = client.get('/api/1.0/dragables/', {'hash': 'd1'})
+        self.assertEqual(response.status_code, 200)
+
+        api_token.delete()
+        response = client.get('/api/1.0/dragables/', {'hash': 'd1'})
+        self.assertEqual(response.status_code, 401)
+
+
+    def test_versioned_reads(self):
+        from django.http import HttpRequest
+        from core import routers
+        from core.graph import get_team_graph
+        from core.models import get_team_ids
+        from core.versions import bump_team_versions
+
+        Dragable.objects.filter(hash='d1').update(title='primary')
+        bump_team_versions([self.team.pk])
+
+        # the ETag names the current version, so the content must be current
+        response = self.client.get('/api/1.0/dragables/d1/')
+        self.assertEqual(json.loads(response.content)[0]['title'], 'primary')
+        response = self.client.get('/api/1.0/dragables/?format=ndjson')
+        self.assertEqual(
+                [json.loads(line)['title']
+                 for line in ''.join(response._container).splitlines()],
+                ['primary'])
+
+        # cached under the current version, or deciding permissions
+        request = HttpRequest()
+        request.user = self.user
+        routers.start_reading(request)
+        try:
+            graph = get_team_graph(self.team.pk)
+            self.team.members.clear()
+            self.failIf(get_team_ids(self.user))
+        finally:
+            routers.stop_reading()
+        self.assertEqual(graph['nodes'][0]['title'], 'primary')
+
+
+    def _age(self):
+        # the last changes of the team and the memberships are older than the
+        # lag of the replicas
+        import time
+        from django.core.cache import cache
+        from core.models import _changed_key
+        from core.versions import ALL_TEAMS
+        from core.versions import _modified_key
+
+        for team_id in (self.team.pk, ALL_TEAMS):
+            cache.set(_modified_key(team_id), time.time() - 60)
+        cache.delete(_changed_key(self.user.id))
+
+
+    def test_versioned_reads_from_replica(self):
+        from django.core.cache import cache
+        from django.http import HttpRequest
+        from core import routers
+        from core.graph import get_team_graph
+        from core.models import _generation_key
+        from core.models import get_team_ids
+
+        # the replica lags behind, without a change the versions know of
+        Dragable.objects.filter(hash='d1').update(title='primary')
+        self._age()
+
+        response = self.client.get('/api/1.0/dragables/')
+        self.assertEqual([d['title'] for d in json.loads(response.content)],
+                         ['replicated'])
+        response = self.client.get('/api/1.0/teams/')
+        self.assertEqual(response.status_code, 200)
+
+        request = HttpRequest()
+        request.user = self.user
+        routers.start_reading(request)
+        try:
+            graph = get_team_graph(self.team.pk)
+            Team.members.through.objects.filter(user=self.user).delete()
+            cache.delete(_generation_key(self.user.id))
+            team_ids = get_team_ids(self.user)
+        finally:
+            routers.stop_reading()
+        self.assertEqual(graph['nodes'][0]['title'], 'replicated')
+        self.assertEqual(team_ids, frozenset([self.team.pk]))
+
+
+class CompressionTest(TestCase):
+    """
+    Tests for the gzip compressed responses and their cache
+    """
+
+    def setUp(self):
+        self.client = create_paginated_team(20)
+        self.old_min_length = settings.COMPRESSION_MIN_LENGTH
+        settings.COMPRESSION_MIN_LENGTH = 1024
+
+
+    def tearDown(self):
+        settings.COMPRESSION_MIN_LENGTH = self.old_min_length
+
+
+    def _decompress(self, content):
+        import gzip
+        from StringIO import StringIO
+        return gzip.GzipFile(fileobj=StringIO(content)).read()
+
+
+    def test_negotiation(self):
+        from django.http import HttpRequest
+        from core.compression import accepts_gzip
+
+        for header, accepted in (('', False),
+                                 ('gzip', True),
+                                 ('deflate, gzip;q=0.5', True),
+                                 ('GZIP;Q=1.0', True),
+                                 ('gzip;q=0', False),
+                                 ('deflate', False),
+                                 ('*', True),
+                                 ('*;q=0.1, gzip;q=0', False),
+                                 ('identity, *;q=0', False),
+                                 ('x-gzip', True)):
+            request = HttpRequest()
+            request.META['HTTP_ACCEPT_ENCODING'] = header
+            self.assertEqual(accepts_gzip(request), accepted, header)
+
+
+    def test_compressed(self):
+        plain = self.client.get('/api/1.0/dragables/', {'limit': 20})
+        self.failIf(plain.has_header('Content-Encoding'))
+        self.assert_('Accept-Encoding' in plain['Vary'])
+
+        response = self.client.get('/api/1.0/dragables/',
+                                   {'limit': 20},
+                                   HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assert_('Accept-Encoding' in response['Vary'])
+        self.assertEqual(response['Content-Length'],
+                         str(len(response.content)))
+        # the variants have their own ETags
+        self.assertEqual(response['ETag'], plain['ETag'][:-1] + '-gzip"')
+        self.assert_(len(response.content) < len(plain.content))
+        self.assertEqual(self._decompress(response.content), plain.content)
+
+        # either one is current
+        for etag in (plain['ETag'], response['ETag']):
+            not_modified = self.client.get('/api/1.0/dragables/',
+                                           {'limit': 20},
+                                           HTTP_ACCEPT_ENCODING='gzip',
+                                           HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(not_modified.status_code, 304)
+            self.assertEqual(not_modified['ETag'], etag)
+
+
+    def test_below_threshold(self):
+        response = self.client.get('/api/1.0/dragables/page0/',
+                                   HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assert_(len(response.content) < 1024)
+        self.failIf(response.has_header('Content-Encoding'))
+
+
+    def test_errors_not_compressed(self):
+        response = self.client.get('/api/1.0/dragables/nonexistent/',
+                                   HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 404)
+        self.failIf(response.has_header('Content-Encoding'))
+
+
+    def test_streamed(self):
+        plain = self.client.get('/api/1.0/annotations/',
+                                {'format': 'ndjson'}).content
+        self.assertEqual(len(plain.splitlines()), 20)
+        # streamed responses are compressed however short they are
+        settings.COMPRESSION_MIN_LENGTH = 10 ** 6
+        response = self.client.get('/api/1.0/annotations/',
+                                   {'format': 'ndjson'},
+                                   HTTP_ACCEPT_ENCODING='gzip')
+        self.assert_(response.streaming)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.failIf(response.has_header('Content-Length'))
+        self.assertEqual(self._decompress(response.content), plain)
+
+
+    def test_cached(self):
+        from core import compression
+
+        url = '/api/1.0/dragables/'
+        first = self.client.get(url, {'limit': 20}, HTTP_ACCEPT_ENCODING='gzip')
+        compress = compression.compress
+        calls = []
+        def counting_compress(data):
+            calls.append(data)
+            return compress(data)
+        compression.compress = counting_compress
+        try:
+            # the handler isn't called, authenticating the user is all
+            response, queries = count_queries(self.client.get,
+                                              url,
+                                              {'limit': 20},
+                                              HTTP_ACCEPT_ENCODING='gzip')
+        finally:
+            compression.compress = compress
+
+        self.assertEqual(queries, 1)
+        self.assertEqual(calls, [])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, first.content)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Type'], first['Content-Type'])
+        self.assertEqual(response['ETag'], first['ETag'])
+        self.assert_(response['ETag'].endswith('-gzip"'))
+        self.assert_('Accept-Encoding' in response['Vary'])
+        self.assertEqual(response['X-Sync-Token'], first['X-Sync-Token'])
+
+
+    def test_cached_until_write(self):
+        url = '/api/1.0/dragables/'
+        first = self.client.get(url, {'limit': 20}, HTTP_ACCEPT_ENCODING='gzip')
+        dragable = Dragable.objects.get(hash='page3')
+        dragable.title = 'new title'
+        dragable.save()
+        response = self.client.get(url,
+                                   {'limit': 20},
+                                   HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotEqual(response['ETag'], first['ETag'])
+        self.assert_('new title' in self._decompress(response.content))
+
+
+class MessagePackTest(TestCase):
+    """
+    Tests for the MessagePack emitter and parser
+    """
+
+    def setUp(self):
+        self.client = create_paginated_team(5)
+        self.hashes = ['page%d' % i for i in range(5)]
+
+
+    def _get(self, url, **params):
+        params['format'] = 'msgpack'
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-msgpack')
+        return response.content
+
+
+    def test_list(self):
+        from datetime import datetime
+        from api import messagepack
+        content = self._get('/api/1.0/dragables/')
+        dragables = messagepack.unpackb(content)
+        self.assertEqual([d['hash'] for d in dragables], self.hashes)
+        self.assertEqual(dragables[0]['team']['name'], 'paginated team')
+
+        created = Dragable.objects.get(hash='page0').created
+        self.assertEqual(datetime.fromtimestamp(dragables[0]['created']),
+                         created.replace(microsecond=0))
+
+        as_json = self.client.get('/api/1.0/dragables/').content
+        self.assertEqual([d['title'] for d in json.loads(as_json)],
+                         [d['title'] for d in dragables])
+        self.assert_(len(content) < len(as_json) / 2)
+
+
+    def test_interned(self):
+        from api import messagepack
+        content = self._get('/api/1.0/annotations/')
+        annotations = messagepack.unpackb(content)
+        self.assertEqual(len(annotations), 5)
+        self.assertEqual(set([a['created_by']['username']
+                              for a in annotations]),
+                         set(['testuser']))
+        # sent once, referenced afterwards
+        self.assertEqual(content.count('testuser'), 1)
+        self.assertEqual(content.count('created_by'), 1)
+
+
+    def test_cached_fragments(self):
+        first = self._get('/api/1.0/dragables/')
+        second = self._get('/api/1.0/dragables/')
+        self.assertEqual(first, second)
+
+
+    def test_splice(self):
+        from api import messagepack
+        data = {'hash': 'spliced',
+                'created_by': {'username': 'testuser'},
+                'number': 1,
+                'tags': ['testuser', 'x']}
+        fragment = messagepack.pack_fragment(data)
+        interner = messagepack.Interner()
+        first = interner.splice(fragment)
+        second = interner.splice(fragment)
+
+        unpacker = messagepack.unpacker()
+        unpacker.feed(first + second)
+        self.assertEqual(list(unpacker), [data, data])
+        # the strings of the second one are references only
+        self.assertEqual(first.count('testuser'), 1)
+        self.failIf('testuser' in second)
+
+
+    def test_single(self):
+        from api import messagepack
+        content = self._get('/api/1.0/dragables/page2/')
+        dragables = messagepack.unpackb(content)
+        self.assertEqual(dragables[0]['title'], 'dragable 2')
+
+
+    def test_streamed(self):
+        from api import messagepack
+        response = self.client.get('/api/1.0/annotations/',
+                                   {'format': 'msgpack', 'stream': 1})
+        self.assert_(response.streaming)
+        unpacker = messagepack.unpacker()
+        unpacker.feed(response.content)
+        annotations = list(unpacker)
+        self.assertEqual([a['hash'] for a in annotations],
+                         ['page_note%d' % i for i in range(5)])
+        self.assertEqual([a['created_by']['username'] for a in annotations],
+                         ['testuser'] * 5)
+
+
+    def test_parser(self):
+        from api import messagepack
+        interner = messagepack.Interner()
+        body = interner.pack([{'hash': 'packed%d' % i,
+                               'team': 'paginated team',
+                               'url': 'http://www.example.com/',
+                               'xpath': 'foo/bar',
+                               'title': 'packed %d' % i}
+                              for i in range(2)])
+        response = self.client.post('/api/1.0/bulk/dragables/',
+                                    body,
+                                    content_type='application/x-msgpack')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Dragable.objects.get(hash='packed1').title,
+                         'packed 1')
+
+
+    def test_parser_single(self):
+        from api import messagepack
+        response = self.client.post('/api/1.0/dragables/',
+                                    messagepack.packb({
+                                        'hash': 'packed',
+                                        'team': 'paginated team',
+                                        'url': 'http://www.example.com/',
+                                        'xpath': 'foo/bar',
+                                        'title': 'packed'}),
+                                    content_type='application/x-msgpack')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Dragable.objects.get(hash='packed').title, 'packed')
+
+        response = self.client.put('/api/1.0/dragables/packed/',
+                                   messagepack.packb({'title': 'repacked'}),
+                                   content_type='application/x-msgpack')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Dragable.objects.get(hash='packed').title,
+                         'repacked')
+
+
+    def test_parser_types(self):
+        from api import messagepack
+        body = {'hash': 'typed',
+                'team': 'paginated team',
+                'url': 'http://www.example.com/',
+                'xpath': 'foo/bar'}
+        for title in (None, ['list'], {'a': 'map'}, True):
+            body['title'] = title
+            response = self.client.post('/api/1.0/dragables/',
+                                        messagepack.packb(body),
+                                        content_type='application/x-msgpack')
+            self.assertEqual(response.status_code, 400, repr(title))
+
+        body['title'] = 42
+        response = self.client.post('/api/1.0/dragables/',
+                                    messagepack.packb(body),
+                                    content_type='application/x-msgpack')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Dragable.objects.get(hash='typed').title, '42')
+
+        response = self.client.put('/api/1.0/teams/paginated team/',
+                                   messagepack.packb({'password': 1234}),
+                                   content_type='application/x-msgpack')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.put('/api/1.0/teams/paginated team/',
+                                   messagepack.packb({'password': None}),
+                                   content_type='application/x-msgpack')
+        self.assertEqual(response.status_code, 400)
+
+
+    def test_dates(self):
+        from datetime import date
+        from datetime import datetime
+        from datetime import timedelta
+        from datetime import tzinfo
+        from api import messagepack
+
+        class Offset(tzinfo):
+            def utcoffset(self, value):
+                return timedelta(hours=2)
+
+        self.assertEqual(messagepack._default(date(1970, 1, 2)), 86400)
+        self.assertEqual(messagepack._default(datetime(1970, 1, 1, 3,
+                                                       tzinfo=Offset())),
+                         3600)
+        # TIME_ZONE is Europe/Berlin, summer and winter time
+        self.assertEqual(messagepack._default(datetime(2010, 7, 1, 12)),
+                         messagepack._default(datetime(2010, 7, 1, 12,
+                                                       tzinfo=Offset())))
+        self.assertEqual(messagepack._default(datetime(2010, 1, 1, 12)),
+                         messagepack._default(datetime(2010, 1, 1, 13,
+                                                       tzinfo=Offset())))
+
+
+    def test_parser_invalid(self):
+        response = self.client.post('/api/1.0/bulk/dragables/',
+                                    '\xd4\x02\x05',
+                                    content_type='application/x-msgpack')
+        self.assertEqual(response.status_code, 400)
+
+
+class FieldsetTest(TestCase):
+    """
+    Tests for the sparse fieldsets (``fields`` URL parameter)
+    """
+
+    def setUp(self):
+        self.client = create_paginated_team(5)
+
+
+    def _get(self, url, params):
+        from django.db import connection
+        old_debug = settings.DEBUG
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            response = self.client.get(url, params)
+            content = response.content
+            return response, content, [q['sql'] for q in connection.queries]
+        finally:
+            settings.DEBUG = old_debug
+
+
+    def test_list(self):
+        response, content, queries = self._get('/api/1.0/dragables/',
+                                               {'fields': 'hash,title,updated'})
+        self.assertEqual(response.status_code, 200)
+        dragables = json.loads(content)
+        self.assertEqual(len(dragables), 5)
+        for dragable in dragables:
+            self.assertEqual(sorted(dragable.keys()),
+                             ['hash', 'title', 'updated'])
+        self.assertEqual(dragables[2]['title'], 'dragable 2')
+
+        selects = [sql for sql in queries if 'core_dragable' in sql]
+        self.assertEqual(len(selects), 1)
+        self.failIf('"text"' in selects[0] or 'xpath' in selects[0])
+        # no related objects are loaded
+        self.failIf([sql for sql in queries if 'FROM "core_team"' in sql])
+
+
+    def test_full_representation_unchanged(self):
+        self.client.get('/api/1.0/dragables/', {'fields': 'hash'})
+        dragables = json.loads(self.client.get('/api/1.0/dragables/').content)
+        self.assertEqual(dragables[0]['team'], {'name': 'paginated team'})
+        self.assertEqual(dragables[0]['xpath'], 'foo/bar')
+
+
+    def test_related(self):
+        response, content, queries = self._get('/api/1.0/dragables/',
+                                               {'fields': 'hash,created_by'})
+        dragables = json.loads(content)
+        self.assertEqual(dragables[0], {'hash': 'page0',
+                                        'created_by': {'username': 'testuser'}})
+        self.assert_([sql for sql in queries if 'FROM "auth_user"' in sql])
+        self.failIf([sql for sql in queries if 'FROM "core_team"' in sql])
+
+
+    def test_unknown_field(self):
+        for fields in ('hash,password', 'nosuchfield', ','):
+            response = self.client.get('/api/1.0/dragables/',
+                                       {'fields': fields})
+            self.assertEqual(response.status_code, 400)
+
+
+    def test_single(self):
+        response, content, queries = self._get('/api/1.0/dragables/page1/',
+                                               {'fields': 'title'})
+        self.assertEqual(json.loads(content), [{'title': 'dragable 1'}])
+        response, full_content, full_queries = self._get(
+                                                '/api/1.0/dragables/page1/',
+                                                {})
+        self.assert_(len(queries) < len(full_queries))
+
+
+    def test_streamed(self):
+        response, content, queries = self._get('/api/1.0/annotations/',
+                                               {'fields': 'hash,note',
+                                                'format': 'ndjson'})
+        self.assertEqual([json.loads(line) for line in content.splitlines()],
+                         [{'hash': 'page_note%d' % i, 'note': 'note %d' % i}
+                          for i in range(5)])
+        self.failIf([sql for sql in queries if 'FROM "core_dragable"' in sql])
+
+
+    def test_annotation_multi_get(self):
+        hashes = ','.join(['page_note%d' % i for i in range(5)])
+        # warm up the membership cache
+        self.client.get('/api/1.0/annotations/', {'hash': 'page_note0'})
+        response, one = count_queries(self.client.get,
+                                      '/api/1.0/annotations/',
+                                      {'hash': 'page_note0',
+                                       'fields': 'hash,dragable'})
+        response, five = count_queries(self.client.get,
+                                       '/api/1.0/annotations/',
+                                       {'hash': hashes,
+                                        'fields': 'hash,dragable'})
+        self.assertEqual(one, five)
+        results = json.loads(response.content)
+        self.assertEqual(results[4]['annotation'],
+                         {'hash': 'page_note4', 'dragable': {'hash': 'page4'}})
+
+
+    def test_annotation_single(self):
+        response = self.client.get('/api/1.0/annotations/page_note3/',
+                                   {'fields': 'type,note'})
+        self.assertEqual(json.loads(response.content),
+                         [{'type': 'note', 'note': 'note 3'}])
+
+
+    def test_sync(self):
+        from datetime import datetime
+        from datetime import timedelta
+        from api.pagination import encode_sync_token
+        since = encode_sync_token(datetime.now() - timedelta(days=1))
+        response = self.client.get('/api/1.0/dragables/',
+                                   {'since': since, 'fields': 'hash,updated'})
+        changed = json.loads(response.content)['changed']
+        self.assertEqual(len(changed), 5)
+        self.assertEqual(sorted(changed[0].keys()), ['hash', 'updated'])
+
+
+    def test_teams(self):
+        response, content, queries = self._get('/api/1.0/teams/',
+                                               {'fields': 'name'})
+        self.assertEqual(json.loads(content), [{'name': 'paginated team'}])
+        self.failIf([sql for sql in queries if 'core_team_members' in sql])
+
+
+class RecordingCursor(object):
+    """
+    Cursor that records the statements it runs with their parameters.
+    """
+
+    def __init__(self, cursor, statements):
+        self.cursor = cursor
+        self.statements = statements
+
+
+    def execute(self, sql, params=()):
+        self.statements.append((sql, params))
+        return self.cursor.execute(sql, params)
+
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+def explain(sql, params, min_rows=100):
+    """
+    Returns the query plan of a ``SELECT`` as a list of strings, and the
+    problems in it: full scans of tables, and sorts.
+
+    MySQL prefers full scans of tiny tables, so there only scans of at least
+    ``min_rows`` (estimated) rows count.
+    """
+    import re
+    from django.db import connection
+    cursor = connection.cursor()
+    tables = set(connection.introspection.table_names())
+    limited = re.search(r'\bLIMIT\b', sql) is not None
+    plan = []
+    problems = []
+
+    if 'mysql' in connection.settings_dict['ENGINE']:
+        cursor.execute('EXPLAIN ' + sql, params)
+        columns = [column[0] for column in cursor.description]
+        for row in cursor.fetchall():
+            row = dict(zip(columns, row))
+            plan.append('%(table)s: type=%(type)s key=%(key)s rows=%(rows)s '
+                        '%(Extra)s' % row)
+            if row['table'] in tables and (row['rows'] or 0) >= min_rows:
+                if row['type'] == 'ALL':
+                    problems.append('full scan of %s' % row['table'])
+                elif row['type'] == 'index' and not limited:
+                    problems.append('full index scan of %s' % row['table'])
+            if 'Using filesort' in (row['Extra'] or ''):
+                problems.append('sort')
+    else:
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        for row in cursor.fetchall():
+            detail = row[-1]
+            plan.append(detail)
+            match = re.match(r'SCAN (\w+)', detail)
+            if match and match.group(1) in tables and \
+               not 'VIRTUAL TABLE' in detail:
+                # an index walked in order is fine, if it stops at a LIMIT
+                if not 'USING' in detail or not limited:
+                    problems.append('full scan of %s' % match.group(1))
+            if detail.startswith('USE TEMP B-TREE FOR ORDER BY'):
+                problems.append('sort')
+
+    return plan, problems
+
+
+class QueryPlanTest(TransactionTestCase):
+    """
+    Checks the query plans of the queries of every read: none may scan a
+    whole table, and only the queries listed in ``SORTED`` may sort (SQLite
+    and MySQL).
+
+    Besides the data the requests read, the fixture holds ``FILLER``
+    dragables and annotations of a team the user isn't a member of. The
+    tables of the access paths are then large enough for MySQL to prefer
+    its indexes, and a full scan of them counts.
+
+    A ``TransactionTestCase``, because Python's sqlite3 module commits before
+    ``EXPLAIN``.
+    """
+
+    FILLER = 200
+
+    # the queries that may sort: the request, a part of the query's SQL and
+    # the reason
+    SORTED = (
+        ('/api/1.0/teams/', '"core_team_members"."team_id" IN',
+         'the members of the teams of one page, by membership'),
+        ('/api/1.0/teams/?name=t,u', '"core_team_members"."team_id" IN',
+         'the members of the named teams, by membership'),
+        ('/api/1.0/teams/t/graph/',
+         'FROM "core_annotation" INNER JOIN "core_dragable"',
+         'the connections of a team are found through its dragables, no '
+         'index holds them in order; cached under the team version'),
+        ('/api/1.0/dragables/', '"core_dragable"."team_id" IN',
+         'the dragables of several teams, merged by creation time'),
+        ('/api/1.0/dragables/?stream=1', '"core_dragable"."team_id" IN',
+         'the dragables of several teams, merged by creation time'),
+        ('/api/1.0/dragables/?since=', '"core_dragable"."team_id" IN',
+         'the dragables of several teams, merged by update time'),
+        ('/api/1.0/annotations/', '"core_dragable"."team_id" IN',
+         'the annotations of several teams, merged by creation time'),
+        ('/api/1.0/annotations/?since=', '"core_dragable"."team_id" IN',
+         'the annotations of several teams, merged by update time'),
+        ('/api/1.0/dragables/?hash=d1,d2', '"core_dragable"."hash" IN',
+         'at most API_BULK_MAX_ITEMS dragables'),
+        ('/api/1.0/annotations/?hash=a1,a2', '"core_annotation"."hash" IN',
+         'at most API_BULK_MAX_ITEMS annotations'),
+        ('/api/1.0/dragables/?search=research', 'ORDER BY score',
+         'matches are ranked by their score'),
+        ('/api/1.0/annotations/?search=research', 'ORDER BY score',
+         'matches are ranked by their score'),
+        ('/api/1.0/dragables/d2/neighbourhood/', 'WITH RECURSIVE',
+         'at most API_GRAPH_MAX_NODES dragables, closest first'),
+        ('/api/1.0/dragables/d2/neighbourhood/', '"core_dragable"."id" IN',
+         'at most API_GRAPH_MAX_NODES dragables'),
+        ('/api/1.0/dragables/d2/neighbourhood/',
+         '"core_annotation"."dragable_id" IN',
+         'the connections of at most API_GRAPH_MAX_NODES dragables'),
+    )
+
+    def setUp(self):
+        from core.bulk import insert_instances
+        from core.tokens import issue_token
+        self.user = User.objects.create_user('testuser',
+                                             'testuser@example.com',
+                                             'donthackmebro')
+        self.team = Team(name='t', created_by=self.user)
+        self.team.save()
+        Team(name='u', created_by=self.user).save()
+
+        previous = None
+        for i in range(5):
+            dragable = Dragable(hash='d%d' % i,
+                                team=self.team,
+                                created_by=self.user,
+                                url='http://www.example.com/',
+                                title='research',
+                                xpath='foo',
+                                connected_to=previous)
+            dragable.save()
+            Annotation(hash='a%d' % i,
+                       type='note',
+                       dragable=dragable,
+                       created_by=self.user,
+                       note='research').save()
+            previous = dragable
+
+        owner = User.objects.create_user('owner',
+                                         'owner@example.com',
+                                         'donthackmebro')
+        other = Team(name='v', created_by=owner)
+        other.save()
+        filler = [Dragable(hash='f%d' % i,
+                           team=other,
+                           created_by=owner,
+                           url='http://www.example.com/',
+                           title='filler',
+                           xpath='foo')
+                  for i in range(self.FILLER)]
+        insert_instances(Dragable, filler)
+        insert_instances(Annotation,
+                         [Annotation(hash='fa%d' % i,
+                                     type='note',
+                                     dragable=dragable,
+                                     created_by=owner,
+                                     note='filler')
+                          for i, dragable in enumerate(filler)])
+
+        token = issue_token(self.user)[0]
+        self.client = Client(HTTP_AUTHORIZATION='Token %s' % token)
+
+
+    def _statements(self, client, url):
+        """
+        Returns the ``SELECT``s of a request to ``url``.
+        """
+        from django.core.cache import cache
+        from django.db import connection
+        cache.clear()
+        statements = []
+        cursor = connection.cursor
+        connection.cursor = lambda: RecordingCursor(cursor(), statements)
+        try:
+            response = client.get(url)
+            ''.join(response)
+        finally:
+            del connection.cursor
+
+        self.assertEqual(response.status_code, 200, url)
+        return [(sql, params) for sql, params in statements
+                if sql.lstrip().upper().startswith('SELECT')]
+
+
+    def assertPlans(self, url, client=None, key=None):
+        key = key or url
+        for sql, params in self._statements(client or self.client, url):
+            # estimates vary, but a full scan reads about the filler at least
+            plan, problems = explain(sql, params, self.FILLER // 2)
+            for request, part, reason in self.SORTED:
+                if request == key and part in sql:
+                    problems = [p for p in problems if p != 'sort']
+            self.assertEqual(problems, [], '%s: %s\n%s\n%s'
+                                           % (url, ', '.join(problems), sql,
+                                              '\n'.join(plan)))
+
+
+    def _since(self):
+        from datetime import datetime, timedelta
+        from api.pagination import encode_sync_token
+        return encode_sync_token(datetime.now() - timedelta(1))
+
+
+    def test_teams(self):
+        self.assertPlans('/api/1.0/teams/')
+        self.assertPlans('/api/1.0/teams/t/')
+        self.assertPlans('/api/1.0/teams/?name=t,u')
+        self.assertPlans('/api/1.0/teams/t/graph/')
+
+
+    def test_dragables(self):
+        self.assertPlans('/api/1.0/dragables/')
+        self.assertPlans('/api/1.0/dragables/?stream=1')
+        self.assertPlans('/api/1.0/dragables/d1/')
+        self.assertPlans('/api/1.0/dragables/?team=t')
+        self.assertPlans('/api/1.0/dragables/?hash=d1,d2')
+        self.assertPlans('/api/1.0/dragables/?search=research')
+        self.assertPlans('/api/1.0/dragables/d2/neighbourhood/')
+
+
+    def test_dragables_page(self):
+        response = self.client.get('/api/1.0/dragables/?team=t&limit=2')
+        self.assertPlans('/api/1.0/dragables/?team=t&cursor=%s'
+                         % response['X-Next-Cursor'])
+
+
+    def test_dragables_sync(self):
+        self.assertPlans('/api/1.0/dragables/?since=%s' % self._since(),
+                         key='/api/1.0/dragables/?since=')
+        self.assertPlans('/api/1.0/dragables/?team=t&since=%s'
+                         % self._since())
+
+
+    def test_annotations(self):
+        self.assertPlans('/api/1.0/annotations/')
+        self.assertPlans('/api/1.0/annotations/a1/')
+        self.assertPlans('/api/1.0/annotations/?dragable=d1')
+        self.assertPlans('/api/1.0/annotations/?hash=a1,a2')
+        self.assertPlans('/api/1.0/annotations/?search=research')
+        self.assertPlans('/api/1.0/annotations/?since=%s' % self._since(),
+                         key='/api/1.0/annotations/?since=')
+
+
+    def test_my_dragables(self):
+        client = Client()
+        client.login(username='testuser', password='donthackmebro')
+        self.assertPlans('/members/', client)
+
+
+    def test_tokens(self):
+        self.assertPlans('/api/1.0/tokens/')
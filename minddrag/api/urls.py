@@ -7,28 +7,46 @@ URL configuration for the Minddrag API
 '''
 
 from django.conf.urls.defaults import *
-from piston.resource import Resource
-from piston.authentication import HttpBasicAuthentication
 
+from api.authentication import TokenAuthentication
+from api.resource import Resource
 from api.handlers import TeamHandler
+from api.handlers import TeamGraphHandler
 from api.handlers import DragableHandler
+from api.handlers import NeighbourhoodHandler
 from api.handlers import AnnotationHandler
+from api.handlers import BulkDragableHandler
+from api.handlers import BulkAnnotationHandler
+from api.handlers import MetricsHandler
+from api.handlers import TokenHandler
 
-auth = HttpBasicAuthentication(realm='Minddrag API')
+auth = TokenAuthentication(realm='Minddrag API')
 ad = { 'authentication': auth }
 
 team_resource = Resource(handler=TeamHandler, **ad)
+team_graph_resource = Resource(handler=TeamGraphHandler, **ad)
 dragable_resource = Resource(handler=DragableHandler, **ad)
+neighbourhood_resource = Resource(handler=NeighbourhoodHandler, **ad)
 annotation_resource = Resource(handler=AnnotationHandler, **ad)
+bulk_dragable_resource = Resource(handler=BulkDragableHandler, **ad)
+bulk_annotation_resource = Resource(handler=BulkAnnotationHandler, **ad)
+metrics_resource = Resource(handler=MetricsHandler, **ad)
+token_resource = Resource(handler=TokenHandler, **ad)
 
 urlpatterns = patterns('',
     url(r'^teams/$', team_resource, name='api_teams'),
     url(r'^teams/(?P<name>[^/]+)/$', team_resource, name='api_teams_by_name'),
+    url(r'^teams/(?P<name>[^/]+)/graph/$',
+        team_graph_resource,
+        name='api_team_graph'),
 
     url(r'^dragables/$', dragable_resource, name='api_dragables'),
     url(r'^dragables/(?P<hash>[^/]+)/$',
         dragable_resource,
         name='api_dragables_by_hash'),
+    url(r'^dragables/(?P<hash>[^/]+)/neighbourhood/$',
+        neighbourhood_resource,
+        name='api_dragable_neighbourhood'),
 
     url(r'^annotations/$',
         annotation_resource,
@@ -36,5 +54,20 @@ urlpatterns = patterns('',
     url(r'^annotations/(?P<hash>[^/]+)/$',
         annotation_resource,
         name='api_annotations_by_hash'),
+
+    url(r'^bulk/dragables/$',
+        bulk_dragable_resource,
+        name='api_bulk_dragables'),
+    url(r'^bulk/annotations/$',
+        bulk_annotation_resource,
+        name='api_bulk_annotations'),
+
+    url(r'^tokens/$', token_resource, name='api_tokens'),
+    url(r'^tokens/(?P<id>\d+)/$', token_resource, name='api_tokens_by_id'),
+
+    url(r'^_metrics$', metrics_resource, name='api_metrics'),
+    url(r'^_metrics/(?P<exposition>prometheus)$',
+        metrics_resource,
+        name='api_metrics_prometheus'),
 )
 
@@ -0,0 +1,65 @@
+"""
+What the user of a request may see.
+
+The ids of the teams the user is a member of are resolved once per request
+(from the cache, see ``core.models.get_team_ids``), and dragables and
+annotations are filtered with ``team_id IN (...)``, which the indexes on
+``team_id`` serve. Nothing is joined to the members or the users, so rows
+aren't duplicated either.
+
+Users in very many teams (more than ``API_VISIBILITY_MAX_TEAM_IDS``) would
+make long statements, for them the team ids are read by a subquery on the
+membership table instead.
+"""
+
+from django.conf import settings
+
+from core.models import Annotation
+from core.models import Dragable
+from core.models import Team
+from core.models import get_team_ids
+
+
+def visible_team_ids(request):
+    """
+    Returns the set of ids of the teams the user is a member of.
+    """
+    team_ids = getattr(request, '_visible_team_ids', None)
+    if team_ids is None:
+        team_ids = get_team_ids(request.user)
+        request._visible_team_ids = team_ids
+    return team_ids
+
+
+def team_filter(request):
+    """
+    Returns the value for an ``__in`` lookup of the visible teams: a sorted
+    list of their ids, or a subquery for users in very many teams.
+    """
+    team_ids = visible_team_ids(request)
+
+    if len(team_ids) > getattr(settings, 'API_VISIBILITY_MAX_TEAM_IDS', 500):
+        return Team.members.through.objects.filter(
+                                user=request.user.id).values('team')
+
+    return sorted(team_ids)
+
+
+def visible_dragables(request, queryset=None):
+    """
+    Restricts ``queryset`` (all dragables by default) to the visible
+    dragables.
+    """
+    if queryset is None:
+        queryset = Dragable.objects.all()
+    return queryset.filter(team__in=team_filter(request))
+
+
+def visible_annotations(request, queryset=None):
+    """
+    Restricts ``queryset`` (all annotations by default) to the visible
+    annotations.
+    """
+    if queryset is None:
+        queryset = Annotation.objects.all()
+    return queryset.filter(dragable__team__in=team_filter(request))
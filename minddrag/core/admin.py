@@ -1,6 +1,13 @@
 from core import models
+from core.forms import HashForm
 from django.contrib import admin
 
+
+class HashAdmin(admin.ModelAdmin):
+    # checks the uniqueness of the hash
+    form = HashForm
+
+
 admin.site.register(models.Team)
-admin.site.register(models.Dragable)
-admin.site.register(models.Annotation)
+admin.site.register(models.Dragable, HashAdmin)
+admin.site.register(models.Annotation, HashAdmin)
@@ -0,0 +1,114 @@
+"""
+Set-based writes for lists of model instances.
+
+``Model.save`` issues one statement per instance. These functions write a
+whole list of instances of one model with multi-row statements instead and
+send ``core.signals.post_bulk_save`` once, rather than ``post_save`` for
+every instance.
+"""
+
+from django.db import connection
+from django.db import transaction
+from django.db.models import AutoField
+
+from core.signals import post_bulk_save
+
+# stay below the bind parameter limit of old SQLite versions
+MAX_PARAMETERS = 999
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def insert_rows(model, instances):
+    """
+    Inserts the unsaved ``instances`` of ``model``, without setting their
+    primary keys or sending signals.
+    """
+    qn = connection.ops.quote_name
+    fields = [f for f in model._meta.local_fields
+              if not isinstance(f, AutoField)]
+    rows = []
+
+    for instance in instances:
+        rows.append([f.get_db_prep_save(f.pre_save(instance, True),
+                                        connection=connection)
+                     for f in fields])
+
+    columns = ', '.join([qn(f.column) for f in fields])
+    placeholders = '(%s)' % ', '.join(['%s'] * len(fields))
+    cursor = connection.cursor()
+
+    for chunk in _chunks(rows, MAX_PARAMETERS // len(fields)):
+        cursor.execute('INSERT INTO %s (%s) VALUES %s'
+                       % (qn(model._meta.db_table),
+                          columns,
+                          ', '.join([placeholders] * len(chunk))),
+                       [value for row in chunk for value in row])
+
+
+def insert_instances(model, instances):
+    """
+    Inserts the unsaved ``instances`` of ``model`` and sets their primary
+    keys. ``model`` must have unique hashes (see ``core.hashes``), which are
+    used to find out the primary keys of the new rows.
+    """
+    if not instances:
+        return
+
+    insert_rows(model, instances)
+    pks = dict(model.objects.filter(
+                    hash__in=[i.hash for i in instances]
+               ).values_list('hash', 'pk'))
+
+    for instance in instances:
+        instance.pk = pks[instance.hash]
+
+    transaction.commit_unless_managed()
+    post_bulk_save.send(sender=model, instances=instances, created=True)
+
+
+def update_instances(model, instances, field_names):
+    """
+    Writes the fields named in ``field_names`` of the saved ``instances`` of
+    ``model`` back to the database with one ``UPDATE`` statement per chunk.
+    Fields with ``auto_now`` are always written.
+    """
+    if not instances:
+        return
+
+    qn = connection.ops.quote_name
+    fields = [f for f in model._meta.local_fields
+              if f.name in field_names or getattr(f, 'auto_now', False)]
+    pk_column = qn(model._meta.pk.column)
+    cursor = connection.cursor()
+
+    # every instance needs two parameters per field plus one for its pk
+    chunk_size = MAX_PARAMETERS // (len(fields) * 2 + 1)
+
+    for chunk in _chunks(instances, chunk_size):
+        assignments = []
+        params = []
+
+        for f in fields:
+            cases = []
+            for instance in chunk:
+                value = f.get_db_prep_save(f.pre_save(instance, False),
+                                           connection=connection)
+                cases.append('WHEN %s THEN %s')
+                params += [instance.pk, value]
+            assignments.append('%s = CASE %s %s END'
+                               % (qn(f.column), pk_column, ' '.join(cases)))
+
+        params += [instance.pk for instance in chunk]
+        cursor.execute('UPDATE %s SET %s WHERE %s IN (%s)'
+                       % (qn(model._meta.db_table),
+                          ', '.join(assignments),
+                          pk_column,
+                          ', '.join(['%s'] * len(chunk))),
+                       params)
+
+    transaction.commit_unless_managed()
+    post_bulk_save.send(sender=model, instances=instances, created=False)
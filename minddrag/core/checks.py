@@ -0,0 +1,61 @@
+"""
+Checks of the deployment.
+
+Permission checks (``core.models.get_team_ids``), ETags (``core.versions``),
+API tokens (``core.tokens``) and the read-your-writes pins of
+``core.routers`` are kept in the cache and invalidated by deleting or
+changing the cached entries. That only reaches the other processes of the
+site if they share the cache. A user removed from a team would otherwise
+keep access in every other process until the entry expires.
+
+``CACHE_BACKEND`` must therefore name a shared cache (e.g. memcached) when
+the site runs in more than one process. ``CheckedApplication`` refuses to
+serve a multi-process deployment with a process-local cache.
+"""
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# cache backends that aren't shared between processes
+PROCESS_LOCAL_CACHES = ('locmem',)
+
+
+def is_shared_cache(backend=None):
+    """
+    Returns true, if the cache ``backend`` (``CACHE_BACKEND`` by default) is
+    shared by all processes.
+    """
+    if backend is None:
+        backend = settings.CACHE_BACKEND
+    return backend.split(':', 1)[0] not in PROCESS_LOCAL_CACHES
+
+
+def check_cache(multiprocess):
+    """
+    Raises ``ImproperlyConfigured`` if the site runs in more than one process
+    (``multiprocess``) with a process-local cache.
+    """
+    if multiprocess and not is_shared_cache():
+        raise ImproperlyConfigured(
+                'CACHE_BACKEND %r is local to each process, but the site runs '
+                'in several processes. Configure a shared cache, e.g. '
+                'memcached.' % settings.CACHE_BACKEND)
+
+
+class CheckedApplication(object):
+    """
+    WSGI application that runs ``check_cache`` before it passes the first
+    request on to ``application``, and fails every request if the check
+    fails.
+    """
+
+    def __init__(self, application):
+        self.application = application
+        self.checked = False
+
+
+    def __call__(self, environ, start_response):
+        if not self.checked:
+            check_cache(environ.get('wsgi.multiprocess', False))
+            self.checked = True
+        return self.application(environ, start_response)
@@ -0,0 +1,138 @@
+"""
+Compression of responses with gzip.
+
+``core.middleware.CompressionMiddleware`` compresses the responses of the
+API and the views for clients that accept gzip (``Accept-Encoding``), as long
+as they are of a textual type and at least ``COMPRESSION_MIN_LENGTH`` bytes
+long. Streamed responses are compressed while they are sent.
+
+The compressed variant of a response has its own ETag, the ETag of the
+response with ``GZIP_ETAG_SUFFIX`` (see ``gzip_etag``), so that caches don't
+mix up the variants.
+
+Compressed responses can be cached, so that they don't need to be rendered
+and compressed again: if the request carries a ``compressed_cache_key`` (e.g.
+derived from its ETag, see ``api.conditional``), the middleware stores the
+compressed response under it, and ``get_compressed`` returns it for the next
+request with the same key. Only responses read from the primary database may
+be cached this way, the key names the current state of the data.
+"""
+
+import zlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+
+# the types worth compressing
+COMPRESSIBLE_TYPES = ('text/',
+                      'application/json',
+                      'application/x-ndjson',
+                      'application/x-yaml',
+                      'application/xml',
+                      'application/javascript',
+                      'application/x-msgpack')
+
+# the headers of a cached response, besides Content-Encoding
+CACHED_HEADERS = ('Content-Type', 'ETag', 'X-Next-Cursor', 'X-Sync-Token')
+
+# distinguishes the ETag of the compressed variant
+GZIP_ETAG_SUFFIX = '-gzip'
+
+
+def accepts_gzip(request):
+    """
+    Returns true, if the ``Accept-Encoding`` header of ``request`` allows
+    gzip.
+    """
+    qualities = {}
+    for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = coding.split(';')
+        name = params[0].strip().lower()
+        quality = 1.0
+        for param in params[1:]:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name:
+            qualities[name] = quality
+
+    for name in ('gzip', 'x-gzip', '*'):
+        if name in qualities:
+            return qualities[name] > 0
+    return False
+
+
+def gzip_etag(etag):
+    """
+    Returns the ETag of the compressed variant of the response with
+    ``etag``.
+    """
+    if etag.endswith('"'):
+        return '%s%s"' % (etag[:-1], GZIP_ETAG_SUFFIX)
+    return etag + GZIP_ETAG_SUFFIX
+
+
+def is_compressible(response):
+    if response.status_code != 200 or response.has_header('Content-Encoding'):
+        return False
+    content_type = response.get('Content-Type', '').lower()
+    for prefix in COMPRESSIBLE_TYPES:
+        if content_type.startswith(prefix):
+            return True
+    return False
+
+
+def _compressor():
+    # gzip framing, without a timestamp
+    return zlib.compressobj(getattr(settings, 'COMPRESSION_LEVEL', 6),
+                            zlib.DEFLATED,
+                            16 + zlib.MAX_WBITS)
+
+
+def compress(data):
+    compressor = _compressor()
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_stream(parts):
+    """
+    Yields the gzip compressed ``parts`` as they come in.
+    """
+    compressor = _compressor()
+    for part in parts:
+        data = compressor.compress(part)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def cache_compressed(key, response):
+    cache.set(key,
+              (response.content,
+               [(header, response[header]) for header in CACHED_HEADERS
+                if response.has_header(header)]),
+              getattr(settings, 'API_REPRESENTATION_CACHE_TIMEOUT',
+                      60 * 60 * 24))
+
+
+def get_compressed(key):
+    """
+    Returns the compressed response cached under ``key``, or ``None``.
+    """
+    cached = cache.get(key)
+    if cached is None:
+        return None
+
+    content, headers = cached
+    response = HttpResponse(content)
+    for header, value in headers:
+        response[header] = value
+    response['Content-Encoding'] = 'gzip'
+    response['Content-Length'] = str(len(content))
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
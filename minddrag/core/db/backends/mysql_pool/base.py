@@ -0,0 +1,12 @@
+"""
+The MySQL backend with pooled connections (see ``core.db.pool``).
+"""
+
+from django.db.backends.mysql.base import *
+from django.db.backends.mysql import base as mysql
+
+from core.db.pool import PooledDatabaseWrapper
+
+
+class DatabaseWrapper(PooledDatabaseWrapper, mysql.DatabaseWrapper):
+    pass
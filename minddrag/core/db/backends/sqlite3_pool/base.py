@@ -0,0 +1,23 @@
+"""
+The SQLite backend with pooled connections (see ``core.db.pool``).
+In-memory databases aren't pooled, every connection would open a database
+of its own.
+"""
+
+from django.db.backends.sqlite3.base import *
+from django.db.backends.sqlite3 import base as sqlite3
+
+from core.db.pool import PooledDatabaseWrapper
+
+
+class DatabaseWrapper(PooledDatabaseWrapper, sqlite3.DatabaseWrapper):
+
+    def __init__(self, settings_dict, *args, **kwargs):
+        # pooled connections move between threads, one at a time
+        settings_dict['OPTIONS'] = dict(settings_dict.get('OPTIONS') or {},
+                                        check_same_thread=False)
+        super(DatabaseWrapper, self).__init__(settings_dict, *args, **kwargs)
+
+
+    def is_pooled(self):
+        return self.settings_dict['NAME'] != ':memory:'
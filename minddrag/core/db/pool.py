@@ -0,0 +1,272 @@
+"""
+Pooled database connections.
+
+Django opens a connection for every request and closes it when the request
+is finished. The backends in ``core.db.backends`` keep the closed
+connections in a pool of the process instead and hand them to the next
+request, so the connection setup (TCP, authentication, session settings)
+isn't paid per request. Select one of them as ``ENGINE``, e.g.
+``core.db.backends.mysql_pool``.
+
+A pool holds at most ``DATABASE_POOL_SIZE`` connections of one database per
+process, idle or in use. When all of them are in use, a thread waits up to
+``DATABASE_POOL_TIMEOUT`` seconds for one to be returned, and then fails
+with a ``DatabaseError``. Idle connections are checked with ``SELECT 1``
+before they are handed out, and connections older than
+``DATABASE_POOL_MAX_AGE`` seconds are closed instead of being reused, so
+connections killed by the server or a firewall are replaced.
+
+Transactions left open by a request are rolled back when the connection
+goes back to the pool. ``get_stats`` returns the numbers of all pools, they
+are part of the request metrics (see ``core.metrics``).
+"""
+
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db.utils import DatabaseError
+
+
+class ConnectionPool(object):
+    """
+    At most ``size`` connections, of which the idle ones are kept for reuse
+    until they are ``max_age`` seconds old.
+    """
+
+    def __init__(self, size, max_age, timeout):
+        self.size = size
+        self.max_age = max_age
+        self.timeout = timeout
+        self.pid = os.getpid()
+        # (connection, connected), the most recently returned last
+        self.idle = []
+        # idle and in use
+        self.open = 0
+        self.condition = threading.Condition()
+        self.checkouts = 0
+        self.reused = 0
+        self.created = 0
+        self.expired = 0
+        self.failed_checks = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+
+
+    def checkout(self):
+        """
+        Returns an idle connection and the time it was connected at. Returns
+        ``(None, None)`` if the caller has to connect, then the new
+        connection counts against the size of the pool already.
+        """
+        while True:
+            connection, connected = self._take()
+            if connection is None:
+                return None, None
+
+            if time.time() - connected > self.max_age:
+                self.discard(connection)
+                self._count('expired')
+            elif not _is_usable(connection):
+                self.discard(connection)
+                self._count('failed_checks')
+            else:
+                self._count('reused')
+                return connection, connected
+
+
+    def connected(self):
+        """
+        Tells the pool that the caller of ``checkout`` connected.
+        """
+        self._count('created')
+
+
+    def checkin(self, connection, connected):
+        """
+        Returns the ``connection`` that was connected at ``connected``.
+        """
+        if time.time() - connected > self.max_age:
+            self.discard(connection)
+            self._count('expired')
+            return
+
+        self.condition.acquire()
+        try:
+            self.idle.append((connection, connected))
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+
+    def discard(self, connection=None):
+        """
+        Closes ``connection`` (if any), which makes room for a new one.
+        """
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+        self.condition.acquire()
+        try:
+            self.open -= 1
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+
+    def as_dict(self):
+        self.condition.acquire()
+        try:
+            return {
+                'size': self.size,
+                'open': self.open,
+                'idle': len(self.idle),
+                'in_use': self.open - len(self.idle),
+                'checkouts': self.checkouts,
+                'reused': self.reused,
+                'created': self.created,
+                'expired': self.expired,
+                'failed_checks': self.failed_checks,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'timeouts': self.timeouts,
+            }
+        finally:
+            self.condition.release()
+
+
+    def _take(self):
+        start = time.time()
+        waited = False
+
+        self.condition.acquire()
+        try:
+            self.checkouts += 1
+            while True:
+                if self.idle:
+                    return self.idle.pop()
+                if self.open < self.size:
+                    self.open += 1
+                    return None, None
+
+                remaining = start + self.timeout - time.time()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise DatabaseError('All %d pooled connections are in '
+                                        'use.' % self.size)
+                waited = True
+                self.condition.wait(remaining)
+        finally:
+            if waited:
+                self.waits += 1
+                self.wait_time += time.time() - start
+            self.condition.release()
+
+
+    def _count(self, counter):
+        self.condition.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + 1)
+        finally:
+            self.condition.release()
+
+
+def _is_usable(connection):
+    try:
+        cursor = connection.cursor()
+        try:
+            cursor.execute('SELECT 1')
+        finally:
+            cursor.close()
+    except Exception:
+        return False
+    return True
+
+
+# alias -> pool
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias):
+    """
+    Returns the pool of the database ``alias`` in this process.
+    """
+    pool = _pools.get(alias)
+    # connections must not be shared with forked processes
+    if pool is None or pool.pid != os.getpid():
+        _pools_lock.acquire()
+        try:
+            pool = _pools.get(alias)
+            if pool is None or pool.pid != os.getpid():
+                pool = _pools[alias] = ConnectionPool(
+                    getattr(settings, 'DATABASE_POOL_SIZE', 10),
+                    getattr(settings, 'DATABASE_POOL_MAX_AGE', 600),
+                    getattr(settings, 'DATABASE_POOL_TIMEOUT', 10))
+        finally:
+            _pools_lock.release()
+    return pool
+
+
+def get_stats():
+    """
+    Returns the numbers of the pools of this process by database alias.
+    """
+    return dict([(alias, pool.as_dict())
+                 for alias, pool in _pools.items()
+                 if pool.pid == os.getpid()])
+
+
+class PooledDatabaseWrapper(object):
+    """
+    Mixin for a ``DatabaseWrapper`` that takes its connections from the pool
+    of its database and returns them on ``close``.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PooledDatabaseWrapper, self).__init__(*args, **kwargs)
+        # when the current connection was connected
+        self.connected = None
+
+
+    def is_pooled(self):
+        return True
+
+
+    def _cursor(self):
+        if self.connection is None and self.is_pooled():
+            pool = get_pool(self.alias)
+            self.connection, self.connected = pool.checkout()
+            if self.connection is None:
+                try:
+                    cursor = super(PooledDatabaseWrapper, self)._cursor()
+                except:
+                    pool.discard(self.connection)
+                    self.connection = None
+                    raise
+                self.connected = time.time()
+                pool.connected()
+                return cursor
+
+        return super(PooledDatabaseWrapper, self)._cursor()
+
+
+    def close(self):
+        if self.connection is None or not self.is_pooled():
+            return super(PooledDatabaseWrapper, self).close()
+
+        connection = self.connection
+        self.connection = None
+        pool = get_pool(self.alias)
+        try:
+            # the next user starts without the transaction of this one
+            connection.rollback()
+        except Exception:
+            pool.discard(connection)
+        else:
+            pool.checkin(connection, self.connected)
@@ -0,0 +1,136 @@
+"""
+Stress test of the connection pool.
+
+Threads play requests against a database: every request takes a
+connection, runs a few queries and closes the connection again, like
+Django at the end of a request. The requests run once with the plain backend
+and once with its pooled counterpart (see ``core.db.pool``), and the
+latencies of both are reported.
+
+Use the ``stress_db_pool`` management command. In-memory SQLite databases
+are replaced by a temporary file, they would have nothing to connect to.
+"""
+
+import os
+import tempfile
+import threading
+import time
+
+from django.db import load_backend
+
+from core import metrics
+from core.db import pool
+
+# plain backend -> pooled backend
+POOLED_ENGINES = {
+    'django.db.backends.mysql': 'core.db.backends.mysql_pool',
+    'django.db.backends.sqlite3': 'core.db.backends.sqlite3_pool',
+}
+
+
+def get_engines(engine):
+    """
+    Returns the plain and the pooled backend for ``engine``, which may be
+    either of them.
+    """
+    for plain, pooled in POOLED_ENGINES.items():
+        if engine in (plain, pooled, plain.split('.')[-1]):
+            return plain, pooled
+    raise ValueError('There is no pooled backend for %s.' % engine)
+
+
+def run(settings_dict, threads=10, requests=100, queries=3, log=None):
+    """
+    Plays ``requests`` requests with ``queries`` queries each in every one of
+    ``threads`` threads against the database of ``settings_dict``, with the
+    plain and the pooled backend. Returns the results by backend.
+    """
+    settings_dict = dict(settings_dict)
+    temporary = None
+    if settings_dict['NAME'] in ('', ':memory:'):
+        temporary = tempfile.mkstemp(suffix='.db')
+        os.close(temporary[0])
+        settings_dict['NAME'] = temporary[1]
+
+    try:
+        results = {}
+        for name, engine in zip(('plain', 'pooled'),
+                                get_engines(settings_dict['ENGINE'])):
+            if log:
+                log('%s (%s)' % (name, engine))
+            results[name] = _run(engine,
+                                 dict(settings_dict, ENGINE=engine),
+                                 threads,
+                                 requests,
+                                 queries)
+        return results
+    finally:
+        if temporary:
+            os.remove(temporary[1])
+
+
+def _run(engine, settings_dict, threads, requests, queries):
+    backend = load_backend(engine)
+    alias = 'stress-%s' % engine
+    # a fresh pool
+    pool._pools.pop(alias, None)
+
+    latencies = []
+    errors = []
+
+    def play():
+        wrapper = backend.DatabaseWrapper(dict(settings_dict), alias)
+        for i in range(requests):
+            start = time.time()
+            try:
+                try:
+                    cursor = wrapper.cursor()
+                    for j in range(queries):
+                        cursor.execute('SELECT 1')
+                        cursor.fetchall()
+                finally:
+                    wrapper.close()
+            except Exception, e:
+                errors.append(e)
+            else:
+                latencies.append(time.time() - start)
+            wrapper.queries = []
+
+    workers = [threading.Thread(target=play) for i in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+
+    latencies.sort()
+
+    def ms(seconds):
+        if seconds is None:
+            return None
+        return round(seconds * 1000, 3)
+
+    result = {
+        'requests': threads * requests,
+        'errors': len(errors),
+        'throughput': elapsed and len(latencies) / elapsed or 0.0,
+        'latency_ms': {
+            'mean': ms(sum(latencies) / max(len(latencies), 1)),
+            'p50': ms(metrics.percentile(latencies, 50)),
+            'p95': ms(metrics.percentile(latencies, 95)),
+            'p99': ms(metrics.percentile(latencies, 99)),
+            'max': ms(metrics.percentile(latencies, 100)),
+        },
+    }
+
+    stats = pool.get_stats().get(alias)
+    if stats is not None:
+        result['pool'] = stats
+        # close the idle connections
+        test_pool = pool.get_pool(alias)
+        while test_pool.idle:
+            test_pool.discard(test_pool.idle.pop()[0])
+        del pool._pools[alias]
+
+    return result
@@ -0,0 +1,18 @@
+from django import forms
+from django.utils.translation import ugettext_lazy as _
+
+
+class HashForm(forms.ModelForm):
+    """
+    Checks that the hash is unique, the unique index is on ``hash_key``,
+    which isn't part of the form (see ``core.hashes``).
+    """
+
+    def clean_hash(self):
+        hash = self.cleaned_data['hash']
+        others = self._meta.model.objects.filter(hash=hash)
+        if self.instance.pk is not None:
+            others = others.exclude(pk=self.instance.pk)
+        if others.exists():
+            raise forms.ValidationError(_('This hash is already taken.'))
+        return hash
@@ -0,0 +1,293 @@
+"""
+The mindmap of a team as a graph.
+
+The nodes are the dragables of the team, the edges are their ``connected_to``
+links and the connection annotations between them. Both are read with one
+query each, no matter how large the team is.
+
+``neighbourhood`` walks the graph from one dragable instead, up to a given
+number of hops. It uses a recursive query on databases that support common
+table expressions and reads one level per step elsewhere.
+"""
+
+import sqlite3
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Q
+
+from core.models import Annotation
+from core.models import Dragable
+from core.routers import alias_for_change
+from core.versions import get_team_state
+
+
+def build_team_graph(team_id, using=None):
+    """
+    Returns the graph of the team with the given id as a dict::
+
+        {
+            'nodes': [{'hash': ..., 'title': ..., 'url': ...}, ...],
+            'connected_to': {hash: [hash, ...], ...},
+            'connections': {hash: [[hash, annotation hash], ...], ...},
+        }
+
+    ``connected_to`` and ``connections`` are adjacency lists keyed by the
+    hash of the source dragable. Dragables without outgoing edges are left
+    out of them.
+
+    ``using`` names the database to read from, by default the router
+    decides.
+    """
+    return _build_graph(
+        Dragable.objects.using(using).filter(team=team_id),
+        Annotation.objects.using(using).filter(dragable__team=team_id))
+
+
+def _build_graph(dragables, annotations, extra=()):
+    nodes = []
+    connected_to = {}
+    connections = {}
+
+    rows = dragables.order_by('created', 'pk').values_list(
+                                'hash', 'title', 'url', 'connected_to__hash',
+                                *extra)
+    for row in rows:
+        node = {'hash': row[0], 'title': row[1], 'url': row[2]}
+        for name, value in zip(extra, row[4:]):
+            node[name] = value
+        nodes.append(node)
+        if row[3] is not None:
+            connected_to.setdefault(row[0], []).append(row[3])
+
+    annotations = annotations.filter(type='connection',
+                                     connected_dragable__isnull=False)
+    for hash, source, target in annotations.order_by('created', 'pk'
+                            ).values_list('hash',
+                                          'dragable__hash',
+                                          'connected_dragable__hash'):
+        connections.setdefault(source, []).append([target, hash])
+
+    return {
+        'nodes': nodes,
+        'connected_to': connected_to,
+        'connections': connections,
+    }
+
+
+def get_team_graph(team_id):
+    """
+    Returns the graph of the team with the given id, from the cache if the
+    team hasn't changed since it was built.
+
+    The graph is cached under the current version of the team, so it's read
+    from the primary database while the replicas may lag behind the team's
+    last change.
+    """
+    versions, modified = get_team_state([team_id])
+    version = versions[team_id]
+    key = 'core.graph.%d.%d' % (team_id, version)
+    graph = cache.get(key)
+
+    if graph is None:
+        graph = build_team_graph(team_id, alias_for_change(modified))
+        graph['version'] = version
+        cache.set(key,
+                  graph,
+                  getattr(settings, 'GRAPH_CACHE_TIMEOUT', 60 * 60))
+
+    return graph
+
+
+# ==============================================================================
+# bounded traversal
+# ==============================================================================
+
+def supports_recursive_queries():
+    """
+    Returns true, if the database can run ``WITH RECURSIVE`` queries. The
+    ``GRAPH_RECURSIVE_QUERIES`` setting overrides the detection.
+    """
+    supported = getattr(settings, 'GRAPH_RECURSIVE_QUERIES', None)
+    if supported is not None:
+        return supported
+
+    engine = connection.settings_dict['ENGINE']
+    if 'sqlite3' in engine:
+        # several recursive SELECTs in one common table expression
+        return sqlite3.sqlite_version_info >= (3, 34, 0)
+    if 'postgresql' in engine:
+        return True
+    if 'mysql' in engine:
+        cursor = connection.cursor()
+        cursor.execute('SELECT VERSION()')
+        version = cursor.fetchone()[0]
+        return (not 'mariadb' in version.lower() and
+                int(version.split('.')[0]) >= 8)
+    return False
+
+
+# the ways to get from a dragable (source) to a neighbour (target): its
+# connected_to link in either direction and its connection annotations in
+# either direction. Every step starts from an indexed column.
+STEPS = (
+    ('core_dragable', 'id', 'connected_to_id', ''),
+    ('core_dragable', 'connected_to_id', 'id', ''),
+    ('core_annotation', 'dragable_id', 'connected_dragable_id',
+     " AND s.type = 'connection'"),
+    ('core_annotation', 'connected_dragable_id', 'dragable_id',
+     " AND s.type = 'connection'"),
+)
+
+# one recursive SELECT per step, each joins the frontier to the rows of its
+# table that are linked to it, so a request only reads the neighbourhood and
+# not the whole team
+STEP_SQL = """
+        SELECT s.%(target)s, w.depth + 1 FROM walk w
+            JOIN %(table)s s ON s.%(source)s = w.id
+            JOIN core_dragable n ON n.id = s.%(target)s
+            WHERE w.depth < %%s AND n.team_id = %%s%(condition)s"""
+
+# PostgreSQL allows only one reference to the walk in the recursive part.
+# There the frontier is joined to all steps at once, the planner pushes the
+# join into every branch of the UNION ALL, so each step still uses its index
+EDGE_SQL = """
+            SELECT s.%(source)s AS source, s.%(target)s AS target
+                FROM %(table)s s
+                WHERE s.%(target)s IS NOT NULL%(condition)s"""
+
+EDGES_STEP_SQL = """
+        SELECT e.target, w.depth + 1 FROM walk w
+            JOIN (%s
+            ) e ON e.source = w.id
+            JOIN core_dragable n ON n.id = e.target
+            WHERE w.depth < %%s AND n.team_id = %%s"""
+
+# UNION (not UNION ALL) drops (id, depth) pairs that were already reached,
+# so cycles can't make the walk grow beyond nodes * depth rows. The query is
+# wrapped in a SELECT, because the Python sqlite3 module commits the running
+# transaction before any statement that doesn't start with a DML keyword.
+NEIGHBOURHOOD_SQL = """
+    SELECT id, hops FROM (
+    WITH RECURSIVE
+    walk (id, depth) AS (
+        SELECT %%s, 0
+        UNION%s
+    )
+    SELECT id, MIN(depth) AS hops FROM walk GROUP BY id
+    ) neighbours
+    ORDER BY hops, id LIMIT %%s
+"""
+
+
+def _step(table, source, target, condition):
+    return {'table': table,
+            'source': source,
+            'target': target,
+            'condition': condition}
+
+
+def _neighbourhood_sql():
+    if 'postgresql' in connection.settings_dict['ENGINE']:
+        edges = '\n            UNION ALL'.join([EDGE_SQL % _step(*step)
+                                                for step in STEPS])
+        return NEIGHBOURHOOD_SQL % (EDGES_STEP_SQL % edges), 1
+    steps = '\n        UNION'.join([STEP_SQL % _step(*step)
+                                    for step in STEPS])
+    return NEIGHBOURHOOD_SQL % steps, len(STEPS)
+
+
+def _neighbours_recursive(dragable, depth, limit):
+    sql, steps = _neighbourhood_sql()
+    params = [dragable.pk] + [depth, dragable.team_id] * steps + [limit]
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return [tuple(row) for row in cursor.fetchall()]
+
+
+def _neighbours_by_level(dragable, depth, limit):
+    team_id = dragable.team_id
+    found = [(dragable.pk, 0)]
+    visited = set([dragable.pk])
+    frontier = set([dragable.pk])
+    level = 0
+
+    while frontier and level < depth and len(found) < limit:
+        level += 1
+        candidates = set()
+
+        links = Dragable.objects.filter(team=team_id).filter(
+                                            Q(pk__in=frontier) |
+                                            Q(connected_to__in=frontier))
+        for pk, target in links.values_list('pk', 'connected_to'):
+            candidates.add(pk)
+            candidates.add(target)
+
+        connections = Annotation.objects.filter(
+                                        type='connection',
+                                        dragable__team=team_id).filter(
+                                            Q(dragable__in=frontier) |
+                                            Q(connected_dragable__in=frontier))
+        for source, target in connections.values_list('dragable',
+                                                      'connected_dragable'):
+            candidates.add(source)
+            candidates.add(target)
+
+        # visited dragables close a cycle, don't walk them again
+        candidates.difference_update(visited)
+        candidates.discard(None)
+
+        if not candidates:
+            break
+
+        frontier = set(Dragable.objects.filter(pk__in=candidates,
+                                               team=team_id
+                                      ).values_list('pk', flat=True))
+        visited.update(frontier)
+        found.extend([(pk, level) for pk in sorted(frontier)])
+
+    return found[:limit]
+
+
+def neighbourhood(dragable, depth, limit):
+    """
+    Returns the dragables of ``dragable``'s team that can be reached from it
+    in at most ``depth`` hops over ``connected_to`` links and connection
+    annotations, in either direction. At most ``limit`` dragables are
+    returned, the closest first.
+
+    The result has the format of ``build_team_graph``, every node carries
+    its distance from ``dragable`` in ``hops``. ``truncated`` is true, if
+    dragables were left out because of ``limit``.
+    """
+    if supports_recursive_queries():
+        found = _neighbours_recursive(dragable, depth, limit + 1)
+    else:
+        found = _neighbours_by_level(dragable, depth, limit + 1)
+
+    truncated = len(found) > limit
+    hops = dict(found[:limit])
+    ids = hops.keys()
+
+    graph = _build_graph(
+        Dragable.objects.filter(pk__in=ids),
+        Annotation.objects.filter(dragable__in=ids,
+                                  connected_dragable__in=ids),
+        ('pk',))
+
+    for node in graph['nodes']:
+        node['hops'] = hops[node.pop('pk')]
+    graph['nodes'].sort(key=lambda node: node['hops'])
+
+    # links to dragables outside of the neighbourhood are left out
+    hashes = set([node['hash'] for node in graph['nodes']])
+    for source, targets in graph['connected_to'].items():
+        targets = [t for t in targets if t in hashes]
+        if targets:
+            graph['connected_to'][source] = targets
+        else:
+            del graph['connected_to'][source]
+
+    graph['truncated'] = truncated
+    return graph
@@ -0,0 +1,220 @@
+"""
+Compact keys for the hashes of dragables and annotations.
+
+The hashes are chosen by the clients and can be any string of up to 128
+characters, so they can't be packed into a fixed width without loss. They
+are kept as they are, but without an index, and the SHA-1 digest of each
+hash is stored next to it in a 20 byte binary column, which carries the
+unique index instead. All lookups by hash go through that index.
+
+``HashManager`` rewrites the exact and ``in`` lookups of ``hash`` in
+``filter``, ``exclude`` and ``get``, in keyword arguments and in ``Q``
+objects and also after ``values``, ``values_list`` or ``dates``, into
+lookups of the digest and the hash together. The database finds the rows by
+the digest and compares the strings of those only, so a collision of two
+digests can't return the wrong row. The callers keep working with the
+strings. Raw SQL (``extra``, ``raw``) and subqueries as values aren't
+rewritten, they compare the unindexed strings.
+
+Uniqueness is enforced by the index of the digest, which model forms don't
+know about. A duplicate hash makes ``save`` raise ``IntegrityError``, unless
+the form checks it like ``core.forms.HashForm`` (used by the admin). Two
+different hashes with the same digest can't be stored either, the second one
+raises ``IntegrityError`` in any case.
+"""
+
+from hashlib import sha1
+
+from django.db import connection
+from django.db import models
+from django.db.models.query import QuerySet
+from django.utils.tree import Node
+from django.utils.translation import ugettext_lazy as _
+
+# bytes of a SHA-1 digest
+DIGEST_SIZE = 20
+
+# rows per batch of fill_keys()
+BATCH_SIZE = 1000
+
+# the lookups that can use the digest, the others need the hash itself
+_LOOKUPS = ('', '__exact', '__in')
+
+
+def hash_digest(hash):
+    """
+    Returns the digest of ``hash`` that is stored in the key.
+    """
+    if hash is None:
+        return None
+    if isinstance(hash, unicode):
+        hash = hash.encode('utf-8')
+    return sha1(hash).digest()
+
+
+class HashKeyField(models.Field):
+    """
+    The digest of the string in the field named ``source``, computed when
+    the instance is saved. Lookups take the strings, not the digests.
+    """
+    __metaclass__ = models.SubfieldBase
+
+    description = _('Digest of a hash')
+
+    def __init__(self, source, *args, **kwargs):
+        self.source = source
+        kwargs.setdefault('editable', False)
+        super(HashKeyField, self).__init__(*args, **kwargs)
+
+
+    def db_type(self, connection):
+        engine = connection.settings_dict['ENGINE']
+        if 'mysql' in engine:
+            return 'binary(%d)' % DIGEST_SIZE
+        if 'postgresql' in engine:
+            return 'bytea'
+        if 'oracle' in engine:
+            return 'raw(%d)' % DIGEST_SIZE
+        return 'blob'
+
+
+    def to_python(self, value):
+        # the database adapters return buffers, they can't be pickled
+        if isinstance(value, buffer):
+            return str(value)
+        return value
+
+
+    def pre_save(self, model_instance, add):
+        hash = getattr(model_instance, self.source)
+        setattr(model_instance, self.attname, hash_digest(hash))
+        # get_db_prep_save() digests it
+        return hash
+
+
+    def get_prep_value(self, value):
+        return hash_digest(value)
+
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if not prepared:
+            value = self.get_prep_value(value)
+        if value is None or 'mysql' in connection.settings_dict['ENGINE']:
+            return value
+        # binary, not text
+        return buffer(value)
+
+
+def _key_lookup(lookup, value):
+    # the lookup of the digest that goes with ``lookup``, or ``None``
+    if hasattr(value, 'query') or hasattr(value, 'as_sql'):
+        # a subquery, it yields hashes and not digests
+        return None
+    for suffix in _LOOKUPS:
+        path = 'hash' + suffix
+        if lookup == path or lookup.endswith('__' + path):
+            return lookup[:-len(path)] + 'hash_key' + suffix
+    return None
+
+
+def _key_lookups(kwargs):
+    lookups = {}
+    for lookup, value in kwargs.items():
+        key_lookup = _key_lookup(lookup, value)
+        if key_lookup:
+            if key_lookup.endswith('__in'):
+                # both lookups iterate over it, a generator only once
+                value = list(value)
+            lookups[key_lookup] = value
+        lookups[lookup] = value
+    return lookups
+
+
+def _key_q(node):
+    # a copy of the Q object ``node`` with the lookups of the digests added
+    clone = Node.__new__(type(node))
+    clone.__dict__.update(node.__dict__)
+    clone.children = []
+    for child in node.children:
+        if isinstance(child, Node):
+            clone.children.append(_key_q(child))
+            continue
+        lookup, value = child
+        if _key_lookup(lookup, value):
+            clone.children.append(type(node)(**_key_lookups({lookup: value})))
+        else:
+            clone.children.append(child)
+    return clone
+
+
+class HashLookups(object):
+    """
+    Mixin for querysets, rewrites the lookups of the hash (see above).
+    """
+
+    def _filter_or_exclude(self, negate, *args, **kwargs):
+        args = [isinstance(arg, Node) and _key_q(arg) or arg for arg in args]
+        return super(HashLookups, self)._filter_or_exclude(
+                                        negate, *args, **_key_lookups(kwargs))
+
+
+    def _clone(self, klass=None, *args, **kwargs):
+        # values() and the like switch to another queryset class
+        if klass is not None and not issubclass(klass, HashLookups):
+            klass = _hash_class(klass)
+        return super(HashLookups, self)._clone(klass, *args, **kwargs)
+
+
+_hash_classes = {}
+
+
+def _hash_class(klass):
+    if klass not in _hash_classes:
+        _hash_classes[klass] = type('Hash%s' % klass.__name__,
+                                    (HashLookups, klass),
+                                    {})
+    return _hash_classes[klass]
+
+
+class HashQuerySet(HashLookups, QuerySet):
+    pass
+
+
+class HashManager(models.Manager):
+    """
+    The manager of the models with a ``hash`` and a ``hash_key``.
+    """
+
+    def get_query_set(self):
+        return HashQuerySet(self.model, using=self._db)
+
+
+def fill_keys(table, batch_size=BATCH_SIZE):
+    """
+    Stores the digests of the hashes in the ``hash_key`` column of all rows
+    of ``table`` (used by the migration ``0006_hash_keys``). The rows are
+    read and updated in batches of ``batch_size`` in the order of their
+    primary keys, so large tables aren't loaded at once.
+    """
+    qn = connection.ops.quote_name
+    field = HashKeyField('hash')
+    cursor = connection.cursor()
+    last_id = 0
+
+    while True:
+        cursor.execute('SELECT %s, %s FROM %s WHERE %s > %%s '
+                       'ORDER BY %s LIMIT %d'
+                       % (qn('id'), qn('hash'), qn(table), qn('id'),
+                          qn('id'), batch_size),
+                       [last_id])
+        rows = cursor.fetchall()
+        if not rows:
+            return
+
+        cursor.executemany('UPDATE %s SET %s = %%s WHERE %s = %%s'
+                           % (qn(table), qn('hash_key'), qn('id')),
+                           [(field.get_db_prep_value(hash,
+                                                     connection=connection),
+                             id)
+                            for id, hash in rows])
+        last_id = rows[-1][0]
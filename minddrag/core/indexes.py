@@ -0,0 +1,96 @@
+"""
+Composite indexes for the access paths of the API and the views.
+
+Django can't declare indexes over several columns, so they are listed here
+and created on ``syncdb`` for databases that aren't migrated (e.g. the test
+database). The migration ``0005_access_path_indexes`` holds its own copy of
+the list, changes to it need a new migration.
+
+The columns follow the queries: the equality filter first, then the sort
+order, then the primary key, which every keyset ordering ends with (see
+``api.pagination``).
+"""
+
+from django.db import connection
+from django.db.models import get_app
+from django.db.models.signals import post_syncdb
+
+from core.models import Dragable
+
+INDEXES = (
+    # the teams, ordered by creation time
+    ('core_team', ('created', 'id')),
+    # the dragables of a team, ordered by creation time
+    ('core_dragable', ('team_id', 'created', 'id')),
+    # the dragables of a team changed since a point in time (sync)
+    ('core_dragable', ('team_id', 'updated', 'id')),
+    # the dragables a user created (core.views.my_dragables)
+    ('core_dragable', ('created_by_id', 'created', 'id')),
+    # the annotations of a dragable, ordered by creation time
+    ('core_annotation', ('dragable_id', 'created', 'id')),
+    # the annotations changed since a point in time (sync)
+    ('core_annotation', ('updated', 'id')),
+    # the tombstones of a team since a point in time (sync)
+    ('core_tombstone', ('team_id', 'kind', 'deleted')),
+)
+
+
+def index_name(table, columns):
+    return '%s_%s' % (table, '_'.join(columns))
+
+
+def _is_mysql():
+    return 'mysql' in connection.settings_dict['ENGINE']
+
+
+def _index_names(cursor, table):
+    if _is_mysql():
+        cursor.execute('SHOW INDEX FROM %s'
+                       % connection.ops.quote_name(table))
+        return set([row[2] for row in cursor.fetchall()])
+
+    if 'sqlite3' in connection.settings_dict['ENGINE']:
+        cursor.execute("SELECT name FROM sqlite_master "
+                       "WHERE type = 'index' AND tbl_name = %s", [table])
+    else:
+        cursor.execute('SELECT indexname FROM pg_indexes '
+                       'WHERE tablename = %s', [table])
+    return set([row[0] for row in cursor.fetchall()])
+
+
+def create_indexes():
+    """
+    Creates the indexes that don't exist yet.
+    """
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    for table, columns in INDEXES:
+        name = index_name(table, columns)
+        if name in _index_names(cursor, table):
+            continue
+        cursor.execute('CREATE INDEX %s ON %s (%s)'
+                       % (qn(name),
+                          qn(table),
+                          ', '.join([qn(column) for column in columns])))
+
+
+def drop_indexes():
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    for table, columns in INDEXES:
+        if _is_mysql():
+            cursor.execute('DROP INDEX %s ON %s'
+                           % (qn(index_name(table, columns)), qn(table)))
+        else:
+            cursor.execute('DROP INDEX %s'
+                           % qn(index_name(table, columns)))
+
+
+def _create_indexes(sender, created_models, **kwargs):
+    # sent once per app, and by flush
+    if sender is get_app('core') and Dragable in created_models:
+        create_indexes()
+
+
+post_syncdb.connect(_create_indexes,
+                    dispatch_uid='core.indexes.create_indexes')
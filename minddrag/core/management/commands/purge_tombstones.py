@@ -0,0 +1,16 @@
+"""
+Deletes the tombstones of deleted dragables and annotations that are older
+than ``SYNC_TOMBSTONE_DAYS``. Meant to be run daily by cron.
+"""
+
+from django.core.management.base import NoArgsCommand
+
+from core.models import Tombstone
+from core.sync import oldest_tombstone
+
+
+class Command(NoArgsCommand):
+    help = 'Deletes tombstones older than SYNC_TOMBSTONE_DAYS.'
+
+    def handle_noargs(self, **options):
+        Tombstone.objects.filter(deleted__lt=oldest_tombstone()).delete()
@@ -0,0 +1,17 @@
+"""
+Rebuilds the full-text search index from the dragables and annotations in the
+database, e.g. after importing data with signals disabled.
+"""
+
+from django.core.management.base import NoArgsCommand
+
+from core.search import get_backend
+
+
+class Command(NoArgsCommand):
+    help = 'Rebuilds the full-text search index of dragables and annotations.'
+
+    def handle_noargs(self, **options):
+        backend = get_backend()
+        backend.create_index()
+        backend.rebuild_index()
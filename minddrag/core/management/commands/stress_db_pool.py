@@ -0,0 +1,44 @@
+"""
+Compares the latency of requests with plain and with pooled database
+connections (see ``core.db.stress``) and prints the results as JSON.
+"""
+
+from optparse import make_option
+import sys
+
+from django.core.management.base import NoArgsCommand
+from django.db import connections
+from django.utils import simplejson
+
+from core.db import stress
+
+
+class Command(NoArgsCommand):
+    help = ('Compares the latency of requests with plain and with pooled '
+            'database connections and prints the results as JSON.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--database', default='default',
+                    help='Alias of the database (default "default").'),
+        make_option('--threads', type='int', default=10,
+                    help='Concurrent requests (default 10).'),
+        make_option('--requests', type='int', default=1000,
+                    help='Requests per thread (default 1000).'),
+        make_option('--queries', type='int', default=3,
+                    help='Queries per request (default 3).'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        def log(message):
+            if verbosity:
+                sys.stderr.write('%s\n' % message)
+
+        results = stress.run(connections[options['database']].settings_dict,
+                             threads=options['threads'],
+                             requests=options['requests'],
+                             queries=options['queries'],
+                             log=log)
+        sys.stdout.write(simplejson.dumps(results, indent=4, sort_keys=True)
+                         + '\n')
@@ -0,0 +1,414 @@
+"""
+Request metrics per handler method and view.
+
+For every request the API resources and the views record the latency, the
+number and duration of database queries, the time spent serializing the
+response and the size of the response. The numbers are aggregated in memory
+per process (``registry``), and can be read as a ``dict`` or in the text
+format of Prometheus, together with the numbers of the database connection
+pools (see ``core.db.pool``).
+
+Queries are counted by wrapping the cursors of the database connections of
+the current thread while a request is measured, so this works with
+``DEBUG = False`` and costs next to nothing per query.
+"""
+
+from bisect import bisect_left
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.utils.functional import wraps
+
+from core.db import pool
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+_local = threading.local()
+
+
+class Histogram(object):
+    """
+    Counts observations in buckets with the given upper bounds.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+    def cumulative(self):
+        """
+        Returns ``(upper bound, count)`` tuples like Prometheus expects
+        them, the last bound is ``'+Inf'``.
+        """
+        total = 0
+        result = []
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Stats(object):
+    """
+    The aggregated measurements of one handler method or view.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.queries = 0
+        self.query_time = 0.0
+        self.serialization_time = 0.0
+        self.response_bytes = 0
+
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'latency': {
+                'sum': self.latency.sum,
+                'buckets': [[bound, count] for bound, count
+                            in self.latency.cumulative()],
+            },
+            'queries': self.queries,
+            'query_time': self.query_time,
+            'serialization_time': self.serialization_time,
+            'response_bytes': self.response_bytes,
+        }
+
+
+class Registry(object):
+    """
+    The ``Stats`` of all handler methods and views of this process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+        self.stats = {}
+        self.started = time.time()
+
+
+    def record(self, timer, status, response_bytes):
+        latency = time.time() - timer.start
+
+        self.lock.acquire()
+        try:
+            stats = self.stats.get(timer.name)
+            if stats is None:
+                stats = self.stats[timer.name] = Stats()
+            stats.requests += 1
+            if status >= 500:
+                stats.errors += 1
+            stats.latency.observe(latency)
+            stats.queries += timer.queries
+            stats.query_time += timer.query_time
+            stats.serialization_time += timer.serialization_time
+            stats.response_bytes += response_bytes
+        finally:
+            self.lock.release()
+
+
+    def as_dict(self):
+        self.lock.acquire()
+        try:
+            return {
+                'pid': os.getpid(),
+                'since': self.started,
+                'handlers': dict([(name, stats.as_dict())
+                                  for name, stats in self.stats.items()]),
+                'database_pools': pool.get_stats(),
+            }
+        finally:
+            self.lock.release()
+
+
+    def as_prometheus(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        self.lock.acquire()
+        try:
+            stats = sorted(self.stats.items())
+        finally:
+            self.lock.release()
+
+        lines = []
+
+        def metric(name, kind, help, value):
+            lines.append('# HELP minddrag_%s %s' % (name, help))
+            lines.append('# TYPE minddrag_%s %s' % (name, kind))
+            for handler, s in stats:
+                lines.append('minddrag_%s{handler="%s"} %r'
+                             % (name, handler, value(s)))
+
+        metric('requests_total', 'counter',
+               'Requests per handler method.',
+               lambda s: s.requests)
+        metric('request_errors_total', 'counter',
+               'Requests per handler method that failed with a 5xx status.',
+               lambda s: s.errors)
+
+        lines.append('# HELP minddrag_request_duration_seconds '
+                     'Latency per handler method.')
+        lines.append('# TYPE minddrag_request_duration_seconds histogram')
+        for handler, s in stats:
+            for bound, count in s.latency.cumulative():
+                lines.append('minddrag_request_duration_seconds_bucket'
+                             '{handler="%s",le="%s"} %d'
+                             % (handler, bound, count))
+            lines.append('minddrag_request_duration_seconds_sum'
+                         '{handler="%s"} %r' % (handler, s.latency.sum))
+            lines.append('minddrag_request_duration_seconds_count'
+                         '{handler="%s"} %d' % (handler, s.latency.count))
+
+        metric('db_queries_total', 'counter',
+               'Database queries per handler method.',
+               lambda s: s.queries)
+        metric('db_query_seconds_total', 'counter',
+               'Time spent in database queries per handler method.',
+               lambda s: s.query_time)
+        metric('serialization_seconds_total', 'counter',
+               'Time spent serializing responses per handler method.',
+               lambda s: s.serialization_time)
+        metric('response_bytes_total', 'counter',
+               'Bytes sent per handler method.',
+               lambda s: s.response_bytes)
+
+        pools = sorted(pool.get_stats().items())
+        for key, name, kind, help in (
+                ('open', 'open', 'gauge',
+                 'Open connections, idle and in use.'),
+                ('idle', 'idle', 'gauge', 'Idle connections.'),
+                ('checkouts', 'checkouts_total', 'counter',
+                 'Connections handed out.'),
+                ('created', 'created_total', 'counter',
+                 'Connections opened.'),
+                ('expired', 'expired_total', 'counter',
+                 'Connections closed because of their age.'),
+                ('failed_checks', 'failed_checks_total', 'counter',
+                 'Idle connections that failed the check.'),
+                ('waits', 'waits_total', 'counter',
+                 'Checkouts that had to wait.'),
+                ('wait_time', 'wait_seconds_total', 'counter',
+                 'Time spent waiting for a connection.'),
+                ('timeouts', 'timeouts_total', 'counter',
+                 'Checkouts that gave up waiting.')):
+            lines.append('# HELP minddrag_db_pool_%s %s' % (name, help))
+            lines.append('# TYPE minddrag_db_pool_%s %s' % (name, kind))
+            for alias, stats in pools:
+                lines.append('minddrag_db_pool_%s{database="%s"} %r'
+                             % (name, alias, stats[key]))
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class CountingCursor(object):
+    """
+    Adds the number and duration of the queries run with ``cursor`` to
+    ``timer``.
+    """
+
+    def __init__(self, cursor, timer):
+        self.cursor = cursor
+        self.timer = timer
+
+
+    def execute(self, sql, params=()):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.timer.queries += 1
+            self.timer.query_time += time.time() - start
+
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.timer.queries += 1
+            self.timer.query_time += time.time() - start
+
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+class Timer(object):
+    """
+    The measurements of one request, while it is running.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.queries = 0
+        self.query_time = 0.0
+        self.serialization_time = 0.0
+        # the connections whose cursors are counted, with the cursor
+        # methods they had before
+        self.cursors = []
+
+
+    def serializing(self, func, *args, **kwargs):
+        """
+        Calls ``func`` and adds the time it took, except for the time spent
+        in database queries, to the serialization time.
+        """
+        start = time.time()
+        query_time = self.query_time
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.serialization_time += ((time.time() - start) -
+                                        (self.query_time - query_time))
+
+
+def is_enabled():
+    return getattr(settings, 'METRICS_ENABLED', True)
+
+
+def current_timer():
+    """
+    Returns the ``Timer`` of the request that is measured in this thread,
+    or ``None``.
+    """
+    return getattr(_local, 'timer', None)
+
+
+def start(name):
+    """
+    Starts measuring a request to the handler method or view ``name`` in
+    this thread. Returns ``None`` if metrics are disabled or a request is
+    measured already.
+    """
+    if not is_enabled() or current_timer() is not None:
+        return None
+
+    timer = Timer(name)
+    resume(timer)
+    return timer
+
+
+def resume(timer):
+    """
+    Counts the queries of this thread for ``timer``'s request.
+    """
+    _local.timer = timer
+    timer.cursors = []
+
+    for connection in connections.all():
+        # connections are thread local, so this only affects this thread
+        timer.cursors.append((connection, connection.__dict__.get('cursor')))
+        connection.cursor = _counting_cursor(connection.cursor, timer)
+
+
+def _counting_cursor(cursor, timer):
+    def counting_cursor():
+        return CountingCursor(cursor(), timer)
+    return counting_cursor
+
+
+def stop(timer):
+    """
+    Stops counting the queries of this thread for ``timer``'s request.
+    """
+    for connection, cursor in timer.cursors:
+        if cursor is None:
+            del connection.cursor
+        else:
+            connection.cursor = cursor
+    timer.cursors = []
+    _local.timer = None
+
+
+def finish(timer, status, response_bytes):
+    """
+    Stops measuring ``timer``'s request and records it.
+    """
+    stop(timer)
+    registry.record(timer, status, response_bytes)
+
+
+def iterate_measured(timer, status, iterable):
+    """
+    Yields the parts of a streamed response and records the request when
+    the last part was sent. The time spent producing the parts counts as
+    serialization time, except for the queries.
+    """
+    resume(timer)
+    response_bytes = 0
+    iterator = iter(iterable)
+
+    try:
+        while True:
+            try:
+                part = timer.serializing(iterator.next)
+            except StopIteration:
+                break
+            response_bytes += len(part)
+            yield part
+    finally:
+        finish(timer, status, response_bytes)
+
+
+def measured(name):
+    """
+    Decorator for views, measures every request to the view as ``name``.
+    """
+    def decorator(view):
+        def wrapper(request, *args, **kwargs):
+            timer = start(name)
+            if timer is None:
+                return view(request, *args, **kwargs)
+
+            status = 500
+            response_bytes = 0
+            try:
+                response = view(request, *args, **kwargs)
+                status = response.status_code
+                response_bytes = len(response.content)
+                return response
+            finally:
+                finish(timer, status, response_bytes)
+        return wraps(view)(wrapper)
+    return decorator
+
+
+def percentile(values, percent):
+    """
+    Returns the ``percent`` percentile of the sorted ``values`` (nearest
+    rank).
+    """
+    if not values:
+        return None
+    rank = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
@@ -0,0 +1,67 @@
+"""
+Middleware for the minddrag project
+"""
+
+from django.conf import settings
+from django.middleware import http
+from django.utils.cache import patch_vary_headers
+
+from core import compression
+
+
+class ConditionalGetMiddleware(http.ConditionalGetMiddleware):
+    """
+    Django's ``ConditionalGetMiddleware`` reads the whole content of every
+    response to set the Content-Length header. That would consume streamed
+    responses before they are sent, so they are passed through untouched.
+    """
+
+    def process_response(self, request, response):
+        if getattr(response, 'streaming', False):
+            return response
+        return super(ConditionalGetMiddleware, self).process_response(request,
+                                                                      response)
+
+
+class CompressionMiddleware(object):
+    """
+    Compresses textual responses with gzip for clients that accept it (see
+    ``core.compression``). Buffered responses shorter than
+    ``COMPRESSION_MIN_LENGTH`` are sent as they are, streamed ones are
+    compressed while they are sent.
+
+    Compressed responses get the ETag of the compressed variant. The ones of
+    requests with a ``compressed_cache_key`` are cached under that key.
+    """
+
+    def process_response(self, request, response):
+        if not compression.is_compressible(response):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if not compression.accepts_gzip(request):
+            return response
+
+        if getattr(response, 'streaming', False):
+            response._container = compression.compress_stream(
+                                                    response._container)
+            if response.has_header('Content-Length'):
+                del response['Content-Length']
+        else:
+            content = response.content
+            if len(content) < getattr(settings, 'COMPRESSION_MIN_LENGTH', 1024):
+                return response
+            compressed = compression.compress(content)
+            if len(compressed) >= len(content):
+                return response
+            response.content = compressed
+            response['Content-Length'] = str(len(compressed))
+
+        response['Content-Encoding'] = 'gzip'
+        if response.has_header('ETag'):
+            response['ETag'] = compression.gzip_etag(response['ETag'])
+
+        key = getattr(request, 'compressed_cache_key', None)
+        if key and not getattr(response, 'streaming', False):
+            compression.cache_compressed(key, response)
+        return response
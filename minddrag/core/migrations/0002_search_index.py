@@ -0,0 +1,61 @@
+
+from south.db import db
+from django.db import connection
+
+# the full-text index as of this migration, core.search may change later
+FTS5_TABLES = (
+    ('core_dragable_fts', ('title', 'text', 'url')),
+    ('core_annotation_fts', ('note', 'description')),
+)
+
+FULLTEXT_INDEXES = (
+    ('core_dragable', 'core_dragable_fulltext', ('title', 'text', 'url')),
+    ('core_annotation', 'core_annotation_fulltext', ('note', 'description')),
+)
+
+
+def _is_mysql():
+    return 'mysql' in connection.settings_dict['ENGINE']
+
+
+class Migration:
+
+    def forwards(self, orm):
+
+        # Adding the full-text search index of dragables and annotations
+        if _is_mysql():
+            for table, name, columns in FULLTEXT_INDEXES:
+                db.execute('CREATE FULLTEXT INDEX %s ON %s (%s)'
+                           % (name, table, ', '.join(columns)))
+            return
+
+        for table, columns in FTS5_TABLES:
+            db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS %s USING '
+                       'fts5(%s, team_id UNINDEXED)'
+                       % (table, ', '.join(columns)))
+
+        table, columns = FTS5_TABLES[0]
+        db.execute('INSERT INTO %s (rowid, %s, team_id) '
+                   'SELECT id, %s, team_id FROM core_dragable'
+                   % (table, ', '.join(columns), ', '.join(columns)))
+
+        table, columns = FTS5_TABLES[1]
+        db.execute('INSERT INTO %s (rowid, %s, team_id) '
+                   'SELECT a.id, %s, d.team_id FROM core_annotation a '
+                   'JOIN core_dragable d ON a.dragable_id = d.id'
+                   % (table,
+                      ', '.join(columns),
+                      ', '.join(['a.%s' % c for c in columns])))
+
+
+
+    def backwards(self, orm):
+
+        # Dropping the full-text search index of dragables and annotations
+        if _is_mysql():
+            for table, name, columns in FULLTEXT_INDEXES:
+                db.execute('DROP INDEX %s ON %s' % (name, table))
+            return
+
+        for table, columns in FTS5_TABLES:
+            db.execute('DROP TABLE IF EXISTS %s' % table)
@@ -0,0 +1,32 @@
+
+from south.db import db
+from django.db import models
+
+class Migration:
+    
+    def forwards(self, orm):
+        
+        # Adding indexes for syncing changes since a point in time
+        db.create_index('core_dragable', ['updated'])
+        db.create_index('core_annotation', ['updated'])
+        
+        # Adding model 'Tombstone'
+        db.create_table('core_tombstone', (
+            ('id', models.AutoField(primary_key=True)),
+            ('kind', models.CharField(max_length=32)),
+            ('hash', models.CharField(max_length=128)),
+            ('team_id', models.IntegerField(db_index=True)),
+            ('deleted', models.DateTimeField(auto_now_add=True, db_index=True)),
+        ))
+        db.send_create_signal('core', ['Tombstone'])
+        
+    
+    
+    def backwards(self, orm):
+        
+        # Deleting model 'Tombstone'
+        db.delete_table('core_tombstone')
+        
+        # Dropping the indexes on 'updated'
+        db.delete_index('core_annotation', ['updated'])
+        db.delete_index('core_dragable', ['updated'])
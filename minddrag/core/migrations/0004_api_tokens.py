@@ -0,0 +1,25 @@
+
+from south.db import db
+from django.db import models
+from django.contrib.auth.models import User
+
+class Migration:
+    
+    def forwards(self, orm):
+        
+        # Adding model 'ApiToken'
+        db.create_table('core_apitoken', (
+            ('id', models.AutoField(primary_key=True)),
+            ('user', models.ForeignKey(User, related_name='api_tokens')),
+            ('digest', models.CharField(max_length=64, unique=True)),
+            ('name', models.CharField(max_length=64, blank=True)),
+            ('created', models.DateTimeField(auto_now_add=True)),
+        ))
+        db.send_create_signal('core', ['ApiToken'])
+        
+    
+    
+    def backwards(self, orm):
+        
+        # Deleting model 'ApiToken'
+        db.delete_table('core_apitoken')
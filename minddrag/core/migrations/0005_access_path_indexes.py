@@ -0,0 +1,44 @@
+
+from south.db import db
+from django.db import connection
+
+# the composite indexes as of this migration, core.indexes may change later
+INDEXES = (
+    ('core_team_created_id', 'core_team', ('created', 'id')),
+    ('core_dragable_team_id_created_id', 'core_dragable',
+     ('team_id', 'created', 'id')),
+    ('core_dragable_team_id_updated_id', 'core_dragable',
+     ('team_id', 'updated', 'id')),
+    ('core_dragable_created_by_id_created_id', 'core_dragable',
+     ('created_by_id', 'created', 'id')),
+    ('core_annotation_dragable_id_created_id', 'core_annotation',
+     ('dragable_id', 'created', 'id')),
+    ('core_annotation_updated_id', 'core_annotation', ('updated', 'id')),
+    ('core_tombstone_team_id_kind_deleted', 'core_tombstone',
+     ('team_id', 'kind', 'deleted')),
+)
+
+
+def _is_mysql():
+    return 'mysql' in connection.settings_dict['ENGINE']
+
+
+class Migration:
+    
+    def forwards(self, orm):
+        
+        # Adding the composite indexes of the access paths
+        for name, table, columns in INDEXES:
+            db.execute('CREATE INDEX %s ON %s (%s)'
+                       % (name, table, ', '.join(columns)))
+        
+    
+    
+    def backwards(self, orm):
+        
+        # Dropping the composite indexes of the access paths
+        for name, table, columns in INDEXES:
+            if _is_mysql():
+                db.execute('DROP INDEX %s ON %s' % (name, table))
+            else:
+                db.execute('DROP INDEX %s' % name)
@@ -0,0 +1,32 @@
+
+from south.db import db
+from django.db import models
+
+from core.hashes import HashKeyField
+from core.hashes import fill_keys
+
+class Migration:
+    
+    def forwards(self, orm):
+        
+        for table in ('core_dragable', 'core_annotation'):
+            # Adding field 'hash_key', filled in batches (see core.hashes)
+            db.add_column(table, 'hash_key', HashKeyField('hash', null=True))
+            fill_keys(table)
+            db.alter_column(table, 'hash_key', HashKeyField('hash'))
+            
+            # Moving the unique index from 'hash' to 'hash_key'
+            db.create_unique(table, ['hash_key'])
+            db.delete_unique(table, ['hash'])
+        
+    
+    
+    def backwards(self, orm):
+        
+        for table in ('core_dragable', 'core_annotation'):
+            # Moving the unique index back to 'hash'
+            db.create_unique(table, ['hash'])
+            db.delete_unique(table, ['hash_key'])
+            
+            # Deleting field 'hash_key'
+            db.delete_column(table, 'hash_key')
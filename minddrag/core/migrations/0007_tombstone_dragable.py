@@ -0,0 +1,17 @@
+
+from south.db import db
+from django.db import models
+
+class Migration:
+    
+    def forwards(self, orm):
+        
+        # Adding field 'Tombstone.dragable_id'
+        db.add_column('core_tombstone', 'dragable_id', models.IntegerField(null=True, blank=True, db_index=True))
+        
+    
+    
+    def backwards(self, orm):
+        
+        # Deleting field 'Tombstone.dragable_id'
+        db.delete_column('core_tombstone', 'dragable_id')
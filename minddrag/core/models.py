@@ -2,10 +2,23 @@
 Models for the core app
 """
 
+import time
+
+from django.conf import settings
+from django.core.cache import cache
 from django.db import models
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.db.models.signals import pre_delete
 from django.contrib.auth.models import User
 from django.utils.translation import ugettext_lazy as _
 
+from core.hashes import HashKeyField
+from core.hashes import HashManager
+from core.routers import alias_for_change
+from core.signals import pre_collect
+
 
 class Team(models.Model):
     """
@@ -32,7 +45,7 @@ class Team(models.Model):
 
 
     def is_member(self, user):
-        return self.members.filter(username=user.username)
+        return self.pk in get_team_ids(user)
 
 
     def save(self, *args, **kwargs):
@@ -53,11 +66,13 @@ class Dragable(models.Model):
         verbose_name_plural = _('dragables')
         ordering = ['created']
 
-    hash = models.CharField(_('hash'), max_length=128, unique=True)
+    # looked up by hash_key (see core.hashes)
+    hash = models.CharField(_('hash'), max_length=128)
+    hash_key = HashKeyField('hash', verbose_name=_('hash key'), unique=True)
     created_by = models.ForeignKey(User, name=_('created by'))
     team = models.ForeignKey(Team, name=_('team'))
     created = models.DateTimeField(_('created'), auto_now_add=True)
-    updated = models.DateTimeField(_('updated'), auto_now=True)
+    updated = models.DateTimeField(_('updated'), auto_now=True, db_index=True)
     url = models.URLField(_('URL'), verify_exists=False)
     title = models.CharField(_('title'), max_length=255, blank=True)
     text = models.TextField(_('text'), blank=True)
@@ -67,13 +82,22 @@ class Dragable(models.Model):
                                      blank=True,
                                      null=True)
 
+    objects = HashManager()
+
 
     def can_modify(self, user):
         """
         Returns true, if the user created the dragable, or is a member of
         the team the dragable belongs to.
         """
-        return (self.created_by == user) or self.team.is_member(user)
+        return ((self.created_by_id == user.id) or
+                (self.team_id in get_team_ids(user)))
+
+
+    def _collect_sub_objects(self, seen_objs, parent=None, nullable=False):
+        # a deletion starts, see core.sync
+        pre_collect.send(sender=Dragable, instance=self)
+        super(Dragable, self)._collect_sub_objects(seen_objs, parent, nullable)
 
 
     def __unicode__(self):
@@ -100,11 +124,13 @@ class Annotation(models.Model):
         ordering = ['created']
 
     # common fields
-    hash = models.CharField(_('hash'), max_length=128, unique=True)
+    # looked up by hash_key (see core.hashes)
+    hash = models.CharField(_('hash'), max_length=128)
+    hash_key = HashKeyField('hash', verbose_name=_('hash key'), unique=True)
     dragable = models.ForeignKey(Dragable, name=_('dragable'))
     created_by = models.ForeignKey(User, name=_('created_by'))
     created = models.DateTimeField(_('created'), auto_now_add=True)
-    updated = models.DateTimeField(_('updated'), auto_now=True)
+    updated = models.DateTimeField(_('updated'), auto_now=True, db_index=True)
     type = models.CharField(_('type'), max_length=32, choices=TYPE_CHOICES)
     # note annotation field
     note = models.TextField(_('note'), blank=True)
@@ -120,5 +146,206 @@ class Annotation(models.Model):
                                            blank=True,
                                            null=True)
 
+    objects = HashManager()
+
+    def _collect_sub_objects(self, seen_objs, parent=None, nullable=False):
+        # a deletion starts, see core.sync
+        pre_collect.send(sender=Annotation, instance=self)
+        super(Annotation, self)._collect_sub_objects(seen_objs, parent,
+                                                     nullable)
+
+
+    def __unicode__(self):
+        return self.hash
+
+
+class Tombstone(models.Model):
+    """
+    Remembers a deleted dragable or annotation, so that clients syncing their
+    copy of a team learn about the deletion.
+    """
+    KIND_CHOICES = (
+        (u'dragable', _('Dragable')),
+        (u'annotation', _('Annotation')),
+    )
+
+    class Meta:
+        verbose_name = _('tombstone')
+        verbose_name_plural = _('tombstones')
+        ordering = ['deleted']
+
+    kind = models.CharField(_('kind'), max_length=32, choices=KIND_CHOICES)
+    hash = models.CharField(_('hash'), max_length=128)
+    # not a foreign key, the team might be gone as well
+    team_id = models.IntegerField(_('team id'), db_index=True)
+    # the dragable of a deleted annotation
+    dragable_id = models.IntegerField(_('dragable id'), null=True, blank=True,
+                                      db_index=True)
+    deleted = models.DateTimeField(_('deleted'), auto_now_add=True,
+                                   db_index=True)
+
     def __unicode__(self):
         return self.hash
+
+
+class ApiToken(models.Model):
+    """
+    A token for the API, issued to a user (see ``core.tokens``). Only the
+    SHA-256 digest of the token is stored, the token itself is shown once.
+    Deleting the token revokes it.
+    """
+
+    class Meta:
+        verbose_name = _('API token')
+        verbose_name_plural = _('API tokens')
+        ordering = ['created']
+
+    user = models.ForeignKey(User,
+                             verbose_name=_('user'),
+                             related_name='api_tokens')
+    digest = models.CharField(_('digest'), max_length=64, unique=True)
+    name = models.CharField(_('name'), max_length=64, blank=True)
+    created = models.DateTimeField(_('created'), auto_now_add=True)
+
+    def __unicode__(self):
+        return self.name or unicode(self.pk)
+
+
+# ==============================================================================
+# team membership cache
+# ==============================================================================
+
+# generations are kept as long as the cache backend allows, like the team
+# versions (see core.versions)
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def _generation_key(user_id):
+    return 'core.team_ids_generation.%d' % user_id
+
+
+def _membership_key(user_id, generation):
+    return 'core.team_ids.%d.%d' % (user_id, generation)
+
+
+def _changed_key(user_id):
+    return 'core.team_ids_changed.%d' % user_id
+
+
+def _get_generation(user_id):
+    key = _generation_key(user_id)
+    generation = cache.get(key)
+    if generation is None:
+        # a fresh generation is larger than any evicted one
+        cache.add(key, int(time.time() * 1000000), GENERATION_TIMEOUT)
+        generation = cache.get(key)
+    return generation
+
+
+def get_team_ids(user):
+    """
+    Returns the set of ids of the teams that ``user`` is a member of.
+
+    The set is cached per user and invalidated whenever the members of a team
+    change, so permission checks don't need to query the membership table.
+    It's read from the primary database while the user's memberships have
+    changed within the lag of the replicas (see
+    ``core.routers.is_replicated``), a lagging replica could still list a
+    removed member.
+
+    The cache key holds a generation of the user's memberships, which
+    ``invalidate_team_ids`` increments. A set read before an invalidation is
+    stored under the old generation, where it is never found again, so it
+    can't outlive the invalidation.
+    """
+    if not user.is_authenticated():
+        return frozenset()
+
+    key = _membership_key(user.id, _get_generation(user.id))
+    team_ids = cache.get(key)
+
+    if team_ids is None:
+        changed = cache.get(_changed_key(user.id), 0)
+        memberships = Team.members.through.objects.using(
+                            alias_for_change(changed)).filter(user=user.id)
+        team_ids = frozenset(memberships.values_list('team', flat=True))
+        cache.set(key,
+                  team_ids,
+                  getattr(settings, 'MEMBERSHIP_CACHE_TIMEOUT', 60 * 60))
+
+    return team_ids
+
+
+def invalidate_team_ids(user_ids):
+    """
+    Starts a new generation of the cached team ids of the given users.
+    """
+    now = time.time()
+    for user_id in user_ids:
+        # only needed while the replicas may lag behind the change
+        cache.set(_changed_key(user_id),
+                  now,
+                  getattr(settings, 'DATABASE_REPLICA_PIN_SECONDS', 10))
+        key = _generation_key(user_id)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # not cached (anymore), a fresh generation is larger
+            cache.add(key, int(time.time() * 1000000), GENERATION_TIMEOUT)
+
+
+def _team_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        # instance is a user
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            invalidate_team_ids([instance.pk])
+        return
+
+    if action == 'pre_clear':
+        instance._cleared_member_ids = list(
+                            instance.members.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        invalidate_team_ids(getattr(instance, '_cleared_member_ids', []))
+    elif action in ('post_add', 'post_remove'):
+        invalidate_team_ids(pk_set or [])
+
+
+def _team_pre_delete(sender, instance, **kwargs):
+    instance._deleted_member_ids = list(
+                            instance.members.values_list('pk', flat=True))
+
+
+def _team_post_delete(sender, instance, **kwargs):
+    invalidate_team_ids(getattr(instance, '_deleted_member_ids', []))
+
+
+def _user_created(sender, instance, created, **kwargs):
+    # user ids can be reused, e.g. after a rollback
+    if created:
+        invalidate_team_ids([instance.pk])
+
+
+m2m_changed.connect(_team_members_changed,
+                    sender=Team.members.through,
+                    dispatch_uid='core.models.team_members_changed')
+pre_delete.connect(_team_pre_delete,
+                   sender=Team,
+                   dispatch_uid='core.models.team_pre_delete')
+post_delete.connect(_team_post_delete,
+                    sender=Team,
+                    dispatch_uid='core.models.team_post_delete')
+post_save.connect(_user_created,
+                  sender=User,
+                  dispatch_uid='core.models.user_created')
+
+
+# keeps the full-text search index current
+import core.search
+# keeps the team versions current
+import core.versions
+# records the tombstones of deleted dragables and annotations
+import core.sync
+# revokes cached API tokens
+import core.tokens
+# creates the composite indexes on syncdb
+import core.indexes
@@ -0,0 +1,196 @@
+"""
+Routing of the core models between the primary database and read replicas.
+
+Reads of the API handlers (``read`` methods) and of the views decorated with
+``reads_from_replica`` may be served by one of the databases listed in
+``DATABASE_REPLICAS``. One replica is picked per request, so a request sees
+one consistent state. Everything else, writes in particular, goes to the
+primary (``default``) database.
+
+Replicas lag behind the primary. After a user has written something
+through the API, the user's reads stay on the primary for
+``DATABASE_REPLICA_PIN_SECONDS``, so the user never reads a state older than
+the user's own writes. The pin lives in the cache and so counts for all
+processes (``core.checks`` requires a shared cache when there are several).
+
+Reads whose results are kept under a version of the data, or that decide
+permissions, must not see a lagging state: a stale result would be cached as
+current. The replicas are assumed to catch up within
+``DATABASE_REPLICA_PIN_SECONDS`` as well, so these reads only go to the
+primary while the data they depend on changed more recently than that (see
+``is_replicated``): the conditional reads of the API after a change to one
+of their teams, the graph of a changed team (``core.graph.get_team_graph``)
+and the team ids of a user whose memberships changed
+(``core.models.get_team_ids``). All other times they are served by the
+replicas like any other read.
+
+Only the ORM is routed. Raw SQL on ``django.db.connection`` (e.g. the graph
+and search queries) keeps using the primary.
+"""
+
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.functional import wraps
+
+# the apps whose models are routed
+ROUTED_APPS = ('core',)
+
+_local = threading.local()
+
+
+class ReplicaRouter(object):
+    """
+    Add ``'core.routers.ReplicaRouter'`` to ``DATABASE_ROUTERS``.
+    """
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label in ROUTED_APPS:
+            return get_read_alias()
+        return None
+
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label in ROUTED_APPS:
+            return DEFAULT_DB_ALIAS
+        return None
+
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas hold the same objects as the primary
+        aliases = [DEFAULT_DB_ALIAS] + list(_replicas())
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+
+    def allow_syncdb(self, db, model):
+        # replicas get their tables by replication
+        if db in _replicas():
+            return False
+        return None
+
+
+class _State(object):
+
+    def __init__(self, request):
+        self.request = request
+        self.alias = None
+
+
+def _replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', ())
+
+
+def _pin_key(user_id):
+    return 'core.replica_pin.%d' % user_id
+
+
+def start_reading(request):
+    """
+    Lets the following reads of this thread for ``request`` go to a
+    replica. Returns the state for ``stop_reading`` and
+    ``iterate_reading``, or ``None`` if there are no replicas.
+    """
+    if not _replicas():
+        return None
+    state = _local.state = _State(request)
+    return state
+
+
+def stop_reading():
+    _local.state = None
+
+
+def get_read_alias():
+    """
+    Returns the database for reads of routed models in this thread, or
+    ``None`` for the default.
+    """
+    state = getattr(_local, 'state', None)
+    if state is None:
+        return None
+
+    if state.alias is None:
+        # decided at the first query, the user is authenticated by then
+        if is_pinned(state.request.user):
+            state.alias = DEFAULT_DB_ALIAS
+        else:
+            state.alias = random.choice(_replicas())
+    return state.alias
+
+
+def is_replicated(modified):
+    """
+    Returns true, if a change at ``modified`` (seconds since the epoch) has
+    reached the replicas, i.e. it is older than the lag they are allowed.
+    """
+    seconds = getattr(settings, 'DATABASE_REPLICA_PIN_SECONDS', 10)
+    return modified < time.time() - seconds
+
+
+def alias_for_change(modified):
+    """
+    Returns the database for a read of data that last changed at
+    ``modified``: the primary, if the replicas may not have the change yet,
+    else ``None``, which leaves the choice to the router.
+    """
+    if is_replicated(modified):
+        return None
+    return DEFAULT_DB_ALIAS
+
+
+def read_from_primary():
+    """
+    Lets the remaining reads of this thread go to the primary.
+    """
+    state = getattr(_local, 'state', None)
+    if state is not None:
+        state.alias = DEFAULT_DB_ALIAS
+
+
+def pin(user):
+    """
+    Keeps the reads of ``user`` on the primary for
+    ``DATABASE_REPLICA_PIN_SECONDS``, after the user has written.
+    """
+    if user.is_authenticated() and _replicas():
+        seconds = getattr(settings, 'DATABASE_REPLICA_PIN_SECONDS', 10)
+        cache.set(_pin_key(user.id), time.time() + seconds, seconds)
+
+
+def is_pinned(user):
+    if not user.is_authenticated():
+        return False
+    until = cache.get(_pin_key(user.id))
+    return until is not None and until > time.time()
+
+
+def iterate_reading(state, iterable):
+    """
+    Yields the parts of a streamed response, whose queries run while the
+    parts are produced, with the reads routed like before.
+    """
+    _local.state = state
+    try:
+        for part in iterable:
+            yield part
+    finally:
+        stop_reading()
+
+
+def reads_from_replica(view):
+    """
+    Decorator for views that only read.
+    """
+    def wrapper(request, *args, **kwargs):
+        start_reading(request)
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            stop_reading()
+    return wraps(view)(wrapper)
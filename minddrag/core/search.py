@@ -0,0 +1,344 @@
+"""
+Full-text search over dragables and annotations.
+
+Two backends are available, selected with the ``SEARCH_BACKEND`` setting:
+
+- ``SQLiteFTS5Backend`` keeps an FTS5 table per model next to the model
+  tables and updates it from the ``post_save`` and ``post_delete`` signals.
+- ``MySQLFullTextBackend`` uses ``FULLTEXT`` indexes on the model tables,
+  which MySQL keeps current by itself.
+
+Both backends rank the matches (BM25 with FTS5, MySQL's relevance otherwise)
+and return them in order of ascending ``rank``, so that callers can page
+through the results with a ``(rank, id)`` keyset.
+"""
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.db.models.signals import post_syncdb
+from django.utils.importlib import import_module
+
+from core.models import Annotation
+from core.models import Dragable
+from core.signals import post_bulk_save
+
+
+class SearchBackend(object):
+    """
+    Base class of the search backends.
+    """
+
+    def search(self, model, terms, team_ids, after=None, limit=25):
+        """
+        Returns a list of ``(id, rank)`` tuples of the ``model`` instances
+        (``Dragable`` or ``Annotation``) in the given teams that match
+        ``terms``, best match first. ``after`` is the ``(rank, id)`` of the
+        last result of the previous page.
+        """
+        raise NotImplementedError
+
+
+    def create_index(self):
+        """
+        Creates whatever the backend needs in the database.
+        """
+        pass
+
+
+    def drop_index(self):
+        """
+        Removes what ``create_index`` created.
+        """
+        pass
+
+
+    def rebuild_index(self):
+        """
+        Indexes all existing dragables and annotations.
+        """
+        pass
+
+
+    def index_dragables(self, dragables, created=False):
+        pass
+
+
+    def index_annotations(self, annotations, created=False):
+        pass
+
+
+    def remove(self, model, ids):
+        pass
+
+
+def _words(terms):
+    return [word for word in terms.split() if word]
+
+
+class SQLiteFTS5Backend(SearchBackend):
+    """
+    Search backend for SQLite, based on FTS5 tables.
+    """
+    tables = {
+        Dragable: ('core_dragable_fts', ('title', 'text', 'url')),
+        Annotation: ('core_annotation_fts', ('note', 'description')),
+    }
+
+    # bm25 column weights, a match in the title counts more than in the text
+    weights = {
+        Dragable: (5.0, 1.0, 1.0),
+        Annotation: (1.0, 1.0),
+    }
+
+    def search(self, model, terms, team_ids, after=None, limit=25):
+        words = _words(terms)
+        if not words or not team_ids:
+            return []
+
+        table = self.tables[model][0]
+        # quote every word, so that the search terms can't use FTS5 syntax
+        match = ' '.join(['"%s"' % w.replace('"', '""') for w in words])
+        weights = ', '.join([repr(w) for w in self.weights[model]])
+        team_ids = list(team_ids)
+        params = [match] + team_ids
+
+        sql = ('SELECT id, score FROM ('
+               'SELECT rowid AS id, bm25(%s, %s) AS score FROM %s '
+               'WHERE %s MATCH %%s AND team_id IN (%s))'
+               % (table, weights, table, table,
+                  ', '.join(['%s'] * len(team_ids))))
+
+        if after:
+            sql += ' WHERE score > %s OR (score = %s AND id > %s)'
+            params += [after[0], after[0], after[1]]
+
+        sql += ' ORDER BY score, id LIMIT %s'
+        params.append(limit)
+
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+    def create_index(self):
+        cursor = connection.cursor()
+        for table, columns in self.tables.values():
+            cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS %s USING '
+                           'fts5(%s, team_id UNINDEXED)'
+                           % (table, ', '.join(columns)))
+
+
+    def drop_index(self):
+        cursor = connection.cursor()
+        for table, columns in self.tables.values():
+            cursor.execute('DROP TABLE IF EXISTS %s' % table)
+
+
+    def rebuild_index(self):
+        cursor = connection.cursor()
+        for table, columns in self.tables.values():
+            cursor.execute('DELETE FROM %s' % table)
+
+        table, columns = self.tables[Dragable]
+        cursor.execute('INSERT INTO %s (rowid, %s, team_id) '
+                       'SELECT id, %s, team_id FROM core_dragable'
+                       % (table, ', '.join(columns), ', '.join(columns)))
+
+        table, columns = self.tables[Annotation]
+        cursor.execute('INSERT INTO %s (rowid, %s, team_id) '
+                       'SELECT a.id, %s, d.team_id FROM core_annotation a '
+                       'JOIN core_dragable d ON a.dragable_id = d.id'
+                       % (table,
+                          ', '.join(columns),
+                          ', '.join(['a.%s' % c for c in columns])))
+
+
+    def index_dragables(self, dragables, created=False):
+        table, columns = self.tables[Dragable]
+        rows = [[d.pk] + [getattr(d, c) for c in columns] + [d.team_id]
+                for d in dragables]
+        self._replace(table, columns, rows, created)
+
+        if created:
+            return
+
+        # the annotations of a dragable are searched in the dragable's team,
+        # which might just have changed
+        ids = [d.pk for d in dragables]
+        cursor = connection.cursor()
+        cursor.execute('UPDATE core_annotation_fts SET team_id = ('
+                       'SELECT d.team_id FROM core_annotation a '
+                       'JOIN core_dragable d ON a.dragable_id = d.id '
+                       'WHERE a.id = core_annotation_fts.rowid) '
+                       'WHERE rowid IN (SELECT id FROM core_annotation '
+                       'WHERE dragable_id IN (%s))'
+                       % ', '.join(['%s'] * len(ids)),
+                       ids)
+
+
+    def index_annotations(self, annotations, created=False):
+        table, columns = self.tables[Annotation]
+        team_ids = dict(Dragable.objects.filter(
+                            pk__in=set([a.dragable_id for a in annotations])
+                        ).values_list('pk', 'team'))
+        rows = [[a.pk] + [getattr(a, c) for c in columns] +
+                [team_ids.get(a.dragable_id)]
+                for a in annotations]
+        self._replace(table, columns, rows, created)
+
+
+    def remove(self, model, ids):
+        self._delete(self.tables[model][0], list(ids))
+
+
+    def _replace(self, table, columns, rows, created):
+        if not rows:
+            return
+        if not created:
+            self._delete(table, [row[0] for row in rows])
+        cursor = connection.cursor()
+        cursor.executemany('INSERT INTO %s (rowid, %s, team_id) VALUES (%s)'
+                           % (table,
+                              ', '.join(columns),
+                              ', '.join(['%s'] * (len(columns) + 2))),
+                           rows)
+
+
+    def _delete(self, table, ids):
+        if not ids:
+            return
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s WHERE rowid IN (%s)'
+                       % (table, ', '.join(['%s'] * len(ids))),
+                       ids)
+
+
+class MySQLFullTextBackend(SearchBackend):
+    """
+    Search backend for MySQL, based on FULLTEXT indexes. MySQL maintains
+    the indexes itself, so there is nothing to do on saves and deletes.
+    (InnoDB supports FULLTEXT indexes since MySQL 5.6.)
+    """
+    columns = {
+        Dragable: ('d.title', 'd.text', 'd.url'),
+        Annotation: ('a.note', 'a.description'),
+    }
+
+    indexes = (
+        ('core_dragable', 'core_dragable_fulltext', ('title', 'text', 'url')),
+        ('core_annotation', 'core_annotation_fulltext', ('note', 'description')),
+    )
+
+    def search(self, model, terms, team_ids, after=None, limit=25):
+        words = _words(terms)
+        if not words or not team_ids:
+            return []
+
+        match = 'MATCH (%s) AGAINST (%%s IN NATURAL LANGUAGE MODE)' % (
+                                            ', '.join(self.columns[model]))
+        team_ids = list(team_ids)
+        terms = ' '.join(words)
+
+        if model is Dragable:
+            sql = 'SELECT d.id, -%s AS score FROM core_dragable d ' % match
+            key = 'd.id'
+        else:
+            sql = ('SELECT a.id, -%s AS score FROM core_annotation a '
+                   'JOIN core_dragable d ON a.dragable_id = d.id ' % match)
+            key = 'a.id'
+
+        sql += 'WHERE %s AND d.team_id IN (%s)' % (
+                                    match, ', '.join(['%s'] * len(team_ids)))
+        params = [terms, terms] + team_ids
+
+        if after:
+            sql += ' HAVING score > %%s OR (score = %%s AND %s > %%s)' % key
+            params += [after[0], after[0], after[1]]
+
+        sql += ' ORDER BY score, %s LIMIT %%s' % key
+        params.append(limit)
+
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+    def create_index(self):
+        cursor = connection.cursor()
+        for table, name, columns in self.indexes:
+            cursor.execute('SHOW INDEX FROM %s WHERE Key_name = %%s' % table,
+                           [name])
+            if not cursor.fetchall():
+                cursor.execute('CREATE FULLTEXT INDEX %s ON %s (%s)'
+                               % (name, table, ', '.join(columns)))
+
+
+    def drop_index(self):
+        cursor = connection.cursor()
+        for table, name, columns in self.indexes:
+            cursor.execute('DROP INDEX %s ON %s' % (name, table))
+
+
+_backend = None
+
+def get_backend():
+    """
+    Returns the search backend configured with ``SEARCH_BACKEND``.
+    """
+    global _backend
+
+    if _backend is None:
+        path = getattr(settings,
+                       'SEARCH_BACKEND',
+                       'core.search.SQLiteFTS5Backend')
+        module, name = path.rsplit('.', 1)
+        _backend = getattr(import_module(module), name)()
+
+    return _backend
+
+
+def _dragable_saved(sender, instance, created, **kwargs):
+    get_backend().index_dragables([instance], created)
+
+
+def _annotation_saved(sender, instance, created, **kwargs):
+    get_backend().index_annotations([instance], created)
+
+
+def _bulk_saved(sender, instances, created, **kwargs):
+    if sender is Dragable:
+        get_backend().index_dragables(instances, created)
+    elif sender is Annotation:
+        get_backend().index_annotations(instances, created)
+
+
+def _removed(sender, instance, **kwargs):
+    get_backend().remove(sender, [instance.pk])
+
+
+def _create_index(sender, created_models, **kwargs):
+    if Dragable in created_models:
+        backend = get_backend()
+        backend.create_index()
+        # flush sends post_syncdb as well, after emptying the tables
+        backend.rebuild_index()
+
+
+post_save.connect(_dragable_saved,
+                  sender=Dragable,
+                  dispatch_uid='core.search.dragable_saved')
+post_save.connect(_annotation_saved,
+                  sender=Annotation,
+                  dispatch_uid='core.search.annotation_saved')
+post_bulk_save.connect(_bulk_saved,
+                       dispatch_uid='core.search.bulk_saved')
+post_delete.connect(_removed,
+                    sender=Dragable,
+                    dispatch_uid='core.search.dragable_removed')
+post_delete.connect(_removed,
+                    sender=Annotation,
+                    dispatch_uid='core.search.annotation_removed')
+post_syncdb.connect(_create_index,
+                    dispatch_uid='core.search.create_index')
@@ -0,0 +1,14 @@
+"""
+Signals of the core app
+"""
+
+from django.dispatch import Signal
+
+# Sent after a list of instances of one model has been written with a
+# single multi-row statement (see core.bulk), instead of one ``post_save``
+# per instance. ``created`` is true for inserts and false for updates.
+post_bulk_save = Signal(providing_args=['instances', 'created'])
+
+# Sent when a dragable or an annotation is collected for a deletion, before
+# the deletion sends any ``pre_delete`` (Django 1.2 has no signal for it).
+pre_collect = Signal()
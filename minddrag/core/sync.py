@@ -0,0 +1,167 @@
+"""
+Changes to dragables and annotations since a point in time, for clients that
+keep a copy of their teams.
+
+Created and updated objects are found through their (indexed) ``updated``
+field. Deleted objects leave a ``Tombstone`` behind, which is recorded by
+the ``pre_delete`` and ``post_delete`` signals, so it's written for every
+deletion, including the ones that cascade from a deleted dragable or team.
+
+Django sends ``pre_delete`` for every object of a deletion before it deletes
+anything, and ``post_delete`` afterwards. The tombstones of one deletion are
+collected in between and inserted with one statement once the last object is
+gone. The teams of the annotations come from their dragables, which are
+either deleted along with them, or looked up with one query.
+
+The state of a deletion is reset when the next one collects its objects
+(``core.signals.pre_collect``), so a deletion that failed halfway, in a
+request or not, leaves nothing behind for the next one.
+"""
+
+from datetime import datetime
+from datetime import timedelta
+import threading
+
+from django.conf import settings
+from django.db.models.signals import post_delete
+from django.db.models.signals import pre_delete
+
+from core.bulk import insert_rows
+from core.models import Annotation
+from core.models import Dragable
+from core.models import Tombstone
+from core.signals import pre_collect
+
+_local = threading.local()
+
+
+def changes_since(model, since, team_ids, queryset=None, dragable_ids=None):
+    """
+    Returns the ``model`` instances (``Dragable`` or ``Annotation``) in the
+    given teams that were created or updated at or after ``since``, ordered
+    by ``(updated, id)``, and the hashes of the ones that were deleted since
+    then. Both are querysets.
+
+    ``team_ids`` may be a list or a subquery of team ids. ``queryset``
+    replaces the instances in the given teams, it must not contain instances
+    of other teams. ``dragable_ids`` restricts the deleted annotations to the
+    ones of the given dragables, like ``queryset`` may do for the changed
+    ones.
+    """
+    if model is Dragable:
+        kind = 'dragable'
+        if queryset is None:
+            queryset = model.objects.filter(team__in=team_ids)
+    else:
+        kind = 'annotation'
+        if queryset is None:
+            queryset = model.objects.filter(dragable__team__in=team_ids)
+
+    changed = queryset.filter(updated__gte=since).order_by('updated', 'pk')
+    deleted = Tombstone.objects.filter(kind=kind,
+                                       team_id__in=team_ids,
+                                       deleted__gte=since).order_by()
+    if dragable_ids is not None:
+        deleted = deleted.filter(dragable_id__in=dragable_ids)
+
+    return changed, deleted.values_list('hash', flat=True)
+
+
+def is_expired(since):
+    """
+    Returns true, if tombstones from ``since`` might have been purged
+    already (see ``SYNC_TOMBSTONE_DAYS``).
+    """
+    return since < oldest_tombstone()
+
+
+def oldest_tombstone():
+    """
+    Returns the time before which tombstones are purged.
+    """
+    return datetime.now() - timedelta(days=getattr(settings,
+                                                   'SYNC_TOMBSTONE_DAYS',
+                                                   30))
+
+
+def _state():
+    # the deletion in progress in this thread
+    if not hasattr(_local, 'deleting'):
+        _reset()
+    return _local
+
+
+def _reset(**kwargs):
+    # objects between pre_delete and post_delete
+    _local.deleting = 0
+    _local.tombstones = []
+    # dragable id -> team id
+    _local.team_ids = {}
+    # the dragables of annotations, whose teams aren't known yet
+    _local.dragable_ids = set()
+
+
+def _deleting(sender, instance, **kwargs):
+    state = _state()
+    state.deleting += 1
+
+    # the dragables might be deleted along with the annotations, so their
+    # teams are remembered before anything is deleted
+    if sender is Dragable:
+        state.team_ids[instance.pk] = instance.team_id
+        return
+
+    dragable = getattr(instance, '_dragable_cache', None)
+    if dragable is not None:
+        state.team_ids[dragable.pk] = dragable.team_id
+    else:
+        state.dragable_ids.add(instance.dragable_id)
+
+
+def _deleted(sender, instance, **kwargs):
+    state = _state()
+
+    if sender is Dragable:
+        tombstone = Tombstone(kind='dragable',
+                              hash=instance.hash,
+                              team_id=instance.team_id)
+    else:
+        if instance.dragable_id not in state.team_ids:
+            # the dragables that aren't deleted, they still exist
+            missing = state.dragable_ids.difference(state.team_ids)
+            dragables = Dragable.objects.using(instance._state.db).filter(
+                                                        pk__in=missing)
+            state.team_ids.update(dragables.order_by().values_list('pk',
+                                                                   'team'))
+        tombstone = Tombstone(kind='annotation',
+                              hash=instance.hash,
+                              team_id=state.team_ids[instance.dragable_id],
+                              dragable_id=instance.dragable_id)
+    state.tombstones.append(tombstone)
+
+    state.deleting -= 1
+    if state.deleting <= 0:
+        tombstones = state.tombstones
+        _reset()
+        insert_rows(Tombstone, tombstones)
+
+
+pre_delete.connect(_deleting,
+                   sender=Dragable,
+                   dispatch_uid='core.sync.dragable_deleting')
+pre_delete.connect(_deleting,
+                   sender=Annotation,
+                   dispatch_uid='core.sync.annotation_deleting')
+post_delete.connect(_deleted,
+                    sender=Dragable,
+                    dispatch_uid='core.sync.dragable_deleted')
+post_delete.connect(_deleted,
+                    sender=Annotation,
+                    dispatch_uid='core.sync.annotation_deleted')
+# a deletion that failed halfway never got its post_delete signals
+pre_collect.connect(_reset,
+                    sender=Dragable,
+                    dispatch_uid='core.sync.dragable_collect')
+pre_collect.connect(_reset,
+                    sender=Annotation,
+                    dispatch_uid='core.sync.annotation_collect')
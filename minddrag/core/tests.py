@@ -2,11 +2,26 @@
 Tests for the core app
 """
 
+import os
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
 from django.contrib.auth.models import User
 from django.core import mail
 from django.core.urlresolvers import reverse
+from django.db import connection
 from django.test import Client
 from django.test import TestCase
+from django.test import TransactionTestCase
+
+from core.bulk import update_instances
+from core.models import Annotation
+from core.models import Dragable
+from core.models import Team
+from core.models import Tombstone
+from core.models import get_team_ids
+from core.versions import get_team_version
 
 
 class RegisterTest(TestCase):
@@ -65,3 +80,775 @@ class RegisterTest(TestCase):
         # we should be back at the registration form
         self.assert_(register_form_snippet in response.content)
 
+
+
+class MembershipCacheTest(TestCase):
+    """
+    Tests for the cached team memberships
+    """
+
+    def setUp(self):
+        self.owner = User.objects.create_user('owner',
+                                              'owner@example.com',
+                                              'donthackmebro')
+        self.user = User.objects.create_user('member',
+                                             'member@example.com',
+                                             'donthackmebro')
+        self.team = Team(name='cached team', created_by=self.owner)
+        self.team.save()
+
+
+    def _count_queries(self, func, *args):
+        old_debug = settings.DEBUG
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            func(*args)
+            return len(connection.queries)
+        finally:
+            settings.DEBUG = old_debug
+
+
+    def test_owner_is_member(self):
+        self.assert_(self.team.is_member(self.owner))
+        self.failIf(self.team.is_member(self.user))
+
+
+    def test_cached_check_does_not_query(self):
+        self.team.is_member(self.user)
+        self.assertEqual(
+                self._count_queries(self.team.is_member, self.user), 0)
+
+
+    def test_add_and_remove_member(self):
+        self.failIf(self.team.is_member(self.user))
+        self.team.members.add(self.user)
+        self.assert_(self.team.is_member(self.user))
+        self.team.members.remove(self.user)
+        self.failIf(self.team.is_member(self.user))
+
+
+    def test_add_member_through_user(self):
+        self.failIf(self.team.is_member(self.user))
+        self.user.team_members.add(self.team)
+        self.assert_(self.team.is_member(self.user))
+        self.user.team_members.clear()
+        self.failIf(self.team.is_member(self.user))
+
+
+    def test_clear_members(self):
+        self.team.members.add(self.user)
+        self.assert_(self.team.is_member(self.user))
+        self.team.members.clear()
+        self.failIf(self.team.is_member(self.user))
+        self.failIf(self.team.is_member(self.owner))
+
+
+    def test_delete_team(self):
+        team_id = self.team.pk
+        self.assert_(team_id in get_team_ids(self.owner))
+        self.team.delete()
+        self.failIf(team_id in get_team_ids(self.owner))
+
+
+    def test_anonymous_user(self):
+        self.failIf(self.team.is_member(AnonymousUser()))
+
+
+    def test_stale_fill(self):
+        from django.core.cache import cache
+        from core.models import _get_generation
+        from core.models import _membership_key
+
+        # a read of the memberships that started before the removal, and
+        # stores its result after it
+        self.team.members.add(self.user)
+        key = _membership_key(self.user.id, _get_generation(self.user.id))
+        self.team.members.remove(self.user)
+        cache.set(key, frozenset([self.team.pk]))
+        self.failIf(self.team.is_member(self.user))
+
+
+class TeamVersionTest(TestCase):
+    """
+    Tests for the per-team version counters
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user('owner',
+                                             'owner@example.com',
+                                             'donthackmebro')
+        self.team = Team(name='versioned team', created_by=self.user)
+        self.team.save()
+        self.other_team = Team(name='other team', created_by=self.user)
+        self.other_team.save()
+        self.dragable = Dragable(hash='d1',
+                                 team=self.team,
+                                 created_by=self.user,
+                                 url='http://www.example.com/',
+                                 xpath='foo')
+        self.dragable.save()
+
+
+    def test_version_is_stable(self):
+        self.assertEqual(get_team_version(self.team.pk),
+                         get_team_version(self.team.pk))
+
+
+    def test_dragable_writes(self):
+        version = get_team_version(self.team.pk)
+        self.dragable.title = 'changed'
+        self.dragable.save()
+        self.assert_(get_team_version(self.team.pk) > version)
+
+        version = get_team_version(self.team.pk)
+        self.dragable.delete()
+        self.assert_(get_team_version(self.team.pk) > version)
+
+
+    def test_moved_dragable(self):
+        dragable = Dragable.objects.get(pk=self.dragable.pk)
+        version = get_team_version(self.team.pk)
+        other_version = get_team_version(self.other_team.pk)
+        dragable.team = self.other_team
+        dragable.save()
+        self.assert_(get_team_version(self.team.pk) > version)
+        self.assert_(get_team_version(self.other_team.pk) > other_version)
+
+
+    def test_annotation_writes(self):
+        version = get_team_version(self.team.pk)
+        annotation = Annotation(hash='a1',
+                                type='note',
+                                dragable=self.dragable,
+                                created_by=self.user,
+                                note='note')
+        annotation.save()
+        self.assert_(get_team_version(self.team.pk) > version)
+
+        version = get_team_version(self.team.pk)
+        Annotation.objects.get(pk=annotation.pk).delete()
+        self.assert_(get_team_version(self.team.pk) > version)
+
+
+    def test_bulk_writes(self):
+        version = get_team_version(self.team.pk)
+        other_version = get_team_version(self.other_team.pk)
+        self.dragable.title = 'bulk'
+        update_instances(Dragable, [self.dragable], ['title'])
+        self.assert_(get_team_version(self.team.pk) > version)
+        self.assertEqual(get_team_version(self.other_team.pk), other_version)
+
+
+    def test_evicted_version_grows(self):
+        from django.core.cache import cache
+        version = get_team_version(self.team.pk)
+        cache.delete('core.team_version.%d' % self.team.pk)
+        self.assert_(get_team_version(self.team.pk) > version)
+
+
+class TombstoneTest(TestCase):
+    """
+    Tests for the tombstones of deleted dragables and annotations
+    """
+
+    def setUp(self):
+        user = User.objects.create_user('owner',
+                                        'owner@example.com',
+                                        'donthackmebro')
+        self.team = Team(name='team', created_by=user)
+        self.team.save()
+        self.dragable = Dragable(hash='d1',
+                                 team=self.team,
+                                 created_by=user,
+                                 url='http://www.example.com/',
+                                 xpath='foo')
+        self.dragable.save()
+        Annotation(hash='a1',
+                   type='note',
+                   dragable=self.dragable,
+                   created_by=user,
+                   note='note').save()
+
+
+    def test_team_delete(self):
+        team_id = self.team.pk
+        self.team.delete()
+        tombstones = Tombstone.objects.order_by('kind')
+        self.assertEqual([(t.kind, t.hash, t.team_id) for t in tombstones],
+                         [('annotation', 'a1', team_id),
+                          ('dragable', 'd1', team_id)])
+
+
+    def test_cascade_queries(self):
+        dragable = Dragable(hash='d2',
+                            team=self.team,
+                            created_by=self.team.created_by,
+                            url='http://www.example.com/',
+                            xpath='foo')
+        dragable.save()
+        for i in range(10):
+            Annotation(hash='a2-%d' % i,
+                       type='note',
+                       dragable=dragable,
+                       created_by=self.team.created_by,
+                       note='note').save()
+        dragable_id = dragable.pk
+        dragable = Dragable.objects.get(pk=dragable_id)
+
+        old_debug = settings.DEBUG
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            dragable.delete()
+            queries = [query['sql'] for query in connection.queries]
+        finally:
+            settings.DEBUG = old_debug
+
+        # the tombstones of a deletion are written at once, the team is
+        # known from the deleted dragable
+        self.assertEqual(len([sql for sql in queries
+                              if 'core_tombstone' in sql]),
+                         1)
+        self.assertEqual(len([sql for sql in queries
+                              if sql.startswith('SELECT "core_dragable"."id", '
+                                                '"core_dragable"."team_id"')]),
+                         0)
+        self.assertEqual(Tombstone.objects.filter(kind='annotation',
+                                                  team_id=self.team.pk,
+                                                  dragable_id=dragable_id
+                                                  ).count(),
+                         10)
+
+
+    def test_annotation_delete_queries(self):
+        other = Team(name='other', created_by=self.team.created_by)
+        other.save()
+        dragable = Dragable(hash='d2',
+                            team=other,
+                            created_by=self.team.created_by,
+                            url='http://www.example.com/',
+                            xpath='foo')
+        dragable.save()
+        for i in range(5):
+            Annotation(hash='a2-%d' % i,
+                       type='note',
+                       dragable=dragable,
+                       created_by=self.team.created_by,
+                       note='note').save()
+
+        old_debug = settings.DEBUG
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            Annotation.objects.all().delete()
+            queries = [query['sql'] for query in connection.queries]
+        finally:
+            settings.DEBUG = old_debug
+
+        # the teams of the dragables of all annotations at once
+        self.assertEqual(len([sql for sql in queries
+                              if sql.startswith('SELECT "core_dragable"."id", '
+                                                '"core_dragable"."team_id"')]),
+                         1)
+        self.assertEqual(sorted(Tombstone.objects.values_list('hash',
+                                                              'team_id')),
+                         [(u'a1', self.team.pk)] +
+                         [(u'a2-%d' % i, other.pk) for i in range(5)])
+
+
+    def test_failed_delete(self):
+        from django.db.models.signals import pre_delete
+
+        def fail(sender, instance, **kwargs):
+            raise RuntimeError('failed')
+
+        # fails after the pre_delete of core.sync, outside of a request
+        pre_delete.connect(fail, sender=Dragable, dispatch_uid='test.fail')
+        try:
+            self.assertRaises(RuntimeError,
+                              Dragable.objects.get(hash='d1').delete)
+        finally:
+            pre_delete.disconnect(sender=Dragable, dispatch_uid='test.fail')
+        self.failIf(Tombstone.objects.exists())
+
+        # the next deletion starts afresh and writes its tombstones
+        Dragable.objects.get(hash='d1').delete()
+        self.assertEqual(sorted(Tombstone.objects.values_list('kind', 'hash')),
+                         [(u'annotation', u'a1'), (u'dragable', u'd1')])
+
+
+    def test_purge(self):
+        from datetime import datetime, timedelta
+        from django.core.management import call_command
+
+        self.dragable.delete()
+        old = datetime.now() - timedelta(days=settings.SYNC_TOMBSTONE_DAYS + 1)
+        Tombstone.objects.filter(hash='a1').update(deleted=old)
+
+        call_command('purge_tombstones')
+        self.assertEqual(list(Tombstone.objects.values_list('hash', flat=True)),
+                         ['d1'])
+
+
+class HashKeyTest(TestCase):
+    """
+    Tests for the lookups by hash through the digests (see core.hashes)
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user('owner',
+                                             'owner@example.com',
+                                             'donthackmebro')
+        self.team = Team(name='team', created_by=self.user)
+        self.team.save()
+        for hash in (u'd1', u'D1', u'd\xfc', u'x' * 128):
+            Dragable(hash=hash,
+                     team=self.team,
+                     created_by=self.user,
+                     url='http://www.example.com/',
+                     xpath='foo').save()
+
+
+    def test_lookups(self):
+        from django.db.models import Q
+        from core.hashes import hash_digest
+
+        for hash in (u'd1', u'D1', u'd\xfc', u'x' * 128):
+            dragable = Dragable.objects.get(hash=hash)
+            self.assertEqual(dragable.hash, hash)
+            self.assertEqual(dragable.hash_key, hash_digest(hash))
+
+        self.assertEqual(sorted(Dragable.objects.filter(
+                                    hash__in=['d1', 'D1', 'missing']
+                                ).values_list('hash', flat=True)),
+                         ['D1', 'd1'])
+        self.assertEqual(Dragable.objects.exclude(hash='d1').count(), 3)
+        self.failIf(Dragable.objects.filter(hash='d').exists())
+        # iterators are used up by the first of the two lookups
+        self.assertEqual(Dragable.objects.filter(
+                                    hash__in=(hash for hash in ['d1', 'D1'])
+                                ).count(),
+                         2)
+        self.assertEqual(Dragable.objects.filter(
+                                    Q(hash__in=iter(['d1']))
+                                ).count(),
+                         1)
+        # lookups other than equality use the hash itself
+        self.assertEqual(Dragable.objects.filter(hash__startswith='x').count(),
+                         1)
+
+        Annotation(hash='a1',
+                   type='note',
+                   dragable=Dragable.objects.get(hash='d1'),
+                   created_by=self.user,
+                   note='note').save()
+        self.assertEqual(list(Annotation.objects.filter(
+                                dragable__hash='d1'
+                              ).values_list('hash', flat=True)),
+                         ['a1'])
+
+
+    def test_rewritten_lookups(self):
+        from django.db.models import Q
+
+        # Q objects, also negated and nested
+        self.assertEqual(sorted(Dragable.objects.filter(
+                                    Q(hash='d1') | Q(hash__in=['D1'])
+                                ).values_list('hash', flat=True)),
+                         ['D1', 'd1'])
+        self.assertEqual(Dragable.objects.filter(
+                                    ~Q(hash='d1') & Q(team=self.team)
+                                ).count(),
+                         3)
+        queryset = Dragable.objects.filter(Q(hash='d1') | Q(pk=0))
+        self.assert_('hash_key' in str(queryset.query))
+
+        # after values(), values_list() and dates()
+        for queryset in (Dragable.objects.values('pk'),
+                         Dragable.objects.values_list('pk'),
+                         Dragable.objects.dates('created', 'year')):
+            self.assert_('hash_key' in str(queryset.filter(hash='d1').query))
+        self.assertEqual(Dragable.objects.values_list('hash', flat=True
+                                                      ).get(hash='D1'),
+                         'D1')
+
+
+    def test_digest_collision(self):
+        from django.db.models import Q
+        from core.hashes import hash_digest
+
+        # as if 'd1' had the digest of 'other'
+        cursor = connection.cursor()
+        cursor.execute('UPDATE core_dragable SET hash_key = %s '
+                       'WHERE hash = %s',
+                       [buffer(hash_digest('other')), 'd1'])
+        self.failIf(Dragable.objects.filter(hash='other').exists())
+        self.failIf(Dragable.objects.filter(Q(hash='other')).exists())
+        self.failIf(Dragable.objects.filter(hash__in=['other']).exists())
+
+
+    def test_admin_form(self):
+        from core.forms import HashForm
+
+        class DragableForm(HashForm):
+            class Meta:
+                model = Dragable
+
+        data = {'hash': 'd1',
+                'team': self.team.pk,
+                'created_by': self.user.pk,
+                'url': 'http://www.example.com/',
+                'xpath': 'foo'}
+        form = DragableForm(data)
+        self.failIf(form.is_valid())
+        self.assert_('hash' in form.errors)
+
+        form = DragableForm(data, instance=Dragable.objects.get(hash='d1'))
+        self.assert_(form.is_valid(), form.errors)
+
+
+    def test_rename(self):
+        dragable = Dragable.objects.get(hash='d1')
+        dragable.hash = 'd2'
+        dragable.save()
+        self.failIf(Dragable.objects.filter(hash='d1').exists())
+        self.assertEqual(Dragable.objects.get(hash='d2').pk, dragable.pk)
+
+
+    def test_fill_keys(self):
+        from core.hashes import fill_keys
+        from core.hashes import hash_digest
+
+        cursor = connection.cursor()
+        for dragable in Dragable.objects.all():
+            cursor.execute('UPDATE core_dragable SET hash_key = %s '
+                           'WHERE id = %s',
+                           [buffer(hash_digest('stale%d' % dragable.pk)),
+                            dragable.pk])
+        self.failIf(Dragable.objects.filter(hash='d1').exists())
+
+        fill_keys('core_dragable', batch_size=3)
+        for hash in (u'd1', u'D1', u'd\xfc', u'x' * 128):
+            self.assertEqual(Dragable.objects.get(hash=hash).hash, hash)
+
+
+class HashIndexSizeTest(TransactionTestCase):
+    """
+    Compares the index of the digests with an index of the hashes themselves
+    (SQLite with the ``dbstat`` table only). The hashes are 40 characters
+    long, like the hex SHA-1 ids of the clients.
+
+    A ``TransactionTestCase``, because Python's sqlite3 module commits before
+    ``CREATE INDEX``.
+    """
+
+    ROWS = 1000
+
+
+    def index_sizes(self, cursor):
+        # the bytes of the entries and of the pages of each index of
+        # core_dragable
+        cursor.execute('SELECT name, SUM(payload), SUM(pgsize) FROM dbstat '
+                       'WHERE name IN (SELECT name FROM sqlite_master '
+                       "WHERE type = 'index' AND tbl_name = 'core_dragable') "
+                       'GROUP BY name')
+        return dict((name, (payload, pages))
+                    for name, payload, pages in cursor.fetchall())
+
+
+    def test_index_size(self):
+        from hashlib import sha1
+        from core.bulk import insert_instances
+
+        cursor = connection.cursor()
+        try:
+            cursor.execute('SELECT COUNT(*) FROM dbstat')
+        except Exception:
+            # not SQLite, or built without dbstat
+            return
+
+        user = User.objects.create_user('owner',
+                                        'owner@example.com',
+                                        'donthackmebro')
+        team = Team(name='team', created_by=user)
+        team.save()
+        insert_instances(Dragable,
+                         [Dragable(hash=sha1(str(i)).hexdigest(),
+                                   team=team,
+                                   created_by=user,
+                                   url='http://www.example.com/',
+                                   xpath='foo')
+                          for i in range(self.ROWS)])
+
+        before = self.index_sizes(cursor)
+        cursor.execute('CREATE INDEX test_dragable_hash '
+                       'ON core_dragable (hash)')
+        try:
+            by_hash = self.index_sizes(cursor)['test_dragable_hash']
+        finally:
+            cursor.execute('DROP INDEX test_dragable_hash')
+
+        # the unique index of the digests
+        cursor.execute("SELECT il.name FROM sqlite_master m, "
+                       "pragma_index_list(m.name) il, "
+                       "pragma_index_info(il.name) ii "
+                       "WHERE m.name = 'core_dragable' "
+                       "AND ii.name = 'hash_key'")
+        by_key = before[cursor.fetchone()[0]]
+        self.assert_(by_key[0] < by_hash[0] * 0.6, (by_key, by_hash))
+        self.assert_(by_key[1] < by_hash[1], (by_key, by_hash))
+
+
+class ConnectionPoolTest(TestCase):
+    """
+    Tests for the pooled database connections (see core.db.pool)
+    """
+
+    def setUp(self):
+        import tempfile
+        handle, self.name = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.old_size = settings.DATABASE_POOL_SIZE
+
+
+    def tearDown(self):
+        settings.DATABASE_POOL_SIZE = self.old_size
+        os.remove(self.name)
+
+
+    def _connect(self):
+        import sqlite3
+        return sqlite3.connect(self.name, check_same_thread=False)
+
+
+    def test_reuse(self):
+        from core.db.pool import ConnectionPool
+
+        pool = ConnectionPool(2, 60, 0.01)
+        self.assertEqual(pool.checkout(), (None, None))
+        connection = self._connect()
+        pool.connected()
+        pool.checkin(connection, time.time())
+
+        self.assertEqual(pool.checkout()[0], connection)
+        stats = pool.as_dict()
+        self.assertEqual((stats['checkouts'], stats['created'],
+                          stats['reused'], stats['in_use']),
+                         (2, 1, 1, 1))
+
+
+    def test_bounded(self):
+        from django.db.utils import DatabaseError
+        from core.db.pool import ConnectionPool
+
+        pool = ConnectionPool(2, 60, 0.01)
+        pool.checkout()
+        pool.checkout()
+        self.assertRaises(DatabaseError, pool.checkout)
+        self.assertEqual(pool.as_dict()['timeouts'], 1)
+
+        # room for a new connection
+        pool.discard()
+        self.assertEqual(pool.checkout(), (None, None))
+        self.assertEqual(pool.as_dict()['open'], 2)
+
+
+    def test_expired_and_broken(self):
+        from core.db.pool import ConnectionPool
+
+        pool = ConnectionPool(2, 60, 0.01)
+        pool.checkout()
+        pool.checkout()
+        pool.checkin(self._connect(), time.time() - 61)
+        broken = self._connect()
+        broken.close()
+        pool.checkin(broken, time.time())
+
+        # neither is handed out again
+        self.assertEqual(pool.checkout(), (None, None))
+        stats = pool.as_dict()
+        self.assertEqual((stats['expired'], stats['failed_checks'],
+                          stats['open']),
+                         (1, 1, 1))
+
+
+    def test_backend(self):
+        import threading
+        from django.db import load_backend
+        from core.db import pool
+
+        backend = load_backend('core.db.backends.sqlite3_pool')
+        settings_dict = dict(connection.settings_dict, NAME=self.name)
+        pool._pools.pop('pool-test', None)
+
+        def request(connections):
+            wrapper = backend.DatabaseWrapper(dict(settings_dict), 'pool-test')
+            wrapper.cursor().execute('SELECT 1')
+            connections.append(wrapper.connection)
+            wrapper.close()
+
+        connections = []
+        for i in range(3):
+            # a thread per request
+            thread = threading.Thread(target=request, args=(connections,))
+            thread.start()
+            thread.join()
+
+        self.assertEqual(len(set(connections)), 1)
+        self.assertEqual(pool.get_stats()['pool-test']['created'], 1)
+        del pool._pools['pool-test']
+
+
+    def test_stress(self):
+        from core.db import stress
+
+        settings.DATABASE_POOL_SIZE = 2
+        results = stress.run(connection.settings_dict,
+                             threads=4,
+                             requests=10)
+
+        self.assertEqual([results['plain']['errors'],
+                          results['pooled']['errors']],
+                         [0, 0])
+        stats = results['pooled']['pool']
+        self.assertEqual(stats['checkouts'], 40)
+        self.failUnless(stats['open'] <= 2)
+        self.assertEqual(stats['reused'], 40 - stats['created'])
+
+
+class ReplicaRouterTest(TestCase):
+    """
+    Tests for the routing of reads to replicas (see core.routers)
+    """
+
+    def setUp(self):
+        from django.http import HttpRequest
+        self.old_settings = (settings.DATABASE_REPLICAS,
+                             settings.DATABASE_REPLICA_PIN_SECONDS)
+        settings.DATABASE_REPLICAS = ['replica1', 'replica2']
+        self.user = User.objects.create_user('reader',
+                                             'reader@example.com',
+                                             'donthackmebro')
+        self.request = HttpRequest()
+        self.request.user = self.user
+
+
+    def tearDown(self):
+        from django.core.cache import cache
+        from core import routers
+        routers.stop_reading()
+        cache.delete(routers._pin_key(self.user.id))
+        (settings.DATABASE_REPLICAS,
+         settings.DATABASE_REPLICA_PIN_SECONDS) = self.old_settings
+
+
+    def test_reads(self):
+        from core import routers
+        router = routers.ReplicaRouter()
+
+        self.assertEqual(router.db_for_read(Dragable), None)
+        self.failUnless(routers.start_reading(self.request))
+        alias = router.db_for_read(Dragable)
+        self.failUnless(alias in settings.DATABASE_REPLICAS)
+        # one replica per request
+        for i in range(10):
+            self.assertEqual(router.db_for_read(Annotation), alias)
+        # other apps and writes aren't routed
+        self.assertEqual(router.db_for_read(User), None)
+        self.assertEqual(router.db_for_write(Dragable), 'default')
+
+        routers.stop_reading()
+        self.assertEqual(router.db_for_read(Dragable), None)
+
+
+    def test_pinned(self):
+        from django.contrib.auth.models import AnonymousUser
+        from core import routers
+        router = routers.ReplicaRouter()
+
+        routers.pin(self.user)
+        routers.start_reading(self.request)
+        self.assertEqual(router.db_for_read(Team), 'default')
+
+        self.request.user = AnonymousUser()
+        routers.pin(self.request.user)
+        routers.start_reading(self.request)
+        self.failUnless(router.db_for_read(Team)
+                        in settings.DATABASE_REPLICAS)
+
+
+    def test_pin_expires(self):
+        from core import routers
+        router = routers.ReplicaRouter()
+
+        settings.DATABASE_REPLICA_PIN_SECONDS = 0
+        routers.pin(self.user)
+        routers.start_reading(self.request)
+        self.failUnless(router.db_for_read(Team)
+                        in settings.DATABASE_REPLICAS)
+
+
+    def test_without_replicas(self):
+        from core import routers
+        router = routers.ReplicaRouter()
+
+        settings.DATABASE_REPLICAS = []
+        self.assertEqual(routers.start_reading(self.request), None)
+        self.assertEqual(router.db_for_read(Dragable), None)
+        self.assertEqual(router.allow_syncdb('default', Dragable), None)
+
+
+    def test_syncdb(self):
+        from core import routers
+        router = routers.ReplicaRouter()
+        self.assertEqual(router.allow_syncdb('replica1', Dragable), False)
+        self.assertEqual(router.allow_syncdb('default', Dragable), None)
+
+
+class CacheCheckTest(TestCase):
+    """
+    Tests for the check of the cache backend (see core.checks)
+    """
+
+    def setUp(self):
+        self.old_backend = settings.CACHE_BACKEND
+
+
+    def tearDown(self):
+        settings.CACHE_BACKEND = self.old_backend
+
+
+    def test_shared(self):
+        from core.checks import is_shared_cache
+        self.failIf(is_shared_cache('locmem://'))
+        self.failUnless(is_shared_cache('memcached://127.0.0.1:11211/'))
+        self.failUnless(is_shared_cache('db://cache_table'))
+
+
+    def test_check(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from core.checks import check_cache
+
+        settings.CACHE_BACKEND = 'locmem://'
+        check_cache(False)
+        self.assertRaises(ImproperlyConfigured, check_cache, True)
+
+        settings.CACHE_BACKEND = 'memcached://127.0.0.1:11211/'
+        check_cache(True)
+
+
+    def test_application(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from core.checks import CheckedApplication
+
+        def application(environ, start_response):
+            return ['ok']
+
+        settings.CACHE_BACKEND = 'locmem://'
+        checked = CheckedApplication(application)
+        self.assertEqual(checked({'wsgi.multiprocess': False}, None), ['ok'])
+        self.assertRaises(ImproperlyConfigured,
+                          CheckedApplication(application),
+                          {'wsgi.multiprocess': True},
+                          None)
@@ -0,0 +1,146 @@
+"""
+API tokens.
+
+A token is issued once for a user who authenticated with username and
+password, and replaces the password in later requests. Tokens are random,
+so a single SHA-256 digest is enough to store them safely, and checking one
+costs no password hashing.
+
+The user of a token is looked up in a small in-process cache first, then in
+the cache (``CACHE_BACKEND``) and only then in the primary database, a
+lagging replica could still hold a revoked token. Revoking a token (deleting
+its ``ApiToken``) or saving its user drops it from the cache and from the
+cache of the current process. The other processes keep it for at most
+``API_TOKEN_LOCAL_TIMEOUT`` seconds.
+
+That only holds if the cache is shared by all processes, e.g. memcached.
+With a process-local cache the others would keep a revoked token for
+``API_TOKEN_CACHE_TIMEOUT``, ``core.checks`` refuses to serve several
+processes with one.
+"""
+
+from hashlib import sha256
+import copy
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+
+from core.models import ApiToken
+
+# random bytes per token
+TOKEN_BYTES = 20
+
+# digest -> (expiry time, user)
+_local_cache = {}
+_local_lock = threading.Lock()
+
+
+def _digest(token):
+    if isinstance(token, unicode):
+        token = token.encode('utf-8')
+    return sha256(token).hexdigest()
+
+
+def _cache_key(digest):
+    return 'core.token.%s' % digest
+
+
+def issue_token(user, name=''):
+    """
+    Creates a token for ``user`` and returns it with its ``ApiToken``. The
+    token can't be recovered later.
+    """
+    token = os.urandom(TOKEN_BYTES).encode('hex')
+    api_token = ApiToken.objects.create(user=user,
+                                        digest=_digest(token),
+                                        name=name)
+    return token, api_token
+
+
+def get_token_user(token):
+    """
+    Returns the active user that ``token`` was issued to, or ``None`` if
+    the token is unknown or revoked.
+    """
+    digest = _digest(token)
+    now = time.time()
+
+    entry = _local_cache.get(digest)
+    if entry is not None and entry[0] > now:
+        user = entry[1]
+    else:
+        key = _cache_key(digest)
+        user = cache.get(key)
+
+        if user is None:
+            try:
+                user = ApiToken.objects.using(DEFAULT_DB_ALIAS).select_related(
+                                            'user').get(digest=digest).user
+            except ApiToken.DoesNotExist:
+                return None
+            cache.set(key,
+                      user,
+                      getattr(settings, 'API_TOKEN_CACHE_TIMEOUT', 60 * 60))
+
+        _remember(digest, user, now)
+
+    if not user.is_active:
+        return None
+
+    # requests must not share the instance
+    return copy.copy(user)
+
+
+def _remember(digest, user, now):
+    _local_lock.acquire()
+    try:
+        if len(_local_cache) >= getattr(settings,
+                                        'API_TOKEN_LOCAL_CACHE_SIZE',
+                                        1000):
+            _local_cache.clear()
+        _local_cache[digest] = (now + getattr(settings,
+                                              'API_TOKEN_LOCAL_TIMEOUT',
+                                              10),
+                                user)
+    finally:
+        _local_lock.release()
+
+
+def invalidate_tokens(digests):
+    """
+    Drops the cached users of the tokens with the given digests.
+    """
+    cache.delete_many([_cache_key(digest) for digest in digests])
+
+    _local_lock.acquire()
+    try:
+        for digest in digests:
+            _local_cache.pop(digest, None)
+    finally:
+        _local_lock.release()
+
+
+def _token_deleted(sender, instance, **kwargs):
+    invalidate_tokens([instance.digest])
+
+
+def _user_saved(sender, instance, created, **kwargs):
+    # e.g. deactivated or renamed
+    if not created:
+        invalidate_tokens(list(instance.api_tokens.values_list('digest',
+                                                               flat=True)))
+
+
+post_delete.connect(_token_deleted,
+                    sender=ApiToken,
+                    dispatch_uid='core.tokens.token_deleted')
+post_save.connect(_user_saved,
+                  sender=User,
+                  dispatch_uid='core.tokens.user_saved')
@@ -0,0 +1,211 @@
+"""
+Per-team version counters.
+
+Every write to a dragable or an annotation bumps the version of the team it
+belongs to, so anything derived from the contents of a team (e.g. the graph
+of its dragables) can be cached under the team's current version and never
+needs to be invalidated explicitly.
+
+Changes to the teams themselves (name, description, members) bump the
+version of the team and the ``ALL_TEAMS`` version, which covers the list of
+all teams.
+
+The counters live in the cache. A missing counter is started at the current
+time in microseconds, so a counter that was evicted from the cache comes
+back larger than any value it had before. Next to every counter the cache
+holds the time of its last change.
+
+A bump has to reach every process, or the others would keep answering
+``304 Not Modified`` for content that has changed. With several processes
+the cache must therefore be shared, e.g. memcached, whose ``incr`` is atomic
+as well. ``core.checks`` refuses to serve them from a process-local cache.
+"""
+
+import time
+
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_init
+from django.db.models.signals import post_save
+
+from core.models import Annotation
+from core.models import Dragable
+from core.models import Team
+from core.signals import post_bulk_save
+
+# counters are kept as long as the cache backend allows (30 days for memcached)
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+# the version of the list of all teams
+ALL_TEAMS = 'all'
+
+
+def _version_key(team_id):
+    return 'core.team_version.%s' % team_id
+
+
+def _modified_key(team_id):
+    return 'core.team_modified.%s' % team_id
+
+
+def _initial_version():
+    return int(time.time() * 1000000)
+
+
+def get_team_state(team_ids):
+    """
+    Returns a dict mapping each of the given team ids (or ``ALL_TEAMS``) to
+    its current version, and the time of the latest change to any of the
+    teams in seconds since the epoch. Needs one cache lookup.
+    """
+    keys = []
+    for team_id in team_ids:
+        keys.extend([_version_key(team_id), _modified_key(team_id)])
+    cached = cache.get_many(keys)
+    versions = {}
+    last_modified = 0
+
+    for team_id in team_ids:
+        key = _version_key(team_id)
+        if key not in cached:
+            cache.add(key, _initial_version(), VERSION_TIMEOUT)
+            cached[key] = cache.get(key)
+        versions[team_id] = cached[key]
+
+        modified = cached.get(_modified_key(team_id))
+        if modified is None:
+            # unknown, so it has to be treated as changed just now
+            modified = time.time()
+            cache.add(_modified_key(team_id), modified, VERSION_TIMEOUT)
+        last_modified = max(last_modified, modified)
+
+    return versions, last_modified
+
+
+def get_team_versions(team_ids):
+    """
+    Returns a dict mapping each of the given team ids to its current version.
+    """
+    return get_team_state(team_ids)[0]
+
+
+def get_team_version(team_id):
+    """
+    Returns the current version of the team with the given id.
+    """
+    return get_team_versions([team_id])[team_id]
+
+
+def bump_team_versions(team_ids):
+    """
+    Increments the versions of the given teams.
+    """
+    now = time.time()
+
+    for team_id in set(team_ids):
+        if team_id is None:
+            continue
+        key = _version_key(team_id)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # not cached (anymore), a fresh counter is larger than the old one
+            cache.add(key, _initial_version(), VERSION_TIMEOUT)
+        cache.set(_modified_key(team_id), now, VERSION_TIMEOUT)
+
+
+def _annotation_team_ids(annotations):
+    team_ids = set()
+    dragable_ids = set()
+
+    for annotation in annotations:
+        dragable = getattr(annotation, '_dragable_cache', None)
+        if dragable is not None:
+            team_ids.add(dragable.team_id)
+        else:
+            dragable_ids.add(annotation.dragable_id)
+
+    if dragable_ids:
+        team_ids.update(Dragable.objects.filter(
+                            pk__in=dragable_ids).values_list('team', flat=True))
+
+    return team_ids
+
+
+def _dragable_loaded(sender, instance, **kwargs):
+    # remembers the team, in case the dragable is moved to another one
+    instance._loaded_team_id = instance.team_id
+
+
+def _dragables_changed(dragables):
+    team_ids = set()
+    for dragable in dragables:
+        team_ids.add(dragable.team_id)
+        team_ids.add(getattr(dragable, '_loaded_team_id', None))
+        dragable._loaded_team_id = dragable.team_id
+    bump_team_versions(team_ids)
+
+
+def _dragable_saved(sender, instance, **kwargs):
+    _dragables_changed([instance])
+
+
+def _annotation_saved(sender, instance, **kwargs):
+    bump_team_versions(_annotation_team_ids([instance]))
+
+
+def _bulk_saved(sender, instances, **kwargs):
+    if sender is Dragable:
+        _dragables_changed(instances)
+    elif sender is Annotation:
+        bump_team_versions(_annotation_team_ids(instances))
+
+
+def _team_changed(sender, instance, **kwargs):
+    bump_team_versions([instance.pk, ALL_TEAMS])
+
+
+def _team_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            bump_team_versions([instance.pk, ALL_TEAMS])
+        return
+
+    # instance is a user, pk_set holds team ids
+    if action == 'pre_clear':
+        instance._cleared_team_ids = list(
+                            instance.team_members.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        bump_team_versions(getattr(instance, '_cleared_team_ids', []) +
+                           [ALL_TEAMS])
+    elif action in ('post_add', 'post_remove'):
+        bump_team_versions(list(pk_set or []) + [ALL_TEAMS])
+
+
+post_init.connect(_dragable_loaded,
+                  sender=Dragable,
+                  dispatch_uid='core.versions.dragable_loaded')
+post_save.connect(_dragable_saved,
+                  sender=Dragable,
+                  dispatch_uid='core.versions.dragable_saved')
+post_delete.connect(_dragable_saved,
+                    sender=Dragable,
+                    dispatch_uid='core.versions.dragable_deleted')
+post_save.connect(_annotation_saved,
+                  sender=Annotation,
+                  dispatch_uid='core.versions.annotation_saved')
+post_delete.connect(_annotation_saved,
+                    sender=Annotation,
+                    dispatch_uid='core.versions.annotation_deleted')
+post_bulk_save.connect(_bulk_saved,
+                       dispatch_uid='core.versions.bulk_saved')
+post_save.connect(_team_changed,
+                  sender=Team,
+                  dispatch_uid='core.versions.team_saved')
+post_delete.connect(_team_changed,
+                    sender=Team,
+                    dispatch_uid='core.versions.team_deleted')
+m2m_changed.connect(_team_members_changed,
+                    sender=Team.members.through,
+                    dispatch_uid='core.versions.team_members_changed')
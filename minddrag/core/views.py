@@ -2,8 +2,11 @@ from django.contrib.auth.decorators import login_required
 from django.shortcuts import render_to_response
 from django.template.context import RequestContext
 
+from core import metrics
 from core import models
+from core.routers import reads_from_replica
 
+@metrics.measured('views.index')
 def index(request):
     """
     The minddrag homepage
@@ -13,7 +16,9 @@ def index(request):
                               context_instance=RequestContext(request))
 
 
+@metrics.measured('views.my_dragables')
 @login_required
+@reads_from_replica
 def my_dragables(request):
     """
     The page where users can view their dragables.
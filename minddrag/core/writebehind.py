@@ -0,0 +1,361 @@
+"""
+Write-behind buffer for new dragables and annotations.
+
+With ``WRITE_BEHIND_ENABLED`` the creating handlers don't save every new
+instance in its own transaction. They put it into a bounded in-process
+queue, and a background thread inserts what has piled up with one multi-row
+statement per model (see ``core.bulk``) and commits once per batch. Under
+load this turns many small transactions, which serialize on the write lock
+of SQLite, into few large ones.
+
+``WRITE_BEHIND_DURABILITY`` decides when a create is acknowledged:
+
+``'commit'``
+    after the batch with the instance was committed. The response means the
+    same as without the buffer, and failures (e.g. a duplicate hash) are
+    still reported to the client.
+
+``'enqueue'``
+    as soon as the instance is queued. Responses are faster, but the
+    instance is only readable after the next flush, it's lost if the process
+    dies before, and failures can only be logged.
+
+When the queue is full, a create waits ``WRITE_BEHIND_ENQUEUE_TIMEOUT``
+seconds for room and then gives up with ``BufferFull``, which the handlers
+answer with ``503 Throttled``. A create that waits longer than
+``WRITE_BEHIND_COMMIT_TIMEOUT`` seconds for its commit is taken out of the
+queue and fails with ``BufferFull`` as well, unless its batch is already
+being written. Then it fails with ``StillWriting``, which the handlers answer
+with ``202 Accepted``.
+
+Instances that are still queued can be found with ``pending``, e.g. to
+annotate a dragable that was created just before.
+"""
+
+from Queue import Empty
+from Queue import Full
+from Queue import Queue
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.db import transaction
+
+from core.bulk import insert_instances
+
+
+class NullHandler(logging.Handler):
+    """
+    Drops the records, ``logging.NullHandler`` is new in Python 2.7.
+    """
+
+    def emit(self, record):
+        pass
+
+
+logger = logging.getLogger('core.writebehind')
+logger.addHandler(NullHandler())
+
+
+class BufferFull(Exception):
+    """
+    The queue stayed full, or the flush took too long. The instance isn't
+    saved.
+    """
+
+
+class StillWriting(Exception):
+    """
+    The flush took too long, but the batch with the instance is being
+    written. The instance may still be saved.
+    """
+
+
+class _Entry(object):
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.done = threading.Event()
+        self.error = None
+        # taken out of the queue to be written
+        self.taken = False
+        # given up by ``add``, must not be written
+        self.cancelled = False
+
+
+class WriteBuffer(object):
+    """
+    A queue of at most ``size`` new instances, written in batches of up to
+    ``batch_size``. Without ``background`` no thread is started, and the
+    queue is only written by ``flush``.
+    """
+
+    def __init__(self, size, batch_size, background=True):
+        self.queue = Queue(size)
+        self.batch_size = batch_size
+        self.background = background
+        # (model, hash) -> queued instance
+        self._pending = {}
+        self._lock = threading.Lock()
+        # batches are written one after the other, so that instances that
+        # refer to queued instances are inserted after them
+        self._write_lock = threading.Lock()
+        self._thread = None
+
+
+    def add(self, instance, wait):
+        """
+        Queues the new ``instance``. With ``wait``, returns after it was
+        written: true if it was saved and false if saving failed.
+
+        Raises ``BufferFull`` if the instance couldn't be queued, or if it
+        wasn't written in time and was taken out of the queue again, and
+        ``StillWriting`` if it wasn't written in time but can't be taken out
+        of the queue anymore.
+        """
+        entry = _Entry(instance)
+        key = (type(instance), instance.hash)
+
+        self._lock.acquire()
+        try:
+            if key in self._pending:
+                # would fail the unique index of the hash
+                return False
+            self._pending[key] = instance
+        finally:
+            self._lock.release()
+
+        try:
+            self.queue.put(entry,
+                           timeout=getattr(settings,
+                                           'WRITE_BEHIND_ENQUEUE_TIMEOUT',
+                                           1))
+        except Full:
+            self._forget([entry])
+            raise BufferFull()
+
+        if not self.background:
+            if wait:
+                self.flush()
+        elif self._thread is None or not self._thread.isAlive():
+            self._start()
+
+        if not wait:
+            return True
+
+        entry.done.wait(getattr(settings, 'WRITE_BEHIND_COMMIT_TIMEOUT', 10))
+        if not entry.done.isSet():
+            self._cancel(entry)
+        return entry.error is None
+
+
+    def pending(self, model, hash):
+        """
+        Returns the queued instance of ``model`` with ``hash`` or ``None``.
+        """
+        return self._pending.get((model, hash))
+
+
+    def flush(self):
+        """
+        Writes the queued instances in the calling thread and returns when
+        the queue is empty.
+        """
+        while True:
+            batch = self._take(block=False)
+            if batch:
+                self._write(batch)
+            elif self.queue.empty():
+                return
+
+
+    def _cancel(self, entry):
+        # raises the error of an instance that wasn't written in time
+        self._lock.acquire()
+        try:
+            if entry.done.isSet():
+                # written in the meantime
+                return
+            if entry.taken:
+                raise StillWriting()
+            entry.cancelled = True
+        finally:
+            self._lock.release()
+        self._forget([entry])
+        raise BufferFull()
+
+
+    def _start(self):
+        self._lock.acquire()
+        try:
+            if self._thread is None or not self._thread.isAlive():
+                self._thread = threading.Thread(target=self._run,
+                                                name='write-behind')
+                self._thread.setDaemon(True)
+                self._thread.start()
+        finally:
+            self._lock.release()
+
+
+    def _run(self):
+        while True:
+            batch = self._take(block=True)
+            try:
+                self._write(batch)
+            except Exception:
+                logger.exception('Writing %d instances failed', len(batch))
+
+
+    def _take(self, block):
+        batch = []
+        try:
+            if block:
+                batch.append(self.queue.get())
+            while len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+        except Empty:
+            pass
+
+        self._lock.acquire()
+        try:
+            batch = [entry for entry in batch if not entry.cancelled]
+            for entry in batch:
+                entry.taken = True
+        finally:
+            self._lock.release()
+        return batch
+
+
+    def _write(self, batch):
+        # one group per model, in the order the models came in
+        groups = []
+        by_model = {}
+        for entry in batch:
+            model = type(entry.instance)
+            if model not in by_model:
+                by_model[model] = []
+                groups.append((model, by_model[model]))
+            by_model[model].append(entry)
+
+        self._write_lock.acquire()
+        try:
+            for model, entries in groups:
+                _resolve_relations(entries)
+                try:
+                    _insert(model, [entry.instance for entry in entries])
+                except Exception:
+                    # find the culprits
+                    for entry in entries:
+                        try:
+                            _save(entry.instance)
+                        except Exception, e:
+                            entry.error = e
+                            entry.instance.pk = None
+                            logger.warning('Saving %s %r failed: %s',
+                                           model.__name__,
+                                           entry.instance.hash,
+                                           e)
+        finally:
+            self._write_lock.release()
+            self._forget(batch)
+            for entry in batch:
+                entry.done.set()
+
+
+    def _forget(self, entries):
+        self._lock.acquire()
+        try:
+            for entry in entries:
+                key = (type(entry.instance), entry.instance.hash)
+                # the hash may have been queued again by now
+                if self._pending.get(key) is entry.instance:
+                    del self._pending[key]
+        finally:
+            self._lock.release()
+
+
+def _resolve_relations(entries):
+    # instances that were queued when they were assigned have a pk now
+    for entry in entries:
+        instance = entry.instance
+        for field in instance._meta.fields:
+            if (field.rel is None
+                or getattr(instance, field.attname) is not None):
+                continue
+            related = getattr(instance, field.get_cache_name(), None)
+            if related is not None:
+                setattr(instance, field.attname, related.pk)
+
+
+def _insert(model, instances):
+    try:
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            insert_instances(model, instances)
+            transaction.commit()
+        except:
+            transaction.rollback()
+            for instance in instances:
+                instance.pk = None
+            raise
+    finally:
+        transaction.leave_transaction_management()
+
+
+def _save(instance):
+    if instance.pk is not None:
+        # inserted by the failed batch, which was rolled back
+        instance.pk = None
+    save = transaction.commit_on_success(instance.save)
+    save()
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    """
+    Returns the buffer of this process.
+    """
+    global _buffer
+    if _buffer is None:
+        _buffer_lock.acquire()
+        try:
+            if _buffer is None:
+                _buffer = WriteBuffer(
+                    getattr(settings, 'WRITE_BEHIND_QUEUE_SIZE', 1000),
+                    getattr(settings, 'WRITE_BEHIND_BATCH_SIZE', 100))
+                # don't drop what's queued on a regular exit
+                atexit.register(_buffer.flush)
+        finally:
+            _buffer_lock.release()
+    return _buffer
+
+
+def is_enabled():
+    return getattr(settings, 'WRITE_BEHIND_ENABLED', False)
+
+
+def save(instance):
+    """
+    Saves the new ``instance``, through the buffer if it's enabled. Returns
+    false if saving failed, as far as the durability tells.
+    """
+    if not is_enabled():
+        instance.save()
+        return True
+
+    durability = getattr(settings, 'WRITE_BEHIND_DURABILITY', 'commit')
+    return get_buffer().add(instance, wait=durability == 'commit')
+
+
+def pending(model, hash):
+    """
+    Returns the queued instance of ``model`` with ``hash``, or ``None``.
+    """
+    if not is_enabled() or _buffer is None:
+        return None
+    return _buffer.pending(model, hash)
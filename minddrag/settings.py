@@ -17,10 +17,29 @@ if DEBUG:
 # cache settings
 # ==============================================================================
 
+# permissions, ETags and API tokens are invalidated through the cache, so it
+# has to be shared by all processes of the site (e.g. memcached); locmem only
+# works for a single process (see core.checks)
 CACHE_BACKEND = 'locmem://'
 CACHE_MIDDLEWARE_KEY_PREFIX = '%s_' % PROJECT_NAME
 CACHE_MIDDLEWARE_SECONDS = 600
 
+# how long the team ids of a user are cached (see core.models.get_team_ids)
+MEMBERSHIP_CACHE_TIMEOUT = 60 * 60
+# how long the graph of a team is cached, it is rebuilt anyway when the team's
+# version changes (see core.graph.get_team_graph)
+GRAPH_CACHE_TIMEOUT = 60 * 60
+# how long the serialized dragables and annotations are cached, writes change
+# their cache keys (see api.representations)
+API_REPRESENTATION_CACHE_TIMEOUT = 60 * 60 * 24
+# how long the users of API tokens are cached, in CACHE_BACKEND and in every
+# process (see core.tokens); revoked tokens keep working in other processes
+# for up to API_TOKEN_LOCAL_TIMEOUT seconds, as long as CACHE_BACKEND is
+# shared by them (locmem isn't, see core.checks)
+API_TOKEN_CACHE_TIMEOUT = 60 * 60
+API_TOKEN_LOCAL_TIMEOUT = 10
+API_TOKEN_LOCAL_CACHE_SIZE = 1000
+
 # ==============================================================================
 # email and error-notify settings
 # ==============================================================================
@@ -63,6 +82,24 @@ DATABASE_PASSWORD = ''
 DATABASE_HOST = ''
 DATABASE_PORT = ''
 
+# the pooled backends (e.g. DATABASE_ENGINE = 'core.db.backends.mysql_pool')
+# keep up to DATABASE_POOL_SIZE connections per process open between
+# requests, for at most DATABASE_POOL_MAX_AGE seconds each. A request waits
+# DATABASE_POOL_TIMEOUT seconds for a connection when all are in use (see
+# core.db.pool). Compare with ``manage.py stress_db_pool``.
+DATABASE_POOL_SIZE = 10
+DATABASE_POOL_MAX_AGE = 600
+DATABASE_POOL_TIMEOUT = 10
+
+# reads of the API and my_dragables may go to the aliases in DATABASE_REPLICAS
+# (add them to DATABASES), writes go to the default database. Users who have
+# written read from the default database for DATABASE_REPLICA_PIN_SECONDS, and
+# so do cached reads of data that changed more recently (see core.routers);
+# the replicas must catch up within that time.
+DATABASE_ROUTERS = ['core.routers.ReplicaRouter']
+DATABASE_REPLICAS = []
+DATABASE_REPLICA_PIN_SECONDS = 10
+
 # ==============================================================================
 # i18n and url settings
 # ==============================================================================
@@ -101,10 +138,10 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'minddrag.core.middleware.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'django.middleware.http.ConditionalGetMiddleware',
-#    'django.middleware.gzip.GZipMiddleware',
+    'minddrag.core.middleware.ConditionalGetMiddleware',
     'django.middleware.common.CommonMiddleware',
 )
 
@@ -126,6 +163,60 @@ TEMPLATE_LOADERS = (
 #    'django.template.loaders.eggs.load_template_source',
 )
 
+# ==============================================================================
+# api settings
+# ==============================================================================
+
+# page size of collection reads, unless the client asks for a different one
+API_PAGE_SIZE = 25
+# upper bound for the ``limit`` URL parameter
+API_MAX_PAGE_SIZE = 100
+# number of rows read per query when a collection is streamed
+API_STREAM_CHUNK_SIZE = 500
+# maximum number of objects in one bulk request
+API_BULK_MAX_ITEMS = 100
+# default and maximum number of hops and dragables of a neighbourhood read
+API_GRAPH_DEPTH = 2
+API_GRAPH_MAX_DEPTH = 5
+API_GRAPH_NODES = 100
+API_GRAPH_MAX_NODES = 500
+# users in more teams are filtered with a membership subquery instead of a
+# list of team ids (see api.visibility)
+API_VISIBILITY_MAX_TEAM_IDS = 500
+
+# sync tokens point this many seconds into the past, so that slow commits
+# aren't missed by the next sync
+SYNC_TOKEN_OVERLAP = 2
+# how long the tombstones of deleted dragables and annotations are kept, older
+# sync tokens are rejected (see core.sync)
+SYNC_TOMBSTONE_DAYS = 30
+
+# full-text search over dragables and annotations (see core.search)
+SEARCH_BACKEND = 'core.search.SQLiteFTS5Backend'
+
+# measure the requests to the API and the views, staff can read the numbers
+# at api/1.0/_metrics (see core.metrics)
+METRICS_ENABLED = True
+
+# queue new dragables and annotations and insert them in batches from a
+# background thread (see core.writebehind). Acknowledge a create after its
+# batch was committed ('commit') or as soon as it's queued ('enqueue').
+WRITE_BEHIND_ENABLED = False
+WRITE_BEHIND_DURABILITY = 'commit'
+WRITE_BEHIND_QUEUE_SIZE = 1000
+WRITE_BEHIND_BATCH_SIZE = 100
+# seconds a create waits for room in a full queue, and for the commit of its
+# batch, before it's answered with 503 Throttled (or 202 Accepted, if its
+# batch is being written by then)
+WRITE_BEHIND_ENQUEUE_TIMEOUT = 1
+WRITE_BEHIND_COMMIT_TIMEOUT = 10
+
+# responses are compressed with gzip at COMPRESSION_LEVEL if they are at least
+# COMPRESSION_MIN_LENGTH bytes long (streamed ones always), compressed
+# representations with an ETag are cached (see core.compression)
+COMPRESSION_LEVEL = 6
+COMPRESSION_MIN_LENGTH = 1024
+
 # ==============================================================================
 # the secret key
 # ==============================================================================
@@ -159,6 +250,8 @@ ACCOUNT_ACTIVATION_DAYS = 7
 
 PISTON_EMAIL_ERRORS = False
 PISTON_DISPLAY_ERRORS = True
+# buffer ordinary responses; collection reads can still be streamed per
+# request with ``stream=1`` or ``format=ndjson`` (see api.emitters)
 PISTON_STREAM_OUTPUT = False
 
 # ==============================================================================
@@ -7,3 +7,6 @@ DATABASE_USER = 'minddrag'
 DATABASE_PASSWORD = 'EnikniOjkogMoiHivRew'
 DATABASE_HOST = 'localhost'
 
+SEARCH_BACKEND = 'core.search.MySQLFullTextBackend'
+# shared by all mod_wsgi processes (see core.checks)
+CACHE_BACKEND = 'memcached://127.0.0.1:11211/'